@@ -14,11 +14,19 @@ import sys
 
 from db import db
 from ma import ma
+from libs import timing, retention, confirmation_sweeper, outbox
+from libs.passwords import HashingBusy
+import messages.en as msgs
 from resources.user import UserRegister, UserList, UserLogin, TokenRefresh
-from resources.safe import SafeList, SafeRegister, SafeCheckin, AvailableSafes
+from resources.safe import SafeList, SafeRegister, SafeCheckin, SafeBatchCheckin, SafeSession, AvailableSafes
 from resources.confirmation import Confirmation, ConfirmationByUser
-from resources.operations import ClaimSafe, KHClaimSH, Message, SafeOps, SafeSummary
+from resources.operations import ClaimSafe, KHClaimSH, Message, MessageStream, MessageRead, MessageUnread, SafeOps, \
+    SafeEvents, SafeSummary
 from resources.relationship import GetRelationStatus
+from resources.metrics import ServerMetrics
+from models.safe import SafeModel, heartbeat_buffer, unlock_scheduler
+from models.lease import LeaseModel
+from models.outbox import OutboxModel, mail_sender
 
 app = Flask(__name__)
 cors = CORS(app)
@@ -32,6 +40,14 @@ ma.init_app(app)
 
 jwt = JWTManager(app)
 migrate = Migrate(app=app, db=db)
+timing.init_app(app)
+retention.init_app(app)
+confirmation_sweeper.init_app(app)
+heartbeat_buffer.init_app(app, writer=SafeModel.save_heartbeats)
+unlock_scheduler.init_app(app, loader=SafeModel.find_pending_unlocks, unlocker=SafeModel.authorise_unlocks,
+                          acquire=LeaseModel.acquire, release=LeaseModel.release)
+mail_sender.init_app(app, claimer=OutboxModel.claim_due, recorder=OutboxModel.record_results)
+outbox.init_app(app, sender=mail_sender, purger=OutboxModel.purge_sent)
 
 
 @app.before_first_request
@@ -44,6 +60,11 @@ def handle_marshmallow_error(err):
     return jsonify(err.messages), 400
 
 
+@app.errorhandler(HashingBusy)
+def handle_hashing_busy(err):
+    return jsonify({"message": msgs.HASHING_BUSY}), 503, {"Retry-After": "1"}
+
+
 # User endpoints
 api.add_resource(UserRegister, "/register")
 api.add_resource(UserList, "/users")
@@ -55,14 +76,21 @@ api.add_resource(ConfirmationByUser, "/check/<int:user_id>")
 api.add_resource(SafeList, "/api/safe")  # GET
 api.add_resource(SafeRegister, "/api/register")  # POST
 api.add_resource(SafeCheckin, "/api/checkin")  # POST
+api.add_resource(SafeSession, "/api/session")  # POST - Safe to negotiate a session key for checkins
+api.add_resource(SafeBatchCheckin, "/api/checkin/batch")  # POST - Site gateway checkin for several safes
 api.add_resource(AvailableSafes, "/api/available_safes")  # GET
+api.add_resource(ServerMetrics, "/api/metrics")  # GET - Checkin admission rate and cache figures for this process
 # Operations endpoints
 api.add_resource(ClaimSafe, "/operation/claim_safe")  # GET/DELETE - SH to register ownership of safe or release one
 api.add_resource(KHClaimSH, "/operation/claim_sh")  # POST/DELETE - KH to initiate/release relationship with SH
 # api.add_resource(SHEmergency, "/operation/emergency')  # DELETE - SH emergency terminate of relationship
 api.add_resource(GetRelationStatus, "/operation/relationship")  # GET - Either party to get status of their relationship
 api.add_resource(Message, "/operation/message")  # GET/POST - Either party to leave message for the other
+api.add_resource(MessageStream, "/operation/message/stream")  # GET - Either party's SSE stream of new messages
+api.add_resource(MessageRead, "/operation/message/read")  # POST - Either party to mark messages read up to one
+api.add_resource(MessageUnread, "/operation/message/unread")  # GET - Unread message counts for user's relationships
 api.add_resource(SafeOps, "/operation/safe")  # GET/PATCH - KH to change parameters of Safe
+api.add_resource(SafeEvents, "/operation/events")  # GET - SH or KH to page through a safe's event history
 api.add_resource(SafeSummary, "/operation/summary")  # GET - Summary of user's relationships
 
 
@@ -0,0 +1,80 @@
+"""
+Micro-benchmark of libs.checkin_parser against the split/strptime parsing it replaced in SafeCheckin.post,
+over a corpus of realistic checkin messages (status line plus 0-N buffered events).
+
+    python -m benchmarks.checkin_parser --messages 5000 --max-events 20
+"""
+from datetime import datetime, timezone
+import argparse
+import random
+import timeit
+
+from benchmarks.sim_safe import SimulatedSafe
+from libs.checkin_parser import parse_checkin
+
+
+def legacy_convert_timestamp(tstamp_str: str) -> datetime:
+    # Copy of the convert_timestamp() previously in resources/safe.py
+    if "+" in tstamp_str or '-' in tstamp_str:
+        tstamp = datetime.strptime(tstamp_str, '%Y-%m-%d %H:%M:%S.%f%z')
+        tstamp = tstamp.replace(tzinfo=timezone.utc)
+    else:
+        tstamp = datetime.strptime(tstamp_str, '%Y-%m-%d %H:%M:%S.%f')
+    return tstamp
+
+
+def legacy_parse(message: str):
+    # The parsing previously inlined in SafeCheckin.post
+    if '\n' in message:
+        message_lines = message.split('\n')
+    else:
+        message_lines = [message, ]
+    status_parts = message_lines[0].split(',')
+    result = [legacy_convert_timestamp(status_parts[2]), status_parts[3] == 'True',
+              status_parts[4] == 'True', status_parts[5] == 'True']
+    events = []
+    for i in range(len(message_lines) - 1):
+        if message_lines[i + 1].startswith('EVENT'):
+            event_parts = message_lines[i + 1].split(',')
+            if len(event_parts) == 3:
+                events.append((legacy_convert_timestamp(event_parts[1]), event_parts[2]))
+    return result, events
+
+
+def build_corpus(n_messages: int, max_events: int) -> list:
+    """
+    Mostly heartbeats with no events, some with a few, and the occasional long replay after an offline period
+    """
+    safe = SimulatedSafe.__new__(SimulatedSafe)  # Message building needs no key pair
+    safe.hwid = 'BENCH-000000000001'
+    corpus = []
+    for _ in range(n_messages):
+        roll = random.random()
+        n_events = 0 if roll < 0.7 else random.randint(1, 3) if roll < 0.97 else max_events
+        corpus.append(safe.status_message(n_events=n_events, now=datetime.now(timezone.utc)))
+    return corpus
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--messages', type=int, default=5000, help='Messages in the corpus')
+    parser.add_argument('--max-events', type=int, default=20, help='Events in a long replay message')
+    parser.add_argument('--repeat', type=int, default=5, help='Timing repeats - the best is reported')
+    args = parser.parse_args()
+
+    corpus = build_corpus(args.messages, args.max_events)
+    # Both parsers must agree on the corpus before they are compared
+    for message in corpus:
+        old_status, old_events = legacy_parse(message)
+        new = parse_checkin(message)
+        assert old_status == [new.timestamp, new.hinge_closed, new.lid_closed, new.bolt_engaged]
+        assert old_events == [(event.timestamp, event.name) for event in new.events]
+
+    n_lines = sum(message.count('\n') + 1 for message in corpus)
+    for name, func in (('legacy', legacy_parse), ('checkin_parser', parse_checkin)):
+        best = min(timeit.repeat(lambda: [func(message) for message in corpus], number=1, repeat=args.repeat))
+        print(f"{name:15s} {best * 1e6 / len(corpus):8.2f} us/message  {best * 1e6 / n_lines:7.2f} us/line")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,73 @@
+"""
+Latency of a keyholder claiming and releasing a safeholder (POST and DELETE /operation/claim_sh) as the safe's
+relationship history grows.  For each size, the safe is given that many ended relationships before the claim.
+The bound on the query count is tested in tests/test_claim.py.
+
+    python -m benchmarks.claim_queries --db sqlite:////tmp/csafe_claim.db --sizes 0 10 100 1000
+"""
+from datetime import date, datetime, timedelta
+import argparse
+import os
+import time
+
+from benchmarks.sim_safe import generate_server_key
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--db', default='sqlite:////tmp/csafe_claim.db', help='Database URL - tables are recreated')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[0, 10, 100, 1000],
+                        help='Ended relationships on the safe per run')
+    args = parser.parse_args()
+
+    os.environ.setdefault('APPLICATION_SETTINGS',
+                          os.path.join(os.path.dirname(os.path.dirname(__file__)), 'default_config.py'))
+    os.environ['DATABASE_URL'] = args.db
+    # Emails are only queued - no sender thread, and nothing is sent
+    os.environ.update({'MAIL_DOMAIN': 'fake.example', 'MAILGUN_API_KEY': 'key-fake', 'CSAFE_MAIL_POLL_SECS': '0'})
+    if 'CSAFE_KEY' not in os.environ:
+        os.environ['CSAFE_KEY'], os.environ['CSAFE_KPWD'] = generate_server_key()
+    from flask_jwt_extended import create_access_token
+    from app import app
+    from db import db
+    from libs.identity_cache import identity_cache
+    from models.relationship import RelationshipModel
+    from models.safe import SafeModel
+    from models.user import UserModel
+
+    client = app.test_client()
+    print(f"{'history':>7s} {'claim ms':>8s} {'release ms':>10s}")
+    for size in args.sizes:
+        with app.app_context():
+            db.drop_all()
+            db.create_all()
+            now = datetime.utcnow()
+            safeholder = UserModel(username='sh', email='sh@example.com', displayname='SH', pw_salt=b'-', pw_hash=b'-')
+            keyholder = UserModel(username='kh', email='kh@example.com', displayname='KH', pw_salt=b'-', pw_hash=b'-')
+            db.session.add_all([safeholder, keyholder])
+            db.session.flush()
+            db.session.add(SafeModel(hardware_id='HW1', safeholder_id=safeholder.id, digital_key='key-1',
+                                     last_update=now, unlock_time=now))
+            db.session.add_all([RelationshipModel(keyholder_id=keyholder.id, safeholder_id=safeholder.id,
+                                                  safe_id='HW1', start_date=date.today() - timedelta(days=i + 1),
+                                                  end_date=date.today() - timedelta(days=i))
+                                for i in range(size)])
+            db.session.commit()
+            for user in (safeholder, keyholder):
+                identity_cache.invalidate(user.id)
+            headers = {'Authorization': f"Bearer {create_access_token(identity=keyholder.id, fresh=True)}"}
+
+        client.get('/operation/summary', headers=headers)  # First request runs create_tables
+        results = []
+        for method, key in (('post', 'key-1'), ('delete', 'key-1')):
+            start = time.perf_counter()
+            response = getattr(client, method)('/operation/claim_sh', headers=headers,
+                                               json={'displayname': 'SH', 'digital_key': key})
+            assert response.status_code == 200, response.json
+            results.append((time.perf_counter() - start) * 1e3)
+        claim_ms, release_ms = results
+        print(f"{size:7d} {claim_ms:8.2f} {release_ms:10.2f}")
+
+
+if __name__ == '__main__':
+    main()
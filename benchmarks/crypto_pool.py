@@ -0,0 +1,63 @@
+"""
+Compare inline and process-pooled checkin crypto throughput for N concurrent simulated safes.
+Each simulated checkin does what SafeCheckin does: decrypt + verify the safe's message, then sign + encrypt a reply.
+
+    python -m benchmarks.crypto_pool --safes 64 --checkins 5 --workers 4
+"""
+from concurrent.futures import ThreadPoolExecutor
+import argparse
+import os
+import time
+
+from benchmarks.sim_safe import SimulatedSafe, generate_server_key
+from libs.crypto import Crypto, PooledCrypto
+
+REPLY = 'Auth_to_unlock:FALSE:2020-01-01 00:00:00\nUnlock_time:2020-01-01 00:00:00\n' \
+        'Settings:SCANFREQ=300:REPORTFREQ=1:PROXIMITYUNIT=M:DISPLAYPROXIMITY=TRUE'
+
+
+def one_checkin(handler: Crypto, safe: SimulatedSafe, envelope: dict) -> None:
+    valid, _ = handler.decrypt(msg=envelope['msg'], sig=envelope['sig'], pkey=safe.public_key_pem, hwid=safe.hwid)
+    assert valid
+    handler.encrypt(msg=REPLY, safe_pkey=safe.public_key_pem, hwid=safe.hwid)
+
+
+def run(handler: Crypto, work: list, concurrency: int) -> float:
+    """
+    Run all checkins with the given number of concurrent request threads
+    :return: checkins per second
+    """
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as threads:
+        list(threads.map(lambda item: one_checkin(handler, *item), work))
+    return len(work) / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--safes', type=int, default=32, help='Number of concurrent simulated safes')
+    parser.add_argument('--checkins', type=int, default=5, help='Checkins per safe')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='Crypto pool worker processes')
+    args = parser.parse_args()
+
+    key, password = generate_server_key()
+    inline = Crypto(key=key, password=password)
+    pooled = PooledCrypto(workers=args.workers, key=key, password=password)
+    safes = [SimulatedSafe() for _ in range(args.safes)]
+    work = []
+    for safe in safes:
+        safe.set_server_key(inline.pub_key().decode('utf-8'))
+        work.extend((safe, safe.envelope(safe.status_message(n_events=2))) for _ in range(args.checkins))
+
+    # Warm up the pool so process start-up is not counted
+    run(pooled, work[:args.workers], args.workers)
+    inline_rate = run(inline, work, args.safes)
+    pooled_rate = run(pooled, work, args.safes)
+    pooled.shutdown()
+    print(f"{len(work)} checkins from {args.safes} concurrent safes")
+    print(f"inline:              {inline_rate:8.1f} checkins/s")
+    print(f"pooled ({args.workers:2d} workers): {pooled_rate:8.1f} checkins/s  ({pooled_rate / inline_rate:.2f}x)")
+
+
+if __name__ == '__main__':
+    main()
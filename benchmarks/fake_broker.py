@@ -0,0 +1,156 @@
+"""
+Local stand-in for a Redis-protocol pub/sub broker, for exercising the relationship event hub across processes
+offline.  Speaks enough RESP for libs.resp.RespClient: PUBLISH, SUBSCRIBE and PSUBSCRIBE with glob patterns,
+PING, SELECT, and GET/SET/DEL on an in-memory dict.  Subscriber connections can be dropped to simulate the
+broker restarting.
+
+    python -m benchmarks.fake_broker --port 6390
+
+then run each server worker with CSAFE_EVENTS_URL=redis://localhost:6390/0
+"""
+from fnmatch import fnmatchcase
+from socketserver import StreamRequestHandler, ThreadingTCPServer
+import argparse
+import socket
+import threading
+
+
+def encode(value) -> bytes:
+    if value is None:
+        return b'$-1\r\n'
+    if isinstance(value, int):
+        return b':%d\r\n' % value
+    if isinstance(value, list):
+        return b'*%d\r\n' % len(value) + b''.join(encode(item) for item in value)
+    value = value.encode('utf-8') if isinstance(value, str) else value
+    return b'$%d\r\n%s\r\n' % (len(value), value)
+
+
+class FakeBroker(ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, port: int = 0):
+        """
+        :param port: Port to listen on - 0 picks a free one
+        """
+        super().__init__(('127.0.0.1', port), FakeBrokerHandler)
+        self.store = {}
+        self.subscribers = {}  # handler: set of (pattern, is_glob)
+        self.published = 0
+        self.lock = threading.Lock()
+
+    @property
+    def url(self) -> str:
+        return f"redis://127.0.0.1:{self.server_address[1]}/0"
+
+    def start(self) -> "FakeBroker":
+        threading.Thread(target=self.serve_forever, name='fake-broker', daemon=True).start()
+        return self
+
+    def publish(self, channel: str, data: str) -> int:
+        with self.lock:
+            self.published += 1
+            targets = [(handler, pattern) for handler, patterns in self.subscribers.items()
+                       for pattern, is_glob in patterns
+                       if (fnmatchcase(channel, pattern) if is_glob else channel == pattern)]
+        for handler, pattern in targets:
+            if pattern == channel:
+                handler.send(encode(['message', channel, data]))
+            else:
+                handler.send(encode(['pmessage', pattern, channel, data]))
+        return len(targets)
+
+    def drop_subscribers(self) -> None:
+        """
+        Close every subscriber's connection, as a broker restart would
+        """
+        with self.lock:
+            handlers = list(self.subscribers)
+        for handler in handlers:
+            handler.connection.shutdown(socket.SHUT_RDWR)
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {"subscribers": len(self.subscribers), "published": self.published}
+
+
+class FakeBrokerHandler(StreamRequestHandler):
+    server: FakeBroker
+
+    def setup(self):
+        super().setup()
+        self.send_lock = threading.Lock()
+
+    def send(self, data: bytes) -> None:
+        with self.send_lock:
+            try:
+                self.wfile.write(data)
+            except OSError:
+                pass
+
+    def read_command(self):
+        line = self.rfile.readline()
+        if not line:
+            return None
+        args = []
+        for _ in range(int(line[1:])):
+            length = int(self.rfile.readline()[1:])
+            args.append(self.rfile.read(length + 2)[:-2].decode('utf-8'))
+        return args
+
+    def handle(self):
+        server = self.server
+        try:
+            while True:
+                args = self.read_command()
+                if args is None:
+                    return
+                command = args[0].upper()
+                if command in ('SUBSCRIBE', 'PSUBSCRIBE'):
+                    with server.lock:
+                        patterns = server.subscribers.setdefault(self, set())
+                        patterns.update((pattern, command == 'PSUBSCRIBE') for pattern in args[1:])
+                        count = len(patterns)
+                    for pattern in args[1:]:
+                        self.send(encode([command.lower(), pattern, count]))
+                elif command == 'PUBLISH':
+                    self.send(encode(server.publish(args[1], args[2])))
+                elif command == 'GET':
+                    with server.lock:
+                        self.send(encode(server.store.get(args[1])))
+                elif command == 'SET':
+                    with server.lock:
+                        server.store[args[1]] = args[2]
+                    self.send(b'+OK\r\n')
+                elif command == 'DEL':
+                    with server.lock:
+                        self.send(encode(int(server.store.pop(args[1], None) is not None)))
+                elif command == 'PING':
+                    self.send(b'+PONG\r\n')
+                elif command == 'SELECT':
+                    self.send(b'+OK\r\n')
+                else:
+                    self.send(b'-ERR unknown command\r\n')
+        except (OSError, ValueError):
+            return
+        finally:
+            with server.lock:
+                server.subscribers.pop(self, None)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--port', type=int, default=6390)
+    args = parser.parse_args()
+
+    broker = FakeBroker(port=args.port)
+    print(f"Fake broker at {broker.url} - Ctrl-C to stop")
+    try:
+        broker.serve_forever()
+    except KeyboardInterrupt:
+        print(broker.stats())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,114 @@
+"""
+Local stand-in for the Mailgun messages API, for exercising the email outbox offline.  Accepts
+POST /v3/<domain>/messages with the form fields Mailgun takes, checks batch sends carry variables for every
+recipient, and counts what it would have delivered.  Latency and failures (429 and 5xx, as Mailgun returns
+under load and in outages) can be injected.
+
+    python -m benchmarks.fake_mailgun --port 8025 --latency 0.05 --fail-rate 0.1
+
+then run the server with MAILGUN_API_BASEURL=http://localhost:8025/v3/<MAIL_DOMAIN>
+"""
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+import argparse
+import json
+import random
+import threading
+import time
+import uuid
+
+
+class FakeMailgun(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, port: int = 0, latency: float = 0.0, fail_rate: float = 0.0):
+        """
+        :param port: Port to listen on - 0 picks a free one
+        :param latency: Seconds each call takes
+        :param fail_rate: Fraction of calls answered with 429 or 500
+        """
+        super().__init__(('127.0.0.1', port), FakeMailgunHandler)
+        self.latency = latency
+        self.fail_rate = fail_rate
+        self.calls = 0
+        self.failures = 0
+        self.rejected = 0
+        self.delivered = []  # (to, subject, text) per message that would have gone out
+        self.lock = threading.Lock()
+
+    @property
+    def base_url(self) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}/v3/fake.example"
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {"calls": self.calls, "failures": self.failures, "rejected": self.rejected,
+                    "delivered": len(self.delivered)}
+
+
+class FakeMailgunHandler(BaseHTTPRequestHandler):
+    server: FakeMailgun
+
+    def log_message(self, format, *args):
+        pass
+
+    def _reply(self, status: int, body: dict) -> None:
+        payload = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def do_POST(self):
+        form = parse_qs(self.rfile.read(int(self.headers.get('Content-Length', 0))).decode())
+        server = self.server
+        time.sleep(server.latency)
+        with server.lock:
+            server.calls += 1
+        if not self.path.endswith('/messages'):
+            return self._reply(404, {"message": "Not found"})
+        if not self.headers.get('Authorization', '').startswith('Basic '):
+            return self._reply(401, {"message": "Forbidden"})
+        if random.random() < server.fail_rate:
+            with server.lock:
+                server.failures += 1
+            if random.random() < 0.5:
+                return self._reply(429, {"message": "Too many requests"})
+            return self._reply(500, {"message": "Internal server error"})
+        recipients = form.get('to', [])
+        variables = json.loads(form.get('recipient-variables', ['{}'])[0])
+        missing = [to for to in recipients if variables and to not in variables]
+        if not recipients or missing or len(recipients) > 1000:
+            with server.lock:
+                server.rejected += 1
+            return self._reply(400, {"message": f"Bad recipients: {missing or len(recipients)}"})
+        subject, text = form.get('subject', [''])[0], form.get('text', [''])[0]
+        messages = []
+        for to in recipients:
+            body = text
+            for name, value in variables.get(to, {}).items():
+                body = body.replace(f"%recipient.{name}%", str(value))
+            messages.append((to, subject, body))
+        with server.lock:
+            server.delivered.extend(messages)
+        self._reply(200, {"id": f"<{uuid.uuid4().hex}@fake.example>", "message": "Queued. Thank you."})
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--port', type=int, default=8025)
+    parser.add_argument('--latency', type=float, default=0.05, help='Seconds per call')
+    parser.add_argument('--fail-rate', type=float, default=0.0, help='Fraction of calls that fail')
+    args = parser.parse_args()
+
+    server = FakeMailgun(port=args.port, latency=args.latency, fail_rate=args.fail_rate)
+    print(f"Fake Mailgun at {server.base_url} - Ctrl-C to stop")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print(server.stats())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,175 @@
+"""
+Safe fleet load generator.  Provisions N synthetic safes, each with its own RSA key pair, through /api/register,
+then drives /api/checkin at a configurable rate and concurrency using the real checkin message format (status
+line plus EVENT lines).  Reports latency percentiles, throughput and - from the Server-Timing header - the
+server's time split between crypto, DB and serialization.
+
+In-process against a local database (the app is imported with CSAFE_SERVER_TIMING=1 and a throwaway server key):
+
+    python -m benchmarks.load_test --db sqlite:////tmp/csafe_load.db --safes 200 --rate 50 --duration 30
+    python -m benchmarks.load_test --db postgresql://csafe@localhost/csafe_load --safes 200 --concurrency 16
+
+Over HTTP against a running server (start it with CSAFE_SERVER_TIMING=1 for the breakdown):
+
+    python -m benchmarks.load_test --url http://localhost:5000 --safes 200 --rate 100 --duration 60
+"""
+from concurrent.futures import ThreadPoolExecutor
+import argparse
+import os
+import random
+import threading
+import time
+
+from benchmarks.sim_safe import SimulatedSafe, generate_server_key, RSA_MAX_PLAINTEXT
+
+PHASES = ('crypto', 'db', 'serialization')
+
+
+class InProcessClient:
+    """
+    Calls the app through Flask's test client - one client per thread
+    """
+    def __init__(self, db_url: str):
+        os.environ.setdefault('APPLICATION_SETTINGS',
+                              os.path.join(os.path.dirname(os.path.dirname(__file__)), 'default_config.py'))
+        os.environ['DATABASE_URL'] = db_url
+        os.environ['CSAFE_SERVER_TIMING'] = '1'
+        if 'CSAFE_KEY' not in os.environ:
+            os.environ['CSAFE_KEY'], os.environ['CSAFE_KPWD'] = generate_server_key()
+        from app import app
+        self.app = app
+        self._local = threading.local()
+
+    def post(self, path: str, body: dict):
+        if not hasattr(self._local, 'client'):
+            self._local.client = self.app.test_client()
+        response = self._local.client.post(path, json=body)
+        return response.status_code, response.get_json(), response.headers.get('Server-Timing')
+
+
+class HttpClient:
+    """
+    Calls a running server - one pooled requests session per thread
+    """
+    def __init__(self, url: str):
+        self.url = url.rstrip('/')
+        self._local = threading.local()
+
+    def post(self, path: str, body: dict):
+        import requests
+        if not hasattr(self._local, 'session'):
+            self._local.session = requests.Session()
+        response = self._local.session.post(self.url + path, json=body)
+        return response.status_code, response.json(), response.headers.get('Server-Timing')
+
+
+def parse_server_timing(header: str) -> dict:
+    times = {}
+    for item in (header or '').split(','):
+        name, _, duration = item.strip().partition(';dur=')
+        if duration:
+            times[name] = float(duration)
+    return times
+
+
+def percentile(sorted_values: list, pct: float) -> float:
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(pct / 100 * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def provision(client, n_safes: int, concurrency: int) -> list:
+    def register(_):
+        safe = SimulatedSafe()
+        status, body, _ = client.post('/api/register', {'hwid': safe.hwid, 'pkey': safe.public_key_pem})
+        if status != 200:
+            raise RuntimeError(f"Registration of {safe.hwid} failed: {status} {body}")
+        safe.set_server_key(body['key'])
+        return safe
+    with ThreadPoolExecutor(max_workers=concurrency) as threads:
+        return list(threads.map(register, range(n_safes)))
+
+
+def drive(client, safes: list, rate: float, concurrency: int, duration: float, max_events: int) -> dict:
+    """
+    Send checkins from randomly chosen safes for the given duration.  With a rate, sends are scheduled open-loop
+    at that many per second across the fleet; with rate 0 each thread sends back-to-back
+    """
+    results = []
+    results_lock = threading.Lock()
+    sequence = iter(range(10 ** 12))
+    sequence_lock = threading.Lock()
+    start = time.perf_counter()
+    deadline = start + duration
+
+    def worker():
+        while True:
+            with sequence_lock:
+                n = next(sequence)
+            send_at = start + n / rate if rate else time.perf_counter()
+            if send_at >= deadline:
+                return
+            delay = send_at - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            safe = random.choice(safes)
+            n_events = random.randint(1, max_events) if max_events and random.random() < 0.2 else 0
+            envelope = safe.envelope(safe.status_message(n_events=n_events, max_bytes=RSA_MAX_PLAINTEXT))
+            sent = time.perf_counter()
+            status, body, timing = client.post('/api/checkin', envelope)
+            latency = time.perf_counter() - sent
+            if status == 200:
+                safe.read_response(body)
+            with results_lock:
+                results.append((status, latency, parse_server_timing(timing)))
+
+    with ThreadPoolExecutor(max_workers=concurrency) as threads:
+        workers = [threads.submit(worker) for _ in range(concurrency)]
+    for future in workers:
+        future.result()
+    return {'results': results, 'elapsed': time.perf_counter() - start}
+
+
+def report(run: dict) -> None:
+    results = run['results']
+    ok = [r for r in results if r[0] == 200]
+    latencies = sorted(r[1] * 1000 for r in ok)
+    print(f"checkins: {len(results)}  ok: {len(ok)}  errors: {len(results) - len(ok)}  "
+          f"elapsed: {run['elapsed']:.1f}s  throughput: {len(ok) / run['elapsed']:.1f}/s")
+    print(f"latency ms  p50: {percentile(latencies, 50):.2f}  p95: {percentile(latencies, 95):.2f}  "
+          f"p99: {percentile(latencies, 99):.2f}  max: {percentile(latencies, 100):.2f}")
+    timed = [r[2] for r in ok if r[2]]
+    if timed:
+        total = sum(t.get('total', 0.0) for t in timed)
+        print(f"server time per checkin {total / len(timed):.2f} ms:", '  '.join(
+            f"{name} {sum(t.get(name, 0.0) for t in timed) / len(timed):.2f} ms "
+            f"({100 * sum(t.get(name, 0.0) for t in timed) / total:.0f}%)" for name in PHASES))
+    else:
+        print("No Server-Timing breakdown - run the server with CSAFE_SERVER_TIMING=1")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    target = parser.add_mutually_exclusive_group()
+    target.add_argument('--url', help='Base URL of a running server')
+    target.add_argument('--db', default='sqlite:////tmp/csafe_load.db',
+                        help='Database URL for an in-process server (default: %(default)s)')
+    parser.add_argument('--safes', type=int, default=50, help='Number of synthetic safes')
+    parser.add_argument('--rate', type=float, default=0, help='Target checkins/s across the fleet, 0 = unthrottled')
+    parser.add_argument('--concurrency', type=int, default=8, help='Concurrent client threads')
+    parser.add_argument('--duration', type=float, default=10, help='Seconds to drive checkins for')
+    parser.add_argument('--max-events', type=int, default=2,
+                        help='Most EVENT lines in one checkin - limited by what fits in one RSA block')
+    args = parser.parse_args()
+
+    client = HttpClient(args.url) if args.url else InProcessClient(args.db)
+    print(f"Provisioning {args.safes} safes ...")
+    safes = provision(client, args.safes, args.concurrency)
+    print(f"Driving checkins for {args.duration:.0f}s at "
+          f"{args.rate if args.rate else 'max'}/s with {args.concurrency} threads ...")
+    report(drive(client, safes, args.rate, args.concurrency, args.duration, args.max_events))
+
+
+if __name__ == '__main__':
+    main()
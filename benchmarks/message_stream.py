@@ -0,0 +1,163 @@
+"""
+Delivery of relationship messages over the SSE stream (GET /operation/message/stream), through the event hub
+and a stand-in pub/sub broker.  A keyholder holds a stream open while the safeholder posts messages, and a second
+hub on the same broker stands in for another uwsgi worker.  Reports post-to-receipt latency, and fails unless:
+  - the stream and the other worker's hub each receive every message, in order
+  - reconnecting with Last-Event-ID replays exactly the messages after it
+  - losing the broker ends open streams, so their clients resume
+  - ending the relationship sends status active false and ends the stream, and reconnecting then gets 204
+
+    python -m benchmarks.message_stream --db sqlite:////tmp/csafe_stream.db --messages 200
+"""
+from datetime import datetime
+from statistics import median
+import argparse
+import json
+import os
+import threading
+import time
+
+from benchmarks.fake_broker import FakeBroker
+from benchmarks.sim_safe import generate_server_key
+
+
+class StreamReader:
+    """
+    Reads an SSE response body on a thread of its own, noting when each event arrives
+    """
+    def __init__(self, response):
+        self.response = response
+        self.events = []  # (event type, id, data, arrival time)
+        self.ended = threading.Event()
+        threading.Thread(target=self._read, daemon=True).start()
+
+    def _read(self):
+        fields = {}
+        buffer = ''
+        try:
+            for chunk in self.response.response:
+                buffer += chunk.decode() if isinstance(chunk, bytes) else chunk
+                while '\n' in buffer:
+                    line, buffer = buffer.split('\n', 1)
+                    if line:
+                        name, _, value = line.partition(': ')
+                        fields[name] = value
+                    elif 'event' in fields:
+                        self.events.append((fields['event'], int(fields['id']) if 'id' in fields else None,
+                                            json.loads(fields['data']), time.perf_counter()))
+                        fields = {}
+                    else:
+                        fields = {}
+        finally:
+            self.ended.set()
+
+    def messages(self) -> list:
+        return [event for event in self.events if event[0] == 'message']
+
+    def wait_for(self, n_messages: int, timeout: float = 10) -> None:
+        deadline = time.perf_counter() + timeout
+        while len(self.messages()) < n_messages and not self.ended.is_set() and time.perf_counter() < deadline:
+            time.sleep(0.005)
+
+    def close(self) -> None:
+        self.response.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--db', default='sqlite:////tmp/csafe_stream.db', help='Database URL - tables are recreated')
+    parser.add_argument('--messages', type=int, default=200, help='Messages posted')
+    args = parser.parse_args()
+
+    broker = FakeBroker().start()
+    os.environ.setdefault('APPLICATION_SETTINGS',
+                          os.path.join(os.path.dirname(os.path.dirname(__file__)), 'default_config.py'))
+    os.environ['DATABASE_URL'] = args.db
+    os.environ['CSAFE_EVENTS_URL'] = broker.url
+    os.environ['CSAFE_EVENTS_RETRY_SECS'] = '0.2'
+    # Emails are only queued - no sender thread, and nothing is sent
+    os.environ.update({'MAIL_DOMAIN': 'fake.example', 'MAILGUN_API_KEY': 'key-fake', 'CSAFE_MAIL_POLL_SECS': '0'})
+    if 'CSAFE_KEY' not in os.environ:
+        os.environ['CSAFE_KEY'], os.environ['CSAFE_KPWD'] = generate_server_key()
+    from flask_jwt_extended import create_access_token
+    from app import app
+    from db import db
+    from libs.event_hub import EventHub, RespEventBackend
+    from models.relationship import relationship_events
+    from models.safe import SafeModel
+    from models.user import UserModel
+
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        now = datetime.utcnow()
+        safeholder = UserModel(username='sh', email='sh@example.com', displayname='SH', pw_salt=b'-', pw_hash=b'-')
+        keyholder = UserModel(username='kh', email='kh@example.com', displayname='KH', pw_salt=b'-', pw_hash=b'-')
+        db.session.add_all([safeholder, keyholder])
+        db.session.flush()
+        db.session.add(SafeModel(hardware_id='HW1', safeholder_id=safeholder.id, digital_key='key-1',
+                                 last_update=now, unlock_time=now))
+        db.session.commit()
+        sh_headers = {'Authorization': f"Bearer {create_access_token(identity=safeholder.id, fresh=True)}"}
+        kh_headers = {'Authorization': f"Bearer {create_access_token(identity=keyholder.id, fresh=True)}"}
+
+    client = app.test_client()
+    claim = {'displayname': 'SH', 'digital_key': 'key-1'}
+    assert client.post('/operation/claim_sh', headers=kh_headers, json=claim).status_code == 200
+    relationship_id = client.get('/operation/message/unread', headers=kh_headers).json['relationships'][0][
+        'relationship_id']
+    stream_url = f"/operation/message/stream?relationship_id={relationship_id}"
+
+    other_worker = EventHub(RespEventBackend(broker.url), queue_size=args.messages)  # Read only at the end
+    other_subscription = other_worker.subscribe(f"relationship:{relationship_id}")
+    stream = StreamReader(client.get(stream_url, headers=kh_headers, buffered=False))
+    posted = []
+    for i in range(args.messages):
+        posted.append(time.perf_counter())
+        response = client.post('/operation/message', headers=sh_headers,
+                               json={'relationship_id': relationship_id, 'message': f"message {i}"})
+        assert response.status_code == 200, response.json
+    stream.wait_for(args.messages)
+    received = stream.messages()
+    assert stream.events[0][0] == 'status' and stream.events[0][2]['active'], stream.events[:1]
+    assert [data['message'] for _, _, data, _ in received] == [f"message {i}" for i in range(args.messages)]
+    ids = [event_id for _, event_id, _, _ in received]
+    other = [other_subscription.get(timeout=1) for _ in range(args.messages)]
+    assert [event.id for event in other if event is not None] == ids, "Other worker missed events"
+    latencies = sorted((arrived - sent) * 1e3 for (_, _, _, arrived), sent in zip(received, posted))
+    print(f"{len(received)} messages streamed: latency median {median(latencies):.2f} ms, "
+          f"p99 {latencies[int(len(latencies) * 0.99) - 1]:.2f} ms, max {latencies[-1]:.2f} ms")
+
+    # Reconnect from half way
+    resume_from = ids[len(ids) // 2]
+    resumed = StreamReader(client.get(stream_url, headers=dict(kh_headers, **{'Last-Event-ID': str(resume_from)}),
+                                      buffered=False))
+    expected = ids[len(ids) // 2 + 1:][:200]
+    resumed.wait_for(len(expected))
+    assert [event_id for _, event_id, _, _ in resumed.messages()] == expected, "Replay after Last-Event-ID differs"
+    print(f"Resumed from {resume_from}: {len(expected)} messages replayed")
+
+    # Broker restart - the streams end so their clients resume
+    start = time.perf_counter()
+    broker.drop_subscribers()
+    assert stream.ended.wait(5) and resumed.ended.wait(5), "Streams not ended when the broker was lost"
+    print(f"Broker lost: streams ended in {(time.perf_counter() - start) * 1e3:.0f} ms")
+    resumed.close()
+    stream.close()
+
+    # End of the relationship
+    stream = StreamReader(client.get(stream_url, headers=dict(kh_headers, **{'Last-Event-ID': str(ids[-1])}),
+                                     buffered=False))
+    time.sleep(0.5)  # Let the listener resubscribe
+    assert client.delete('/operation/claim_sh', headers=kh_headers, json=claim).status_code == 200
+    assert stream.ended.wait(5), "Stream not ended with the relationship"
+    assert stream.events[-1][0] == 'status' and not stream.events[-1][2]['active'], stream.events[-1:]
+    stream.close()
+    response = client.get(stream_url, headers=dict(kh_headers, **{'Last-Event-ID': str(ids[-1])}))
+    assert response.status_code == 204, response.status_code
+    print("Relationship ended: status sent, stream ended, reconnect 204")
+    print(relationship_events.stats())
+
+
+if __name__ == '__main__':
+    main()
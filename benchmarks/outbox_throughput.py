@@ -0,0 +1,72 @@
+"""
+Email outbox throughput and failure handling, offline.  Queues N emails through OutboxModel.enqueue - what the
+API pays per email - then drains the outbox with the mail sender against benchmarks/fake_mailgun.py, with
+injected latency and failures, until every email is sent or has given up.  Checks each recipient got exactly
+their own email.
+
+    python -m benchmarks.outbox_throughput --db sqlite:////tmp/csafe_mail.db --messages 2000 --fail-rate 0.2
+    python -m benchmarks.outbox_throughput --messages 2000 --batch 1   # one Mailgun call per email
+"""
+from collections import Counter
+import argparse
+import os
+import threading
+import time
+
+from benchmarks.fake_mailgun import FakeMailgun
+from benchmarks.sim_safe import generate_server_key
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--db', default='sqlite:////tmp/csafe_mail.db', help='Database URL - tables are recreated')
+    parser.add_argument('--messages', type=int, default=2000)
+    parser.add_argument('--latency', type=float, default=0.1, help='Seconds per Mailgun call')
+    parser.add_argument('--fail-rate', type=float, default=0.1, help='Fraction of Mailgun calls that fail')
+    parser.add_argument('--batch', type=int, default=500, help='Recipients per batch send')
+    parser.add_argument('--concurrency', type=int, default=4, help='Mailgun calls in flight')
+    args = parser.parse_args()
+
+    fake = FakeMailgun(latency=args.latency, fail_rate=args.fail_rate)
+    threading.Thread(target=fake.serve_forever, daemon=True).start()
+    os.environ.setdefault('APPLICATION_SETTINGS',
+                          os.path.join(os.path.dirname(os.path.dirname(__file__)), 'default_config.py'))
+    os.environ['DATABASE_URL'] = args.db
+    os.environ.update({'MAIL_DOMAIN': 'fake.example', 'MAILGUN_API_KEY': 'key-fake', 'CSAFE_MAIL_POLL_SECS': '0',
+                       'MAILGUN_API_BASEURL': fake.base_url, 'CSAFE_MAIL_RETRY_BASE_SECS': '0.05',
+                       'CSAFE_MAIL_RETRY_MAX_SECS': '0.5'})
+    if 'CSAFE_KEY' not in os.environ:
+        os.environ['CSAFE_KEY'], os.environ['CSAFE_KPWD'] = generate_server_key()
+    from app import app
+    from db import db
+    from models.outbox import OutboxModel, mail_sender
+    mail_sender.batch_size = args.batch
+    mail_sender.concurrency = args.concurrency
+
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        start = time.perf_counter()
+        for i in range(args.messages):
+            OutboxModel.enqueue('confirmation', f"user{i}@example.com",
+                                {"name": f"user{i}", "link": f"https://csafe.example/confirm/{i}"})
+        enqueue_secs = time.perf_counter() - start
+
+        start = time.perf_counter()
+        while OutboxModel.query.filter_by(status='pending').count():
+            if not mail_sender.drain():
+                time.sleep(0.05)  # Waiting out retry backoff
+        send_secs = time.perf_counter() - start
+        status = Counter(row[0] for row in db.session.query(OutboxModel.status).all())
+
+    delivered = Counter(to for to, _, _ in fake.delivered)
+    wrong = [to for to, _, text in fake.delivered if f"Dear {to.split('@')[0]}," not in text]
+    print(f"enqueue: {args.messages / enqueue_secs:8.0f} emails/s ({enqueue_secs * 1e3 / args.messages:.2f} ms each)")
+    print(f"send:    {args.messages / send_secs:8.0f} emails/s over {send_secs:.1f} s")
+    print(f"outbox:  {dict(status)}   sender: {mail_sender.stats()}   mailgun: {fake.stats()}")
+    print(f"check:   {len(delivered)} recipients, {sum(1 for n in delivered.values() if n > 1)} duplicated, "
+          f"{len(wrong)} with the wrong variables")
+
+
+if __name__ == '__main__':
+    main()
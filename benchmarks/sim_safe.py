@@ -0,0 +1,76 @@
+"""
+Simulated safes for the benchmark scripts - each has its own RSA key pair and builds checkin messages
+in the same format and envelope as the real safe firmware
+"""
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives.asymmetric import rsa
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.asymmetric import padding
+from datetime import datetime, timedelta, timezone
+from typing import Tuple
+import base64
+import random
+import uuid
+
+OAEP = padding.OAEP(mgf=padding.MGF1(algorithm=hashes.SHA256()), algorithm=hashes.SHA256(), label=None)
+PSS = padding.PSS(mgf=padding.MGF1(hashes.SHA256()), salt_length=padding.PSS.MAX_LENGTH)
+RSA_MAX_PLAINTEXT = 190  # Longest message RSA-2048 OAEP/SHA-256 can carry
+EVENT_NAMES = ["STARTING_OPERATION", "SAFE_LOCKED", "SAFE_OPEN", "BUTTON_PRESS", "LOW_BATTERY"]
+
+
+def generate_server_key(password: str = 'benchmark') -> Tuple[str, str]:
+    """
+    Generate a throwaway server key in the form Crypto() expects
+    :return: PEM private key with escaped newlines, passphrase
+    """
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048, backend=default_backend())
+    pem = key.private_bytes(encoding=serialization.Encoding.PEM,
+                            format=serialization.PrivateFormat.PKCS8,
+                            encryption_algorithm=serialization.BestAvailableEncryption(password.encode('utf-8')))
+    return pem.decode('utf-8').strip().replace('\n', '\\n'), password
+
+
+class SimulatedSafe:
+    def __init__(self, hwid: str = None):
+        self.hwid = hwid or f"BENCH-{uuid.uuid4().hex[:12]}"
+        self.private_key = rsa.generate_private_key(public_exponent=65537, key_size=2048, backend=default_backend())
+        self.public_key_pem = self.private_key.public_key().public_bytes(
+            encoding=serialization.Encoding.PEM,
+            format=serialization.PublicFormat.SubjectPublicKeyInfo).decode('utf-8')
+        self.server_key = None
+
+    def set_server_key(self, server_key_pem: str) -> None:
+        self.server_key = serialization.load_pem_public_key(server_key_pem.encode('utf-8'),
+                                                            backend=default_backend())
+
+    def status_message(self, n_events: int = 0, now: datetime = None, max_bytes: int = None) -> str:
+        """
+        Build a plaintext checkin - status line followed by up to n_events EVENT lines
+        :param max_bytes: Leave out events that would take the message over this length
+        """
+        now = now or datetime.now(timezone.utc)
+        message = f"STATUS,{self.hwid},{now},{random.choice(['True', 'False'])},True,True"
+        for i in range(n_events):
+            line = f"\nEVENT,{now - timedelta(seconds=n_events - i)},{random.choice(EVENT_NAMES)}"
+            if max_bytes is not None and len(message) + len(line) > max_bytes:
+                break
+            message += line
+        return message
+
+    def envelope(self, message: str) -> dict:
+        """
+        Encrypt and sign a message for the server - returns the /api/checkin request body
+        """
+        plaintext = message.encode('utf-8')
+        ciphertext = self.server_key.encrypt(plaintext, OAEP)
+        signature = self.private_key.sign(plaintext, PSS, hashes.SHA256())
+        return {"hwid": self.hwid,
+                "msg": base64.urlsafe_b64encode(ciphertext).decode('utf-8'),
+                "sig": base64.urlsafe_b64encode(signature).decode('utf-8')}
+
+    def read_response(self, body: dict) -> str:
+        """
+        Decrypt the server's response to a checkin
+        """
+        return self.private_key.decrypt(base64.urlsafe_b64decode(body['msg']), OAEP).decode('utf-8')
@@ -0,0 +1,74 @@
+"""
+Latency of GET /operation/summary as a user's relationships grow.  For each size, a keyholder gets that many
+relationships (each with its own safe and safeholder) plus safes of their own, then the summary is fetched fresh
+and with its ETag.  The fixed query count and the 304 round trip are tested in tests/test_summary.py.
+
+    python -m benchmarks.summary_queries --db sqlite:////tmp/csafe_summary.db --sizes 0 1 10 100 500
+"""
+from datetime import date, datetime
+import argparse
+import os
+import time
+
+from benchmarks.sim_safe import generate_server_key
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--db', default='sqlite:////tmp/csafe_summary.db', help='Database URL - tables are recreated')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[0, 1, 10, 100, 500], help='Relationships per run')
+    parser.add_argument('--repeat', type=int, default=20, help='Fetches timed per run')
+    args = parser.parse_args()
+
+    os.environ.setdefault('APPLICATION_SETTINGS',
+                          os.path.join(os.path.dirname(os.path.dirname(__file__)), 'default_config.py'))
+    os.environ['DATABASE_URL'] = args.db
+    if 'CSAFE_KEY' not in os.environ:
+        os.environ['CSAFE_KEY'], os.environ['CSAFE_KPWD'] = generate_server_key()
+    from flask_jwt_extended import create_access_token
+    from app import app
+    from db import db
+    from models.relationship import RelationshipModel
+    from models.safe import SafeModel
+    from models.user import UserModel
+
+    client = app.test_client()
+    print(f"{'relationships':>13s} {'rows':>5s} {'200 ms':>7s} {'304 ms':>7s}")
+    for size in args.sizes:
+        with app.app_context():
+            db.drop_all()
+            db.create_all()
+            now = datetime.utcnow()
+            users = [UserModel(username=f"u{i}", email=f"u{i}@example.com", displayname=f"User {i}",
+                               pw_salt=b'-', pw_hash=b'-') for i in range(size + 1)]
+            db.session.add_all(users)
+            db.session.flush()
+            keyholder = users[0]
+            for i, safeholder in enumerate(users[1:]):
+                db.session.add(SafeModel(hardware_id=f"HW{i}", safeholder_id=safeholder.id, last_update=now,
+                                         unlock_time=now))
+                db.session.add(RelationshipModel(keyholder_id=keyholder.id, safeholder_id=safeholder.id,
+                                                 safe_id=f"HW{i}", start_date=date.today()))
+            for i in range(2):
+                db.session.add(SafeModel(hardware_id=f"OWN{i}", safeholder_id=keyholder.id, last_update=now,
+                                         unlock_time=now))
+            db.session.commit()
+            headers = {'Authorization': f"Bearer {create_access_token(identity=keyholder.id, fresh=True)}"}
+
+        response = client.get('/operation/summary', headers=headers)  # First request runs create_tables
+        assert response.status_code == 200 and len(response.json['safe_list']) == size + 2
+        etag = response.headers['ETag']
+        start = time.perf_counter()
+        for _ in range(args.repeat):
+            client.get('/operation/summary', headers=headers)
+        fresh_ms = (time.perf_counter() - start) * 1e3 / args.repeat
+        conditional = dict(headers, **{'If-None-Match': etag})
+        start = time.perf_counter()
+        for _ in range(args.repeat):
+            client.get('/operation/summary', headers=conditional)
+        not_modified_ms = (time.perf_counter() - start) * 1e3 / args.repeat
+        print(f"{size:13d} {size + 2:5d} {fresh_ms:7.2f} {not_modified_ms:7.2f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,79 @@
+"""
+Size and CPU comparison of the JSON checkin envelope against the binary envelope in libs.wire, for RSA and
+session-key checkins and the server's responses.  Every body is round-tripped through both formats first, so
+the script doubles as a check that the binary format carries exactly what the JSON does.
+
+    python -m benchmarks.wire_format --messages 2000
+"""
+from datetime import datetime, timezone
+import argparse
+import json
+import timeit
+
+from benchmarks.sim_safe import SimulatedSafe, generate_server_key, RSA_MAX_PLAINTEXT
+from libs import wire
+from libs.crypto import Crypto, SessionCrypto
+
+
+def build_bodies(n_messages: int) -> dict:
+    """
+    Real envelopes for each message kind - one simulated safe, its messages and the server's replies
+    """
+    key, password = generate_server_key()
+    server = Crypto(key=key, password=password)
+    safe = SimulatedSafe()
+    safe.set_server_key(server.pub_key().decode('utf-8'))
+    session_key = SessionCrypto.new_key()
+    bodies = {'register': [{"hwid": safe.hwid, "pkey": safe.public_key_pem}],
+              'rsa checkin': [], 'session checkin': [], 'rsa response': [], 'session response': []}
+    for i in range(n_messages):
+        message = safe.status_message(n_events=i % 3, now=datetime.now(timezone.utc), max_bytes=RSA_MAX_PLAINTEXT)
+        bodies['rsa checkin'].append(safe.envelope(message))
+        nonce, ct = SessionCrypto.encrypt(session_key, safe.hwid, message)
+        bodies['session checkin'].append({"hwid": safe.hwid, "nonce": nonce, "ct": ct})
+    response = f"Unchanged:1\nTimestamp:{datetime.now(timezone.utc)}\nNext_checkin:300"
+    for _ in range(min(n_messages, 50)):  # RSA signing is slow - reuse a few responses
+        msg_enc_64, msg_sig_64 = server.encrypt(response, safe.public_key_pem)
+        bodies['rsa response'].append({"msg": msg_enc_64.decode('utf-8'), "sig": msg_sig_64.decode('utf-8')})
+    for _ in range(n_messages):
+        nonce, ct = SessionCrypto.encrypt(session_key, safe.hwid, response)
+        bodies['session response'].append({"nonce": nonce, "ct": ct})
+    return bodies
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--messages', type=int, default=2000, help='Messages of each kind')
+    parser.add_argument('--repeat', type=int, default=5, help='Timing repeats - the best is reported')
+    args = parser.parse_args()
+
+    bodies = build_bodies(args.messages)
+    print(f"{'kind':17s} {'json B':>7s} {'binary B':>8s} {'saving':>7s}   "
+          f"{'json enc+dec us':>15s} {'binary enc+dec us':>17s} {'raw pack+unpack us':>18s}")
+    for kind, items in bodies.items():
+        request = 'response' not in kind
+        encode = wire.encode_request if request else wire.encode_response
+        decode = wire.decode_request if request else wire.decode_response
+        # Round trip - both formats must carry the same body
+        for body in items:
+            assert decode(encode(body)) == body
+            assert json.loads(json.dumps(body)) == body
+        json_size = sum(len(json.dumps(body)) for body in items) / len(items)
+        binary_size = sum(len(encode(body)) for body in items) / len(items)
+        json_time = min(timeit.repeat(lambda: [json.loads(json.dumps(body)) for body in items],
+                                      number=1, repeat=args.repeat))
+        binary_time = min(timeit.repeat(lambda: [decode(encode(body)) for body in items],
+                                        number=1, repeat=args.repeat))
+        # The framing alone - what a safe holding raw ciphertext and signature bytes pays
+        kind_code = wire.unpack(encode(items[0]))[0]
+        raw = [wire.unpack(encode(body))[1] for body in items]
+        raw_time = min(timeit.repeat(lambda: [wire.unpack(wire.pack(kind_code, values)) for values in raw],
+                                     number=1, repeat=args.repeat))
+        print(f"{kind:17s} {json_size:7.0f} {binary_size:8.0f} {1 - binary_size / json_size:7.0%}   "
+              f"{json_time * 1e6 / len(items):15.2f} {binary_time * 1e6 / len(items):17.2f} "
+              f"{raw_time * 1e6 / len(items):18.2f}")
+    print("binary enc+dec includes converting to and from the base64 JSON form the resources work with")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,109 @@
+"""
+Checkin admission control.  Safes report every scan_freq * report_freq seconds, so after a power cut or a deploy
+they all come back at once and stay in step.  AdmissionMeter measures the recent checkin rate and the number of
+checkins in progress, and next_checkin() tells each safe when to report next: the configured interval while
+the server keeps up, stretched in proportion to the overload when it does not, and spread by a per-safe jitter
+so safes that arrived together leave at different times
+"""
+from contextlib import contextmanager
+from functools import wraps
+from math import ceil
+from time import monotonic
+import os
+import threading
+import zlib
+
+TARGET_CHECKIN_RATE = float(os.environ.get('CSAFE_CHECKIN_TARGET_RATE', 50))  # Checkins/sec per process
+TARGET_IN_FLIGHT = int(os.environ.get('CSAFE_CHECKIN_TARGET_IN_FLIGHT', 8))  # Concurrent checkins per process
+CHECKIN_JITTER = float(os.environ.get('CSAFE_CHECKIN_JITTER', 0.1))  # +/- fraction of the delay
+CHECKIN_MAX_STRETCH = float(os.environ.get('CSAFE_CHECKIN_MAX_STRETCH', 4))  # Upper bound if not set on the safe
+RATE_WINDOW_SECS = 10
+LOAD_STEP = 0.25  # Load is rounded up to a step, so delays change in steps rather than with every small swing
+
+
+class AdmissionMeter:
+    """
+    Sliding-window checkin rate, in one-second buckets, plus a count of checkins in progress
+    """
+    def __init__(self, target_rate: float = TARGET_CHECKIN_RATE, target_in_flight: int = TARGET_IN_FLIGHT,
+                 window_secs: int = RATE_WINDOW_SECS):
+        self.target_rate = target_rate
+        self.target_in_flight = target_in_flight
+        self.window_secs = window_secs
+        self.in_flight = 0
+        self._buckets = [0] * window_secs
+        self._bucket_secs = [0] * window_secs
+        self._lock = threading.Lock()
+
+    def record(self, count: int = 1, now: float = None) -> None:
+        """
+        Count checkins arriving
+        :param count: Number of safes - more than 1 for a batch checkin
+        """
+        second = int(monotonic() if now is None else now)
+        index = second % self.window_secs
+        with self._lock:
+            if self._bucket_secs[index] != second:
+                self._bucket_secs[index] = second
+                self._buckets[index] = 0
+            self._buckets[index] += count
+
+    @contextmanager
+    def in_progress(self):
+        """
+        Count a checkin request as in progress for the duration of the block
+        """
+        with self._lock:
+            self.in_flight += 1
+        try:
+            yield
+        finally:
+            with self._lock:
+                self.in_flight -= 1
+
+    def tracked(self, func):
+        """
+        Decorator form of in_progress()
+        """
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with self.in_progress():
+                return func(*args, **kwargs)
+        return wrapper
+
+    def rate(self, now: float = None) -> float:
+        """
+        Checkins per second over the last window_secs complete seconds
+        """
+        second = int(monotonic() if now is None else now)
+        with self._lock:
+            total = sum(count for count, bucket_sec in zip(self._buckets, self._bucket_secs)
+                        if second - self.window_secs <= bucket_sec < second)
+        return total / self.window_secs
+
+    def load(self, now: float = None) -> float:
+        """
+        Checkin load relative to target - above 1.0 the server is behind
+        """
+        return max(self.rate(now) / self.target_rate, self.in_flight / self.target_in_flight)
+
+    def next_checkin(self, hwid: str, scan_freq: int, report_freq: int, max_delay: int = None) -> int:
+        """
+        Seconds until the safe should next check in
+        :param hwid: Safe hardware_id - fixes its jitter, so safes spread apart stay apart rather than being
+                     shuffled again at every checkin
+        :param scan_freq: Seconds between scans
+        :param report_freq: Scans per report - the configured interval is scan_freq * report_freq.  The delay is
+                            never shorter than the interval less the jitter
+        :param max_delay: Longest delay the keyholder allows, or None for CHECKIN_MAX_STRETCH times the interval
+        """
+        interval = max(1, scan_freq * report_freq)
+        stretch = max(1.0, ceil(self.load() / LOAD_STEP) * LOAD_STEP)
+        jitter = (zlib.crc32(hwid.encode('utf-8')) % 2001 - 1000) / 1000 * CHECKIN_JITTER
+        delay = interval * stretch * (1 + jitter)
+        upper = max(interval, max_delay if max_delay else interval * CHECKIN_MAX_STRETCH)
+        return int(min(max(delay, 1), upper))
+
+    def stats(self) -> dict:
+        return {"checkin_rate": self.rate(), "in_flight": self.in_flight, "load": self.load(),
+                "target_rate": self.target_rate, "target_in_flight": self.target_in_flight}
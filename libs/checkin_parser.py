@@ -0,0 +1,121 @@
+"""
+Parser for the plaintext checkin message sent by a safe.
+
+A message is a status line optionally followed by event lines:
+
+    STATUS,<hwid>,<timestamp>,<hinge_closed>,<lid_closed>,<bolt_engaged>
+    EVENT,<timestamp>,<event name>
+    ...
+
+or a single "nothing changed" line:
+
+    UNCHANGED,<hwid>,<timestamp>,<settings_version>
+
+Timestamps are str(datetime) - YYYY-MM-DD HH:MM:SS[.ffffff][+HH:MM] - and flags are the literals True/False
+"""
+from datetime import datetime, timezone
+from typing import List, NamedTuple, Union
+
+STATUS_FIELDS = 6
+UNCHANGED_FIELDS = 4
+EVENT_FIELDS = 3
+# Lengths of str(datetime) without/with microseconds, each with and without a UTC offset
+TIMESTAMP_LENGTHS = (19, 26, 25, 32)
+
+
+class CheckinParseError(ValueError):
+    def __init__(self, line_no: int, reason: str):
+        super().__init__(f"line {line_no}: {reason}")
+        self.line_no = line_no
+        self.reason = reason
+
+
+class CheckinEvent(NamedTuple):
+    timestamp: datetime
+    name: str
+
+
+class CheckinMessage(NamedTuple):
+    unchanged: bool  # True for an UNCHANGED heartbeat, which carries no flags or events
+    hwid: str
+    timestamp: datetime
+    hinge_closed: bool
+    lid_closed: bool
+    bolt_engaged: bool
+    settings_version: Union[int, None]
+    events: List[CheckinEvent]
+    errors: List[CheckinParseError]  # Malformed event lines - skipped rather than failing the checkin
+
+
+def parse_timestamp(value: str, line_no: int = 1) -> datetime:
+    """
+    Decode a str(datetime) timestamp into a timezone-aware UTC datetime.  The layout is fixed, so it is handed
+    straight to datetime.fromisoformat rather than guessing a strptime format.  Naive timestamps are taken as UTC
+    """
+    if len(value) not in TIMESTAMP_LENGTHS or value[4] != '-' or value[10] != ' ':
+        raise CheckinParseError(line_no, f"malformed timestamp '{value}'")
+    try:
+        tstamp = datetime.fromisoformat(value)
+    except ValueError:
+        raise CheckinParseError(line_no, f"malformed timestamp '{value}'")
+    if tstamp.tzinfo is None:
+        return tstamp.replace(tzinfo=timezone.utc)
+    return tstamp.astimezone(timezone.utc)
+
+
+def to_naive_utc(tstamp: Union[datetime, None]) -> Union[datetime, None]:
+    """
+    Timestamps are stored as naive UTC - convert a timezone-aware datetime to match.  Naive datetimes and None
+    are returned unchanged
+    """
+    if tstamp is None or tstamp.tzinfo is None:
+        return tstamp
+    return tstamp.astimezone(timezone.utc).replace(tzinfo=None)
+
+
+def parse_flag(value: str, name: str, line_no: int = 1) -> bool:
+    if value == 'True':
+        return True
+    if value == 'False':
+        return False
+    raise CheckinParseError(line_no, f"{name} must be True or False, not '{value}'")
+
+
+def parse_checkin(message: str) -> CheckinMessage:
+    """
+    Parse a decrypted checkin message
+    :param message: The plaintext message
+    :return: the parsed checkin
+    :raises CheckinParseError: if the status line is malformed
+    """
+    lines = message.split('\n')
+    status = lines[0].split(',')
+    if status[0] == 'UNCHANGED':
+        if len(status) != UNCHANGED_FIELDS:
+            raise CheckinParseError(1, f"expected {UNCHANGED_FIELDS} fields, got {len(status)}")
+        if not (status[3].isascii() and status[3].isdecimal()):
+            raise CheckinParseError(1, f"malformed settings version '{status[3]}'")
+        return CheckinMessage(True, status[1], parse_timestamp(status[2]), False, False, False,
+                              int(status[3]), [], [])
+    if len(status) != STATUS_FIELDS:
+        raise CheckinParseError(1, f"expected {STATUS_FIELDS} fields, got {len(status)}")
+    events = []
+    errors = []
+    for line_no in range(2, len(lines) + 1):
+        line = lines[line_no - 1]
+        if not line:
+            continue
+        parts = line.split(',')
+        try:
+            if parts[0] != 'EVENT':
+                raise CheckinParseError(line_no, f"unknown line type '{parts[0]}'")
+            if len(parts) != EVENT_FIELDS:
+                raise CheckinParseError(line_no, f"expected {EVENT_FIELDS} fields, got {len(parts)}")
+            events.append(CheckinEvent(parse_timestamp(parts[1], line_no), parts[2]))
+        except CheckinParseError as e:
+            errors.append(e)
+    return CheckinMessage(False, status[1], parse_timestamp(status[2]),
+                          parse_flag(status[3], 'hinge_closed'),
+                          parse_flag(status[4], 'lid_closed'),
+                          parse_flag(status[5], 'bolt_engaged'),
+                          None, events, errors)
@@ -0,0 +1,49 @@
+"""
+Removal of confirmation rows that were never used.  Each registration and each resend adds a confirmation that
+expires after 30 minutes; unconfirmed ones are kept for CSAFE_CONFIRMATION_GRACE_HOURS after expiry, so a late
+click still gets the "expired" page, then deleted in batches of CSAFE_CONFIRMATION_PURGE_BATCH rows.
+
+Run periodically with:
+
+    flask purge-confirmations
+"""
+from time import time
+import logging
+import os
+
+import click
+from flask import Flask
+
+from models.confirmation import ConfirmationModel
+
+CONFIRMATION_GRACE_HOURS = float(os.environ.get('CSAFE_CONFIRMATION_GRACE_HOURS', 24))
+CONFIRMATION_PURGE_BATCH = int(os.environ.get('CSAFE_CONFIRMATION_PURGE_BATCH', 1000))
+
+
+def purge_confirmations(now: float, grace_hours: float = CONFIRMATION_GRACE_HOURS,
+                        batch_size: int = CONFIRMATION_PURGE_BATCH) -> int:
+    """
+    Delete unconfirmed confirmations that expired more than grace_hours before now
+    :param now: Epoch seconds
+    :return: number of rows deleted
+    """
+    expired_before = int(now - grace_hours * 3600)
+    total = 0
+    while True:
+        deleted = ConfirmationModel.purge_expired_batch(expired_before, batch_size)
+        total += deleted
+        if deleted == 0:
+            break
+    logging.info(f"CONFIRMATION: Purged {total} expired confirmations")
+    return total
+
+
+def init_app(app: Flask) -> None:
+    @app.cli.command('purge-confirmations')
+    @click.option('--grace-hours', default=CONFIRMATION_GRACE_HOURS, show_default=True,
+                  help='Hours after expiry that an unconfirmed confirmation is kept')
+    @click.option('--batch', default=CONFIRMATION_PURGE_BATCH, show_default=True, help='Rows deleted per transaction')
+    def purge_confirmations_command(grace_hours: float, batch: int):
+        """Delete expired, unconfirmed confirmations"""
+        deleted = purge_confirmations(time(), grace_hours=grace_hours, batch_size=batch)
+        click.echo(f"{deleted} expired confirmations purged")
@@ -1,32 +1,94 @@
-from cryptography.exceptions import InvalidSignature
+from cryptography.exceptions import InvalidSignature, InvalidTag
 from cryptography.hazmat.backends import default_backend
 from cryptography.hazmat.primitives.asymmetric import rsa
 from cryptography.hazmat.primitives import serialization
 from cryptography.hazmat.primitives import hashes
 from cryptography.hazmat.primitives.asymmetric import padding
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
 import os
 import subprocess
 import datetime
 import base64
-from typing import Tuple
+import hashlib
+from concurrent.futures import ProcessPoolExecutor
+from typing import Tuple, Union
+
+from libs.forksafe import PerProcess
+from libs.lru import LRUCache
+
+KEY_CACHE_SIZE = int(os.environ.get('CSAFE_KEY_CACHE_SIZE', 4096))
+CRYPTO_WORKERS = int(os.environ.get('CSAFE_CRYPTO_WORKERS', 0))  # 0 = RSA work runs in the request thread
+SESSION_KEY_LIFETIME = int(os.environ.get('CSAFE_SESSION_LIFETIME', 86400))  # Seconds a safe session key is valid
+# Seconds a session handshake's timestamp may differ from the server clock
+SESSION_MAX_SKEW = int(os.environ.get('CSAFE_SESSION_MAX_SKEW', 300))
+
+
+class PublicKeyCache:
+    """
+    Bounded LRU cache of parsed safe public keys, keyed by hardware_id.
+    Each entry remembers a fingerprint of the PEM it was parsed from, so a safe whose stored key
+    has changed (e.g. re-registered by another worker) is re-parsed rather than served stale
+    """
+    def __init__(self, max_size: int = KEY_CACHE_SIZE):
+        self._cache = LRUCache(max_size=max_size)
+
+    @staticmethod
+    def fingerprint(pkey: str) -> bytes:
+        return hashlib.sha256(pkey.encode('utf-8')).digest()
+
+    def get(self, hwid: str, pkey: str) -> rsa.RSAPublicKey:
+        """
+        Return the parsed public key for this safe, parsing and caching it on a miss
+        :param hwid: Safe hardware_id
+        :param pkey: PEM public key as stored on the SafeModel
+        :return: public key object
+        """
+        fprint = self.fingerprint(pkey)
+        entry = self._cache.get(hwid, validate=lambda cached: cached[0] == fprint)
+        if entry is not None:
+            return entry[1]
+        public_key = serialization.load_pem_public_key(bytes(pkey, 'utf-8'), backend=default_backend())
+        self._cache.put(hwid, (fprint, public_key))
+        return public_key
+
+    def invalidate(self, hwid: str) -> None:
+        """
+        Drop any cached key for this safe - call when a safe is registered or deleted
+        :param hwid: Safe hardware_id
+        """
+        self._cache.pop(hwid)
+
+    def clear(self) -> None:
+        self._cache.clear()
+
+    def stats(self) -> dict:
+        return self._cache.stats()
+
+
+public_key_cache = PublicKeyCache()
 
 
 class Crypto:
-    def __init__(self):
+    def __init__(self, key: Union[str, None] = None, password: Union[str, None] = None):
         """
-        Initialise the class - load the private key from file
+        Initialise the class - load the private key from the arguments or, if not given, from the environment
+        :param key: PEM private key - newlines may be escaped as '\\n', as in CSAFE_KEY
+        :param password: Passphrase for the private key
         """
         print('Initialising Crypto object')
         # Load server keys
-        if 'CSAFE_KEY' in os.environ and 'CSAFE_KPWD' in os.environ:
-            key = '\n'.join(os.environ['CSAFE_KEY'].split('\\n')) + '\n'
-            pw = os.environ['CSAFE_KPWD']
+        if key is None and 'CSAFE_KEY' in os.environ and 'CSAFE_KPWD' in os.environ:
+            key = os.environ['CSAFE_KEY']
+            password = os.environ['CSAFE_KPWD']
+        if key is not None:
+            self._key_args = (key, password)
+            key = '\n'.join(key.split('\\n')) + '\n'
             self.private_key = serialization.load_pem_private_key(
                         data=(key).encode('utf-8'),
-                        password=pw.encode('utf-8'),
+                        password=password.encode('utf-8'),
                         backend=default_backend()
                     )
-            print("Server's secure key obtained from environment")
+            print("Server's secure key obtained")
         else:
             print("Server secure key not in environment variables")
 
@@ -51,17 +113,29 @@ class Crypto:
         """
         return self.public_key_pem
 
-    def decrypt(self, msg: str, sig: str, pkey: str) -> Tuple[bool, str]:
+    @staticmethod
+    def load_safe_key(pkey: str, hwid: Union[str, None] = None) -> rsa.RSAPublicKey:
+        """
+        Convert a safe's PEM public key into a usable key object - via the key cache if hwid is known
+        :param pkey: PEM public key
+        :param hwid: Safe hardware_id, or None to bypass the cache
+        :return: public key object
+        """
+        if hwid is None:
+            return serialization.load_pem_public_key(bytes(pkey, 'utf-8'), backend=default_backend())
+        return public_key_cache.get(hwid, pkey)
+
+    def decrypt(self, msg: str, sig: str, pkey: str, hwid: Union[str, None] = None) -> Tuple[bool, str]:
         """
         Build safe public key from str supplied
         :param msg:
         :param sig:
         :param pkey:
+        :param hwid: Safe hardware_id - used to look up the parsed public key in the key cache
         :return:  encrypted message, message signature
         """
         #
-        safe_public_key = serialization.load_pem_public_key(bytes(pkey, 'utf-8'),
-                                                            backend=default_backend())
+        safe_public_key = self.load_safe_key(pkey, hwid)
         # Decrypt
         try:
             plaintext = self.private_key.decrypt(
@@ -98,11 +172,12 @@ class Crypto:
         else:
             return signature_valid, ''
 
-    def encrypt(self, msg: str, safe_pkey: str) -> Tuple[str, str]:
+    def encrypt(self, msg: str, safe_pkey: str, hwid: Union[str, None] = None) -> Tuple[str, str]:
         """
         Encrypt and sign server message to safe
         :param msg:
         :param safe_pkey:
+        :param hwid: Safe hardware_id - used to look up the parsed public key in the key cache
         :return:
         """
         # Sign message
@@ -116,8 +191,7 @@ class Crypto:
             hashes.SHA256())
         server_message_sig_64 = base64.urlsafe_b64encode(server_message_sig)
         # Convert safe_pkey into form that can be used
-        safe_public_key = serialization.load_pem_public_key(bytes(safe_pkey, 'utf-8'),
-                                                            backend=default_backend())
+        safe_public_key = self.load_safe_key(safe_pkey, hwid)
 
         # Encrypt message
         server_message_enc = safe_public_key.encrypt(
@@ -130,3 +204,107 @@ class Crypto:
         server_message_enc_64 = base64.urlsafe_b64encode(server_message_enc)
 
         return server_message_enc_64, server_message_sig_64
+
+
+class SessionCrypto:
+    """
+    AES-256-GCM encryption for safes that have negotiated a session key through an RSA-authenticated handshake.
+    The safe's hardware_id and the message direction are bound in as associated data, so a message cannot be
+    replayed against another safe or reflected back to its sender
+    """
+    NONCE_BYTES = 12
+    TO_SERVER = b'SAFE>SERVER:'
+    TO_SAFE = b'SERVER>SAFE:'
+
+    @staticmethod
+    def new_key() -> bytes:
+        return AESGCM.generate_key(bit_length=256)
+
+    @classmethod
+    def decrypt(cls, key: bytes, hwid: str, nonce: str, ct: str) -> Tuple[bool, str]:
+        """
+        Decrypt and authenticate a message from a safe
+        :param key: Session key
+        :param hwid: Safe hardware_id
+        :param nonce: urlsafe base64 nonce
+        :param ct: urlsafe base64 ciphertext and tag
+        :return: validity, decrypted message
+        """
+        try:
+            plaintext = AESGCM(key).decrypt(base64.urlsafe_b64decode(nonce),
+                                            base64.urlsafe_b64decode(ct),
+                                            cls.TO_SERVER + hwid.encode('utf-8'))
+        except (InvalidTag, ValueError):
+            return False, ''
+        return True, plaintext.decode('utf-8')
+
+    @classmethod
+    def encrypt(cls, key: bytes, hwid: str, msg: str) -> Tuple[str, str]:
+        """
+        Encrypt a message to a safe
+        :param key: Session key
+        :param hwid: Safe hardware_id
+        :param msg: Message
+        :return: urlsafe base64 nonce, urlsafe base64 ciphertext and tag
+        """
+        nonce = os.urandom(cls.NONCE_BYTES)
+        ct = AESGCM(key).encrypt(nonce, msg.encode('utf-8'), cls.TO_SAFE + hwid.encode('utf-8'))
+        return base64.urlsafe_b64encode(nonce).decode('utf-8'), base64.urlsafe_b64encode(ct).decode('utf-8')
+
+
+# Server key object for a crypto pool worker process - loaded once by _init_worker
+_worker_crypto = None
+
+
+def _init_worker(key: str, password: str) -> None:
+    global _worker_crypto
+    _worker_crypto = Crypto(key=key, password=password)
+
+
+def _worker_decrypt(msg: str, sig: str, pkey: str, hwid: Union[str, None]) -> Tuple[bool, str]:
+    return _worker_crypto.decrypt(msg=msg, sig=sig, pkey=pkey, hwid=hwid)
+
+
+def _worker_encrypt(msg: str, safe_pkey: str, hwid: Union[str, None]) -> Tuple[str, str]:
+    return _worker_crypto.encrypt(msg=msg, safe_pkey=safe_pkey, hwid=hwid)
+
+
+class PooledCrypto(Crypto):
+    """
+    Crypto handler that runs the RSA decrypt/verify and sign/encrypt work on a pool of processes, each of which
+    loads the server key once, so checkin crypto can use every core rather than the GIL-bound request thread.
+    The pool is started lazily, and restarted if the process has forked since (e.g. uwsgi workers)
+    """
+    def __init__(self, workers: int, key: Union[str, None] = None, password: Union[str, None] = None):
+        super().__init__(key=key, password=password)
+        self.workers = workers
+        self._pool = PerProcess(lambda: ProcessPoolExecutor(max_workers=self.workers,
+                                                            initializer=_init_worker,
+                                                            initargs=self._key_args))
+
+    def _executor(self) -> ProcessPoolExecutor:
+        return self._pool.get()
+
+    def decrypt(self, msg: str, sig: str, pkey: str, hwid: Union[str, None] = None) -> Tuple[bool, str]:
+        return self._executor().submit(_worker_decrypt, msg, sig, pkey, hwid).result()
+
+    def encrypt(self, msg: str, safe_pkey: str, hwid: Union[str, None] = None) -> Tuple[str, str]:
+        return self._executor().submit(_worker_encrypt, msg, safe_pkey, hwid).result()
+
+    def shutdown(self) -> None:
+        pool = self._pool.reset()
+        if pool is not None:
+            pool.shutdown()
+
+
+def make_crypto_handler(workers: int = CRYPTO_WORKERS, key: Union[str, None] = None,
+                        password: Union[str, None] = None) -> Crypto:
+    """
+    Return the crypto handler to use - pooled if a worker count is configured (CSAFE_CRYPTO_WORKERS), else inline
+    :param workers: Number of crypto worker processes, 0 for inline
+    :param key: PEM private key, or None to load from the environment
+    :param password: Passphrase for the private key
+    """
+    if workers > 0:
+        return PooledCrypto(workers=workers, key=key, password=password)
+    return Crypto(key=key, password=password)
@@ -0,0 +1,231 @@
+"""
+Fan-out of relationship events - new messages and relationship status changes - to the Server-Sent Events
+streams open on them.  Each stream subscribes to its relationship's channel on the hub in its own process, and
+events are published to the hub once they are committed.
+
+The hub hands events to a backend.  LocalEventBackend delivers them straight back to this process's streams, so
+with several uwsgi workers a stream only sees events published by its own worker.  RespEventBackend publishes
+them through a Redis-protocol server (CSAFE_EVENTS_URL=redis://host:port/db).  Each process holds one pattern
+subscription there and fans each event out to its own streams, so every worker's streams see every event.
+
+Delivery is best effort.  A stream that falls too far behind, or whose process loses the broker, is closed, and
+the client resumes from its Last-Event-ID out of the database
+"""
+from abc import ABC, abstractmethod
+from typing import Callable, Dict, NamedTuple, Set, Union
+import json
+import logging
+import os
+import queue
+import threading
+import time
+
+from libs.forksafe import PerProcess, start_thread
+from libs.resp import RespClient
+
+EVENTS_URL = os.environ.get('CSAFE_EVENTS_URL', '')  # Empty = in-process delivery only
+EVENTS_QUEUE_SIZE = int(os.environ.get('CSAFE_EVENTS_QUEUE_SIZE', 100))  # Events a stream may fall behind by
+EVENTS_RETRY_SECS = float(os.environ.get('CSAFE_EVENTS_RETRY_SECS', 1))  # Wait before resubscribing to the broker
+
+
+class Event(NamedTuple):
+    channel: str
+    type: str
+    data: dict
+    id: Union[int, None] = None  # Message id, for resuming - None for status events
+
+
+class Subscription:
+    """
+    One stream's queue of events from a channel.  Closed by the hub if the stream may have missed an event
+    """
+    def __init__(self, channel: str, queue_size: int = EVENTS_QUEUE_SIZE):
+        self.channel = channel
+        self.closed = False
+        self._queue = queue.Queue(maxsize=queue_size)
+
+    def put(self, event: Event) -> bool:
+        """
+        Queue an event for the stream without waiting
+        :return: False if the queue was full - the subscription is closed
+        """
+        try:
+            self._queue.put_nowait(event)
+            return True
+        except queue.Full:
+            self.closed = True
+            return False
+
+    def close(self) -> None:
+        self.closed = True
+        try:
+            self._queue.put_nowait(None)  # Wake the stream
+        except queue.Full:
+            pass
+
+    def get(self, timeout: float) -> Union[Event, None]:
+        """
+        The next event, or None if there is none within timeout or the subscription has been closed
+        """
+        if self.closed:
+            timeout = 0  # Finish what was queued, then end
+        try:
+            return self._queue.get(timeout=timeout) if timeout else self._queue.get_nowait()
+        except queue.Empty:
+            return None
+
+
+class EventBackend(ABC):
+    @abstractmethod
+    def start(self, deliver: Callable[[Event], None], lost: Callable[[], None]) -> None:
+        """
+        Begin handing published events to deliver.  Called on each subscription, so must be cheap once started
+        :param deliver: Fans an event out to this process's subscriptions
+        :param lost: Closes all this process's subscriptions - called if events may have been missed
+        """
+
+    @abstractmethod
+    def publish(self, event: Event) -> None:
+        pass
+
+    def stats(self) -> dict:
+        return {}
+
+
+class LocalEventBackend(EventBackend):
+    """
+    Events are delivered to this process's streams only
+    """
+    def __init__(self):
+        self._deliver = None
+
+    def start(self, deliver: Callable[[Event], None], lost: Callable[[], None]) -> None:
+        self._deliver = deliver
+
+    def publish(self, event: Event) -> None:
+        if self._deliver is not None:
+            self._deliver(event)
+
+
+class RespEventBackend(EventBackend):
+    """
+    Events published through a Redis-protocol server.  Each process subscribes once, on a listener thread of its
+    own, and the first subscription in a process waits for that to be in place so no event published after it
+    is missed
+    """
+    def __init__(self, url: str, prefix: str = 'csafe:events:', retry_secs: float = EVENTS_RETRY_SECS):
+        self.client = RespClient(url)
+        self.prefix = prefix
+        self.retry_secs = retry_secs
+        self.errors = 0
+        self.received = 0
+        self._deliver = None
+        self._lost = None
+        self._subscribed = threading.Event()
+        # Started on first subscription, and again in each forked worker process
+        self._listener = PerProcess(self._start_listener)
+
+    def start(self, deliver: Callable[[Event], None], lost: Callable[[], None]) -> None:
+        self._deliver, self._lost = deliver, lost
+        self._listener.get()
+        self._subscribed.wait(self.client.timeout)
+
+    def _start_listener(self) -> threading.Thread:
+        self._subscribed = threading.Event()
+        return start_thread(self._run, 'event-listener')
+
+    def publish(self, event: Event) -> None:
+        self.client.command('PUBLISH', f"{self.prefix}{event.channel}",
+                            json.dumps([event.type, event.id, event.data]))
+
+    def _run(self) -> None:
+        while True:
+            try:
+                for channel, payload in self.client.subscribe(f"{self.prefix}*", on_subscribed=self._subscribed.set):
+                    event_type, event_id, data = json.loads(payload)
+                    self.received += 1
+                    self._deliver(Event(channel[len(self.prefix):], event_type, data, event_id))
+            except (OSError, RuntimeError, ValueError) as e:
+                self.errors += 1
+                logging.error(f"EVENTS: Subscription to {self.client} failed, retrying: {str(e)}")
+            # Events published while unsubscribed are lost - end the streams, so their clients resume
+            self._subscribed.clear()
+            self._lost()
+            time.sleep(self.retry_secs)
+
+    def stats(self) -> dict:
+        return {"server": str(self.client), "subscribed": self._subscribed.is_set(), "received": self.received,
+                "errors": self.errors}
+
+
+def make_backend(url: str = EVENTS_URL) -> EventBackend:
+    if url:
+        return RespEventBackend(url)
+    return LocalEventBackend()
+
+
+class EventHub:
+    def __init__(self, backend: EventBackend = None, queue_size: int = EVENTS_QUEUE_SIZE):
+        self.backend = backend or make_backend()
+        self.queue_size = queue_size
+        self.published = 0
+        self.publish_errors = 0
+        self.delivered = 0
+        self.dropped = 0
+        self._subscriptions: Dict[str, Set[Subscription]] = {}
+        self._lock = threading.Lock()
+
+    def subscribe(self, channel: str) -> Subscription:
+        """
+        Start queueing the channel's events for a stream.  Unsubscribe when the stream ends
+        """
+        subscription = Subscription(channel, self.queue_size)
+        with self._lock:
+            self._subscriptions.setdefault(channel, set()).add(subscription)
+        self.backend.start(self.deliver, self.close_all)
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription) -> None:
+        with self._lock:
+            subscriptions = self._subscriptions.get(subscription.channel)
+            if subscriptions is not None:
+                subscriptions.discard(subscription)
+                if not subscriptions:
+                    del self._subscriptions[subscription.channel]
+
+    def publish(self, channel: str, event_type: str, data: dict, event_id: int = None) -> None:
+        """
+        Send an event to every stream on the channel.  Call once the change it reports is committed.  Failures
+        are logged, not raised - the change is in the database, and streams pick it up when they resume
+        """
+        try:
+            self.backend.publish(Event(channel, event_type, data, event_id))
+            self.published += 1
+        except (OSError, RuntimeError) as e:
+            self.publish_errors += 1
+            logging.error(f"EVENTS: Publish to {channel} failed: {str(e)}")
+
+    def deliver(self, event: Event) -> None:
+        with self._lock:
+            subscriptions = list(self._subscriptions.get(event.channel, ()))
+        for subscription in subscriptions:
+            if subscription.put(event):
+                self.delivered += 1
+            else:
+                self.dropped += 1
+                self.unsubscribe(subscription)
+
+    def close_all(self) -> None:
+        with self._lock:
+            subscriptions = [s for channel in self._subscriptions.values() for s in channel]
+            self._subscriptions = {}
+        for subscription in subscriptions:
+            subscription.close()
+
+    def stats(self) -> dict:
+        with self._lock:
+            streams = sum(len(channel) for channel in self._subscriptions.values())
+            channels = len(self._subscriptions)
+        return {"channels": channels, "streams": streams, "published": self.published,
+                "publish_errors": self.publish_errors, "delivered": self.delivered, "dropped": self.dropped,
+                "backend": self.backend.stats()}
@@ -0,0 +1,61 @@
+"""
+Threads, pools and sessions that must exist once per process.  uwsgi imports the app and then forks its
+workers, and only the forking thread survives a fork - a thread or pool started before it is gone in every
+worker, and a pool's handles would be shared.  PerProcess makes its value on first use, and again on first use
+in each process forked since
+"""
+from typing import Callable, Generic, TypeVar, Union
+import os
+import threading
+
+T = TypeVar('T')
+
+
+class PerProcess(Generic[T]):
+    def __init__(self, factory: Callable[[], T]):
+        """
+        :param factory: Makes the value - called at most once per process
+        """
+        self._factory = factory
+        self._value = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    @property
+    def started(self) -> bool:
+        """
+        True if the value has been made in this process
+        """
+        return self._pid == os.getpid()
+
+    def get(self) -> T:
+        """
+        This process's value, made now if it has none yet
+        """
+        if self._pid == os.getpid():
+            return self._value
+        with self._lock:
+            if self._pid != os.getpid():
+                self._value = self._factory()
+                self._pid = os.getpid()
+            return self._value
+
+    def reset(self) -> Union[T, None]:
+        """
+        Forget the value, so the next get makes a new one
+        :return: the value if it was made in this process, else None
+        """
+        with self._lock:
+            value = self._value if self._pid == os.getpid() else None
+            self._pid = None
+            self._value = None
+            return value
+
+
+def start_thread(target: Callable[[], None], name: str) -> threading.Thread:
+    """
+    Start a daemon thread - for use as a PerProcess factory
+    """
+    thread = threading.Thread(target=target, name=name, daemon=True)
+    thread.start()
+    return thread
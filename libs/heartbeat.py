@@ -0,0 +1,97 @@
+import atexit
+import logging
+import os
+import threading
+from datetime import datetime
+from typing import Callable, Dict, Union
+
+from flask import Flask
+
+from libs.forksafe import PerProcess, start_thread
+
+HEARTBEAT_FLUSH_SECS = float(os.environ.get('CSAFE_HEARTBEAT_FLUSH_SECS', 5))  # 0 = write heartbeats through
+HEARTBEAT_MAX_PENDING = int(os.environ.get('CSAFE_HEARTBEAT_MAX_PENDING', 5000))
+
+
+class HeartbeatBuffer:
+    """
+    Write-behind buffer for safe heartbeats - checkins that change nothing but last_update.
+    The latest timestamp per hardware_id is held in memory and written in one bulk UPDATE every few seconds,
+    when the buffer fills, or at shutdown.  Anything that changes safe state is written through as before
+    """
+    def __init__(self, flush_secs: float = HEARTBEAT_FLUSH_SECS, max_pending: int = HEARTBEAT_MAX_PENDING):
+        self.flush_secs = flush_secs
+        self.max_pending = max_pending
+        self.flushes = 0
+        self.coalesced = 0
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._app = None
+        self._writer = None
+        # Started on first use, and again in each forked worker process
+        self._thread = PerProcess(lambda: start_thread(self._run, 'heartbeat-flush'))
+
+    @property
+    def enabled(self) -> bool:
+        return self.flush_secs > 0 and self._app is not None
+
+    def init_app(self, app: Flask, writer: Callable[[Dict[str, datetime]], None]) -> None:
+        """
+        :param app: Flask app - flushes run in its app context
+        :param writer: Writes a {hardware_id: last_update} mapping to the database
+        """
+        self._app = app
+        self._writer = writer
+        atexit.register(self.flush)
+
+    def record(self, hwid: str, timestamp: datetime) -> None:
+        """
+        Note a heartbeat - only the newest timestamp per safe is kept.  Only call when enabled
+        """
+        self._thread.get()
+        with self._lock:
+            current = self._pending.get(hwid)
+            if current is not None:
+                self.coalesced += 1
+            if current is None or timestamp > current:
+                self._pending[hwid] = timestamp
+            full = len(self._pending) >= self.max_pending
+        if full:
+            self._wake.set()
+
+    def pending(self, hwid: str) -> Union[datetime, None]:
+        with self._lock:
+            return self._pending.get(hwid)
+
+    def flush(self) -> int:
+        """
+        Write all pending heartbeats in one bulk UPDATE
+        :return: number of safes written
+        """
+        with self._lock:
+            batch, self._pending = self._pending, {}
+        if not batch or self._app is None:
+            return 0
+        try:
+            with self._app.app_context():
+                self._writer(batch)
+            self.flushes += 1
+        except Exception as e:
+            logging.error(f"HEARTBEAT: Flush of {len(batch)} safes failed, will retry: {str(e)}")
+            with self._lock:
+                for hwid, timestamp in batch.items():
+                    if hwid not in self._pending or self._pending[hwid] < timestamp:
+                        self._pending[hwid] = timestamp
+            return 0
+        return len(batch)
+
+    def _run(self) -> None:
+        while True:
+            self._wake.wait(self.flush_secs)
+            self._wake.clear()
+            self.flush()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"pending": len(self._pending), "flushes": self.flushes, "coalesced": self.coalesced}
@@ -0,0 +1,155 @@
+"""
+Cache of the logged-on user's identity for JWT endpoints, which nearly all start by loading the user for the
+token.  The user is looked up once per request (memoised on flask.g) and kept across requests for
+CSAFE_IDENTITY_TTL seconds in a backend - in process by default, or in a Redis-protocol server shared by all
+workers (CSAFE_IDENTITY_CACHE_URL=redis://host:port/db).
+
+Cached users are CachedUser snapshots of the identity columns, not ORM objects, so they are safe to share
+between requests and processes.  Code that changes or deletes a user must go through UserModel.save_to_db /
+delete_from_db, which invalidate the entry
+"""
+from abc import ABC, abstractmethod
+from typing import Callable, NamedTuple, Union
+import json
+import logging
+import os
+
+from flask import g, has_app_context, has_request_context
+from flask_jwt_extended import get_jwt_identity
+
+from libs.lru import LRUCache
+from libs.resp import RespClient
+
+IDENTITY_CACHE_URL = os.environ.get('CSAFE_IDENTITY_CACHE_URL', '')  # Empty = in-process cache
+IDENTITY_CACHE_SIZE = int(os.environ.get('CSAFE_IDENTITY_CACHE_SIZE', 10000))
+IDENTITY_TTL = float(os.environ.get('CSAFE_IDENTITY_TTL', 60))
+
+
+class CachedUser(NamedTuple):
+    id: int
+    username: str
+    email: str
+    displayname: str
+
+
+class IdentityBackend(ABC):
+    @abstractmethod
+    def get(self, user_id: int) -> Union[dict, None]:
+        pass
+
+    @abstractmethod
+    def put(self, user_id: int, user: dict) -> None:
+        pass
+
+    @abstractmethod
+    def delete(self, user_id: int) -> None:
+        pass
+
+    def stats(self) -> dict:
+        return {}
+
+
+class LocalIdentityBackend(IdentityBackend):
+    """
+    Per-process LRU with expiry - another worker's change to a user is seen here within the TTL
+    """
+    def __init__(self, max_size: int = IDENTITY_CACHE_SIZE, ttl: float = IDENTITY_TTL):
+        self._cache = LRUCache(max_size=max_size, ttl=ttl)
+
+    def get(self, user_id: int) -> Union[dict, None]:
+        return self._cache.get(user_id)
+
+    def put(self, user_id: int, user: dict) -> None:
+        self._cache.put(user_id, user)
+
+    def delete(self, user_id: int) -> None:
+        self._cache.pop(user_id)
+
+    def stats(self) -> dict:
+        return self._cache.stats()
+
+
+class RespIdentityBackend(IdentityBackend):
+    """
+    Users held as JSON in a Redis-protocol server, so an invalidation is seen by every worker.  Errors are
+    logged and treated as misses - the database remains the source of truth
+    """
+    def __init__(self, url: str, ttl: float = IDENTITY_TTL, prefix: str = 'csafe:user:'):
+        self.client = RespClient(url)
+        self.ttl = ttl
+        self.prefix = prefix
+        self.errors = 0
+
+    def _command(self, *args):
+        try:
+            return self.client.command(*args)
+        except (OSError, RuntimeError) as e:
+            self.errors += 1
+            logging.error(f"IDENTITY: Cache backend unavailable: {str(e)}")
+            return None
+
+    def get(self, user_id: int) -> Union[dict, None]:
+        value = self._command('GET', f"{self.prefix}{user_id}")
+        return json.loads(value) if value else None
+
+    def put(self, user_id: int, user: dict) -> None:
+        self._command('SET', f"{self.prefix}{user_id}", json.dumps(user), 'PX', int(self.ttl * 1000))
+
+    def delete(self, user_id: int) -> None:
+        self._command('DEL', f"{self.prefix}{user_id}")
+
+    def stats(self) -> dict:
+        return {"server": str(self.client), "errors": self.errors}
+
+
+def make_backend(url: str = IDENTITY_CACHE_URL) -> IdentityBackend:
+    if url:
+        return RespIdentityBackend(url)
+    return LocalIdentityBackend()
+
+
+class IdentityCache:
+    def __init__(self, backend: IdentityBackend = None):
+        self.backend = backend or make_backend()
+        self._loader = None
+
+    def init_loader(self, loader: Callable[[int], Union[CachedUser, None]]) -> None:
+        """
+        :param loader: Loads a user's CachedUser from the database, or None if there is no such user
+        """
+        self._loader = loader
+
+    def get(self, user_id: int) -> Union[CachedUser, None]:
+        """
+        The user with this id - from this request, the cache, or the database
+        """
+        memo = g.setdefault('identity_users', {}) if has_request_context() else {}
+        if user_id in memo:
+            return memo[user_id]
+        cached = self.backend.get(user_id)
+        if cached is not None:
+            user = CachedUser(**cached)
+        else:
+            user = self._loader(user_id)
+            if user is not None:
+                self.backend.put(user_id, user._asdict())
+        memo[user_id] = user
+        return user
+
+    def current(self) -> Union[CachedUser, None]:
+        """
+        The user the request's JWT was issued to
+        """
+        return self.get(get_jwt_identity())
+
+    def invalidate(self, user_id: int) -> None:
+        # g belongs to the app context, which a request can share with the code around it
+        if has_app_context():
+            g.setdefault('identity_users', {}).pop(user_id, None)
+        self.backend.delete(user_id)
+
+    def stats(self) -> dict:
+        return self.backend.stats()
+
+
+identity_cache = IdentityCache()
@@ -0,0 +1,66 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Hashable, Union
+
+
+class LRUCache:
+    """
+    Thread-safe, bounded least-recently-used cache with optional per-entry time-to-live and hit/miss counters
+    """
+    def __init__(self, max_size: int, ttl: Union[float, None] = None):
+        """
+        :param max_size: Maximum number of entries - least recently used entries are evicted beyond this
+        :param ttl: Seconds an entry stays valid, or None for no expiry
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable, default: Any = None, validate: Union[Callable[[Any], bool], None] = None) -> Any:
+        """
+        Return the cached value for key, or default if absent or expired
+        :param key: Cache key
+        :param default: Returned on a miss
+        :param validate: Optional check on the cached value - if it returns False the entry is dropped as stale
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and (entry[1] is None or entry[1] > time.monotonic()) and \
+                    (validate is None or validate(entry[0])):
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+            if entry is not None:
+                del self._entries[key]
+            self.misses += 1
+            return default
+
+    def put(self, key: Hashable, value: Any) -> None:
+        expires = time.monotonic() + self.ttl if self.ttl is not None else None
+        with self._lock:
+            self._entries[key] = (value, expires)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def pop(self, key: Hashable) -> None:
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"size": len(self._entries), "max_size": self.max_size, "hits": self.hits,
+                    "misses": self.misses, "evictions": self.evictions}
@@ -1,5 +1,6 @@
-from requests import post, Response
+from requests import post, Response, Session
 from typing import Union, List
+import json
 import os
 import logging
 
@@ -13,9 +14,21 @@ class MailGunException(Exception):
 
 class Mailgun:
     MAIL_DOMAIN = os.environ.get("MAIL_DOMAIN", None)
-    MAILGUN_API_BASEURL = "https://api.eu.mailgun.net/v3/{}".format(MAIL_DOMAIN)
+    # Override to point at a local stand-in, e.g. benchmarks/fake_mailgun.py
+    MAILGUN_API_BASEURL = os.environ.get("MAILGUN_API_BASEURL", "https://api.eu.mailgun.net/v3/{}".format(MAIL_DOMAIN))
     MAILGUN_API_KEY = os.environ.get("MAILGUN_API_KEY", None)
 
+    @classmethod
+    def check_config(cls) -> None:
+        """
+        Raise MailGunException if mail cannot be sent with the current settings
+        """
+        if cls.MAILGUN_API_KEY is None:
+            raise MailGunException(msgs.MAILGUN_NO_API_KEY)
+        if cls.MAIL_DOMAIN is None:
+            logging.error('MAILGUN: MAILGUN_NO_DOMAIN')
+            raise MailGunException(msgs.MAILGUN_NO_DOMAIN)
+
     @classmethod
     def send_email(
         cls,
@@ -29,11 +42,7 @@ class Mailgun:
         """
         Send an address confirmation email to the user
         """
-        if cls.MAILGUN_API_KEY is None:
-            raise MailGunException(msgs.MAILGUN_NO_API_KEY)
-        if cls.MAIL_DOMAIN is None:
-            logging.error('MAILGUN: MAILGUN_NO_DOMAIN')
-            raise MailGunException(msgs.MAILGUN_NO_DOMAIN)
+        cls.check_config()
         response = post(
             cls.MAILGUN_API_BASEURL + "/messages",
             auth=("api", cls.MAILGUN_API_KEY),
@@ -49,3 +58,41 @@ class Mailgun:
             logging.error(f"MAILGUN API exception: {response.text}")
             raise MailGunException(msgs.MAILGUN_FAILED_TO_SEND.format(response.text))
         return response
+
+    @classmethod
+    def send_batch(
+        cls,
+        session: Session,
+        from_email: str,
+        from_title: str,
+        recipient_variables: dict,
+        subject: str,
+        text: str,
+        html: str,
+        timeout: float,
+    ) -> Response:
+        """
+        Send one message per recipient in a single call - Mailgun substitutes %recipient.<name>% in the subject
+        and bodies from each recipient's variables
+        :param session: Pooled HTTP session
+        :param recipient_variables: {email: {name: value}} - at most 1000 recipients
+        :param timeout: Seconds to wait for Mailgun
+        """
+        cls.check_config()
+        response = session.post(
+            cls.MAILGUN_API_BASEURL + "/messages",
+            auth=("api", cls.MAILGUN_API_KEY),
+            data={
+                "from": f"{from_title} <{from_email}>",
+                "to": list(recipient_variables),
+                "subject": subject,
+                "text": text,
+                "html": html,
+                "recipient-variables": json.dumps(recipient_variables),
+            },
+            timeout=timeout,
+        )
+        if not response.ok:
+            logging.error(f"MAILGUN API exception: {response.status_code} {response.text}")
+            raise MailGunException(msgs.MAILGUN_FAILED_TO_SEND.format(response.text))
+        return response
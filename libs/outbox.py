@@ -0,0 +1,264 @@
+"""
+Background delivery of queued emails.  Requests only add a row to the email_outbox table (OutboxModel.enqueue),
+so Mailgun's latency or an outage never lands on the API.  A sender thread in each worker process claims due
+rows, groups them by template into Mailgun batch sends - one call for up to CSAFE_MAIL_BATCH recipients, each
+getting their own variables - and posts the batches on a pooled HTTP session with at most
+CSAFE_MAIL_CONCURRENCY in flight.  Failed messages are retried with exponential backoff and jitter, and marked
+failed after CSAFE_MAIL_MAX_ATTEMPTS.
+
+Rows are claimed for CSAFE_MAIL_CLAIM_SECS, so several workers can send side by side and rows claimed by a
+process that dies are picked up again once the claim lapses.  With CSAFE_MAIL_POLL_SECS=0 no thread is started
+and the outbox is drained with:
+
+    flask send-mail
+
+Sent rows are kept for CSAFE_MAIL_KEEP_DAYS and removed by:
+
+    flask purge-outbox
+"""
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from typing import Callable, Dict, List, NamedTuple, Tuple, Union
+import logging
+import os
+import random
+import threading
+
+import click
+from flask import Flask
+from requests import RequestException, Session
+from requests.adapters import HTTPAdapter
+
+from libs.forksafe import PerProcess, start_thread
+from libs.mailgun import Mailgun, MailGunException
+import messages.en as msgs
+
+MAIL_POLL_SECS = float(os.environ.get('CSAFE_MAIL_POLL_SECS', 5))  # 0 = no sender thread, use flask send-mail
+MAIL_CONCURRENCY = int(os.environ.get('CSAFE_MAIL_CONCURRENCY', 4))  # Mailgun calls in flight per process
+MAIL_BATCH = int(os.environ.get('CSAFE_MAIL_BATCH', 500))  # Recipients per batch send - Mailgun allows 1000
+MAIL_CLAIM = int(os.environ.get('CSAFE_MAIL_CLAIM', 500))  # Outbox rows claimed per pass
+MAIL_CLAIM_SECS = float(os.environ.get('CSAFE_MAIL_CLAIM_SECS', 120))
+MAIL_MAX_ATTEMPTS = int(os.environ.get('CSAFE_MAIL_MAX_ATTEMPTS', 8))
+MAIL_RETRY_BASE_SECS = float(os.environ.get('CSAFE_MAIL_RETRY_BASE_SECS', 30))
+MAIL_RETRY_MAX_SECS = float(os.environ.get('CSAFE_MAIL_RETRY_MAX_SECS', 3600))
+MAIL_TIMEOUT = float(os.environ.get('CSAFE_MAIL_TIMEOUT', 10))
+MAIL_KEEP_DAYS = float(os.environ.get('CSAFE_MAIL_KEEP_DAYS', 7))
+
+# Template name: (subject, text body, html body) - bodies are formatted with the message's variables
+TEMPLATES = {
+    'confirmation': (msgs.CONFIRMATION_MAIL_SUBJECT, msgs.CONFIRMATION_MAIL_BODY, msgs.CONFIRMATION_MAIL_BODY_HTML),
+    'relationship_start': (msgs.RELATIONSHIP_MAIL_SUBJECT, msgs.RELATIONSHIP_START_MAIL_BODY,
+                           msgs.RELATIONSHIP_START_MAIL_BODY_HTML),
+    'relationship_end': (msgs.RELATIONSHIP_MAIL_SUBJECT, msgs.RELATIONSHIP_END_MAIL_BODY,
+                         msgs.RELATIONSHIP_END_MAIL_BODY_HTML),
+}
+
+
+class OutboxMessage(NamedTuple):
+    id: int
+    template: str
+    to_email: str
+    variables: Dict[str, str]
+    attempts: int  # Previous attempts
+
+
+# (sent ids, [(id, next attempt time or None if given up, error)], now)
+Recorder = Callable[[List[int], List[Tuple[int, Union[datetime, None], str]], datetime], None]
+
+
+def retry_delay(attempts: int, base_secs: float = MAIL_RETRY_BASE_SECS,
+                max_secs: float = MAIL_RETRY_MAX_SECS) -> float:
+    """
+    Seconds before the next try after the given number of failed attempts - doubling, capped, with jitter so
+    messages that failed together do not all retry together
+    """
+    return min(max_secs, base_secs * 2 ** (attempts - 1)) * random.uniform(0.5, 1.0)
+
+
+def make_batches(messages: List[OutboxMessage], batch_size: int = MAIL_BATCH) -> List[List[OutboxMessage]]:
+    """
+    Group messages by template into batches of at most batch_size.  Recipient variables are keyed by address,
+    so an address appears at most once per batch
+    """
+    by_template = {}
+    for message in messages:
+        by_template.setdefault(message.template, []).append(message)
+    batches = []
+    for template_messages in by_template.values():
+        open_batches = []  # (addresses, messages) not yet full
+        for message in template_messages:
+            index = next((i for i, (addresses, _) in enumerate(open_batches) if message.to_email not in addresses),
+                         None)
+            if index is None:
+                index = len(open_batches)
+                open_batches.append((set(), []))
+            addresses, batch = open_batches[index]
+            addresses.add(message.to_email)
+            batch.append(message)
+            if len(batch) >= batch_size:
+                batches.append(open_batches.pop(index)[1])
+        batches.extend(batch for _, batch in open_batches)
+    return batches
+
+
+def render_batch(batch: List[OutboxMessage]) -> Tuple[str, str, str, dict]:
+    """
+    :return: subject, text, html with %recipient.<name>% placeholders, and the recipient variables
+    """
+    subject, text, html = TEMPLATES[batch[0].template]
+    names = set()
+    for message in batch:
+        names.update(message.variables)
+    placeholders = {name: f"%recipient.{name}%" for name in names}
+    recipient_variables = {message.to_email: {name: message.variables.get(name, '') for name in names}
+                           for message in batch}
+    return subject, text.format(**placeholders), html.format(**placeholders), recipient_variables
+
+
+class MailSender:
+    def __init__(self, poll_secs: float = MAIL_POLL_SECS, concurrency: int = MAIL_CONCURRENCY,
+                 batch_size: int = MAIL_BATCH, claim_size: int = MAIL_CLAIM, claim_secs: float = MAIL_CLAIM_SECS,
+                 max_attempts: int = MAIL_MAX_ATTEMPTS, timeout: float = MAIL_TIMEOUT):
+        self.poll_secs = poll_secs
+        self.concurrency = concurrency
+        self.batch_size = batch_size
+        self.claim_size = claim_size
+        self.claim_secs = claim_secs
+        self.max_attempts = max_attempts
+        self.timeout = timeout
+        self.sent = 0
+        self.retried = 0
+        self.failed = 0
+        self.calls = 0
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._app = None
+        self._claimer = None
+        self._recorder = None
+        # Started on first request, and again in each forked worker process
+        self._thread = PerProcess(lambda: start_thread(self._run, 'mail-sender'))
+        self._senders = PerProcess(self._make_senders)
+
+    @property
+    def enabled(self) -> bool:
+        return self.poll_secs > 0 and self._app is not None
+
+    def init_app(self, app: Flask, claimer: Callable[[datetime, int, float], List[OutboxMessage]],
+                 recorder: Recorder) -> None:
+        """
+        :param app: Flask app - sending passes run in its app context
+        :param claimer: Claims up to the given number of due messages for the given seconds, returning them
+        :param recorder: Records sent and failed messages
+        """
+        self._app = app
+        self._claimer = claimer
+        self._recorder = recorder
+        if self.poll_secs > 0:
+            app.before_request(self._ensure_thread)
+
+    def notify(self) -> None:
+        """
+        Wake the sender - call once a message is committed to the outbox
+        """
+        if self.enabled:
+            self._ensure_thread()
+            self._wake.set()
+
+    def _ensure_thread(self) -> None:
+        self._thread.get()
+
+    def _make_senders(self) -> Tuple[ThreadPoolExecutor, Session]:
+        # Pool and HTTP session are created on first use, and again in each forked worker process
+        session = Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.concurrency)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        return ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix='mail-send'), session
+
+    def _send_batch(self, session: Session, batch: List[OutboxMessage]) -> Union[str, None]:
+        """
+        :return: None if sent, else the error
+        """
+        subject, text, html, recipient_variables = render_batch(batch)
+        try:
+            Mailgun.send_batch(session, from_email=msgs.FROM_EMAIL, from_title=msgs.FROM_TITLE,
+                               recipient_variables=recipient_variables, subject=subject, text=text, html=html,
+                               timeout=self.timeout)
+        except (MailGunException, RequestException) as e:
+            return str(e)
+        return None
+
+    def send_due(self, now: datetime) -> int:
+        """
+        One pass - claim due messages, send them in batches and record the outcome.  Call in an app context
+        :param now: Current (naive UTC) time
+        :return: number of messages claimed
+        """
+        messages = self._claimer(now, self.claim_size, self.claim_secs)
+        if not messages:
+            return 0
+        batches = make_batches(messages, self.batch_size)
+        pool, session = self._senders.get()
+        errors = list(pool.map(lambda batch: self._send_batch(session, batch), batches))
+        sent, failed = [], []
+        for batch, error in zip(batches, errors):
+            if error is None:
+                sent.extend(message.id for message in batch)
+                continue
+            logging.error(f"MAIL: Batch of {len(batch)} {batch[0].template} emails failed: {error}")
+            for message in batch:
+                attempts = message.attempts + 1
+                retry_at = None if attempts >= self.max_attempts else now + timedelta(seconds=retry_delay(attempts))
+                failed.append((message.id, retry_at, error))
+        self._recorder(sent, failed, datetime.utcnow())
+        with self._lock:
+            self.calls += len(batches)
+            self.sent += len(sent)
+            self.retried += sum(1 for _, retry_at, _ in failed if retry_at is not None)
+            self.failed += sum(1 for _, retry_at, _ in failed if retry_at is None)
+        return len(messages)
+
+    def drain(self) -> int:
+        """
+        Send passes until a claim comes back short.  Call in an app context
+        :return: number of messages claimed
+        """
+        total = 0
+        while True:
+            claimed = self.send_due(datetime.utcnow())
+            total += claimed
+            if claimed < self.claim_size:
+                return total
+
+    def _run(self) -> None:
+        while True:
+            self._wake.wait(self.poll_secs)
+            self._wake.clear()
+            try:
+                with self._app.app_context():
+                    self.drain()
+            except Exception as e:
+                logging.error(f"MAIL: Sender pass failed: {str(e)}")
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"sent": self.sent, "retried": self.retried, "failed": self.failed, "calls": self.calls}
+
+
+def init_app(app: Flask, sender: MailSender, purger: Callable[[datetime], int]) -> None:
+    """
+    Register the outbox commands
+    :param sender: The app's MailSender, already initialised
+    :param purger: Deletes sent messages sent before the given time, returning the number deleted
+    """
+    @app.cli.command('send-mail')
+    def send_mail_command():
+        """Send every due email in the outbox"""
+        click.echo(f"{sender.drain()} emails processed")
+
+    @app.cli.command('purge-outbox')
+    @click.option('--keep-days', default=MAIL_KEEP_DAYS, show_default=True, help='Days sent emails are kept')
+    def purge_outbox_command(keep_days: float):
+        """Delete sent emails from the outbox"""
+        deleted = purger(datetime.utcnow() - timedelta(days=keep_days))
+        click.echo(f"{deleted} sent emails purged")
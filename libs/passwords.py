@@ -0,0 +1,104 @@
+"""
+Password hashing off the request thread.  PBKDF2 is deliberately slow, so a burst of logins hashed inline ties
+up every worker and starves safe checkins.  Hashing runs on a small thread pool instead - hashlib releases the
+GIL while it hashes, so the pool uses real cores - with a bounded number of jobs queued or running.  When it is
+full, callers get HashingBusy straight away rather than waiting behind the burst.
+
+Each stored hash records its algorithm and iteration count, so the work factor can be raised through
+CSAFE_PW_ALGORITHM / CSAFE_PW_ITERATIONS and existing hashes are upgraded as their users log in
+"""
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+from typing import NamedTuple
+import hashlib
+import hmac
+import os
+import threading
+
+from libs.forksafe import PerProcess
+
+PW_ALGORITHM = os.environ.get('CSAFE_PW_ALGORITHM', 'pbkdf2_sha256')
+PW_ITERATIONS = int(os.environ.get('CSAFE_PW_ITERATIONS', 100000))
+HASH_WORKERS = int(os.environ.get('CSAFE_HASH_WORKERS', 2))  # Concurrent hashes per process
+HASH_QUEUE = int(os.environ.get('CSAFE_HASH_QUEUE', 16))  # Hashes that may wait for a worker
+HASH_TIMEOUT = float(os.environ.get('CSAFE_HASH_TIMEOUT', 10))  # Seconds a request waits for its hash
+
+ALGORITHMS = {
+    'pbkdf2_sha256': lambda password, salt, iterations: hashlib.pbkdf2_hmac('sha256', password, salt, iterations),
+    'pbkdf2_sha512': lambda password, salt, iterations: hashlib.pbkdf2_hmac('sha512', password, salt, iterations),
+}
+
+
+class HashingBusy(Exception):
+    pass
+
+
+class PasswordHash(NamedTuple):
+    salt: bytes
+    pw_hash: bytes
+    algorithm: str
+    iterations: int
+
+
+class PasswordHasher:
+    def __init__(self, algorithm: str = PW_ALGORITHM, iterations: int = PW_ITERATIONS,
+                 workers: int = HASH_WORKERS, queue: int = HASH_QUEUE, timeout: float = HASH_TIMEOUT):
+        if algorithm not in ALGORITHMS:
+            raise ValueError(f"Unknown password algorithm {algorithm}")
+        self.algorithm = algorithm
+        self.iterations = iterations
+        self.workers = workers
+        self.timeout = timeout
+        self.rejected = 0
+        self._slots = threading.BoundedSemaphore(workers + queue)
+        # Created on first use, and again in each forked worker process
+        self._pool = PerProcess(lambda: ThreadPoolExecutor(max_workers=workers, thread_name_prefix='pw-hash'))
+        self._lock = threading.Lock()
+
+    def _run(self, algorithm: str, password: str, salt: bytes, iterations: int) -> bytes:
+        if not self._slots.acquire(blocking=False):
+            with self._lock:
+                self.rejected += 1
+            raise HashingBusy()
+        try:
+            future = self._pool.get().submit(ALGORITHMS[algorithm], password.encode(), salt, iterations)
+        except BaseException:
+            self._slots.release()
+            raise
+        # The slot is held until the hash finishes or is cancelled, not just while this request waits for it
+        future.add_done_callback(lambda _: self._slots.release())
+        try:
+            return future.result(timeout=self.timeout)
+        except TimeoutError:
+            future.cancel()
+            raise HashingBusy()
+
+    def hash_new(self, password: str) -> PasswordHash:
+        """
+        Hash a password with a new random salt and the current algorithm and work factor
+        :raises HashingBusy: if too many hashes are already queued
+        """
+        salt = os.urandom(16)
+        return PasswordHash(salt, self._run(self.algorithm, password, salt, self.iterations),
+                            self.algorithm, self.iterations)
+
+    def verify(self, stored: PasswordHash, password: str) -> bool:
+        """
+        Check a password against a stored hash, using the parameters it was made with
+        :raises HashingBusy: if too many hashes are already queued
+        """
+        if stored.algorithm not in ALGORITHMS:
+            return False
+        candidate = self._run(stored.algorithm, password, stored.salt, stored.iterations)
+        return hmac.compare_digest(stored.pw_hash, candidate)
+
+    def needs_rehash(self, stored: PasswordHash) -> bool:
+        """
+        True if the stored hash was made with an older algorithm or work factor than the current one
+        """
+        return stored.algorithm != self.algorithm or stored.iterations < self.iterations
+
+    def stats(self) -> dict:
+        return {"workers": self.workers, "rejected": self.rejected}
+
+
+password_hasher = PasswordHasher()
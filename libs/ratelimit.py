@@ -0,0 +1,181 @@
+"""
+Token-bucket throttling for the endpoints that hash passwords.  Each request takes a token from a bucket per
+client IP and a bucket per username; an empty bucket means 429 before the resource touches the database or the
+hashing pool.
+
+Buckets live in a backend.  LocalBackend keeps them in process, in a bounded LRU, so each uwsgi worker limits
+on its own.  RespBackend keeps them in a Redis-protocol server (CSAFE_RATELIMIT_URL=redis://host:port/db), so
+all workers share one budget - it needs only EVAL, which Redis and its protocol-compatible stand-ins provide
+"""
+from abc import ABC, abstractmethod
+from functools import wraps
+from time import monotonic, time
+from typing import Callable, Dict, List, Tuple, Union
+import logging
+import math
+import os
+import threading
+
+from flask import request
+
+from libs.lru import LRUCache
+from libs.resp import RespClient
+import messages.en as msgs
+
+RATELIMIT_URL = os.environ.get('CSAFE_RATELIMIT_URL', '')  # Empty = in-process buckets
+RATELIMIT_MAX_KEYS = int(os.environ.get('CSAFE_RATELIMIT_MAX_KEYS', 100000))
+# Requests per minute, and burst, for each client IP and each username
+AUTH_IP_RATE = float(os.environ.get('CSAFE_AUTH_IP_RATE', 30))
+AUTH_IP_BURST = int(os.environ.get('CSAFE_AUTH_IP_BURST', 20))
+AUTH_USER_RATE = float(os.environ.get('CSAFE_AUTH_USER_RATE', 6))
+AUTH_USER_BURST = int(os.environ.get('CSAFE_AUTH_USER_BURST', 5))
+
+
+class RateLimitBackend(ABC):
+    """
+    Token bucket store.  A bucket holds up to burst tokens and refills at rate tokens per second
+    """
+    @abstractmethod
+    def consume(self, key: str, rate: float, burst: int) -> Tuple[bool, float]:
+        """
+        Take one token from the bucket for key
+        :param key: Bucket key
+        :param rate: Tokens added per second
+        :param burst: Bucket size
+        :return: whether a token was taken, seconds until one will be available
+        """
+
+    def stats(self) -> dict:
+        return {}
+
+
+class LocalBackend(RateLimitBackend):
+    """
+    Buckets held in this process.  The least recently used are evicted beyond max_keys - an evicted bucket
+    starts full again, so max_keys should comfortably exceed the active clients and usernames
+    """
+    def __init__(self, max_keys: int = RATELIMIT_MAX_KEYS):
+        self._buckets = LRUCache(max_size=max_keys)
+        self._lock = threading.Lock()
+
+    def consume(self, key: str, rate: float, burst: int) -> Tuple[bool, float]:
+        now = monotonic()
+        with self._lock:
+            tokens, updated = self._buckets.get(key, (burst, now))
+            tokens = min(burst, tokens + (now - updated) * rate)
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+            self._buckets.put(key, (tokens, now))
+        return allowed, 0.0 if allowed else (1 - tokens) / rate
+
+    def stats(self) -> dict:
+        return self._buckets.stats()
+
+
+# KEYS[1] bucket; ARGV rate, burst, now.  The bucket is a hash of tokens and updated time, expiring once full
+TOKEN_BUCKET_SCRIPT = """
+local rate, burst, now = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3])
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+local tokens = tonumber(bucket[1]) or burst
+local updated = tonumber(bucket[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - updated) * rate)
+local allowed = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+    allowed = 1
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'updated', tostring(now))
+redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate) + 1)
+return {allowed, tostring(tokens)}
+"""
+
+
+class RespBackend(RateLimitBackend):
+    """
+    Buckets held in a Redis-protocol server, shared by every worker - one EVAL round trip per consume.
+    If the server cannot be reached, requests are allowed rather than locking every user out
+    """
+    def __init__(self, url: str, prefix: str = 'csafe:rl:'):
+        self.client = RespClient(url)
+        self.prefix = prefix
+        self.errors = 0
+
+    def consume(self, key: str, rate: float, burst: int) -> Tuple[bool, float]:
+        try:
+            allowed, tokens = self.client.command('EVAL', TOKEN_BUCKET_SCRIPT, 1, self.prefix + key, rate, burst,
+                                                  repr(time()))
+        except (OSError, RuntimeError) as e:
+            self.errors += 1
+            logging.error(f"RATELIMIT: Backend unavailable, allowing request: {str(e)}")
+            return True, 0.0
+        return bool(allowed), 0.0 if allowed else (1 - float(tokens)) / rate
+
+    def stats(self) -> dict:
+        return {"server": str(self.client), "errors": self.errors}
+
+
+def make_backend(url: str = RATELIMIT_URL) -> RateLimitBackend:
+    if url:
+        return RespBackend(url)
+    return LocalBackend()
+
+
+class RateLimiter:
+    def __init__(self, backend: RateLimitBackend = None):
+        self.backend = backend or make_backend()
+        self.rejected: Dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def check(self, scope: str, limits: List[Tuple[str, float, int]]) -> Union[float, None]:
+        """
+        Take a token from each bucket in turn
+        :param scope: Name of the limited operation, e.g. 'login'
+        :param limits: (key, requests per minute, burst) for each bucket
+        :return: None if allowed, else seconds the client should wait
+        """
+        for key, per_minute, burst in limits:
+            allowed, wait = self.backend.consume(f"{scope}:{key}", per_minute / 60, burst)
+            if not allowed:
+                with self._lock:
+                    self.rejected[scope] = self.rejected.get(scope, 0) + 1
+                return wait
+        return None
+
+    def throttled(self, scope: str, username: Callable[[], Union[str, None]] = None):
+        """
+        Decorator for a resource method - limits requests per client IP and, if username returns one, per
+        username, before the method runs.  Rejected requests get 429 and a Retry-After header
+        :param scope: Name of the limited operation
+        :param username: Returns the username the request is for, without touching the database
+        """
+        def decorator(func):
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                limits = [(f"ip:{request.remote_addr}", AUTH_IP_RATE, AUTH_IP_BURST)]
+                name = username() if username else None
+                if name:
+                    limits.append((f"user:{name.lower()}", AUTH_USER_RATE, AUTH_USER_BURST))
+                wait = self.check(scope, limits)
+                if wait is not None:
+                    return {"message": msgs.TOO_MANY_REQUESTS}, 429, {"Retry-After": str(math.ceil(wait))}
+                return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"rejected": dict(self.rejected), "backend": self.backend.stats()}
+
+
+def json_username() -> Union[str, None]:
+    """
+    The username field of the request's JSON body, if any
+    """
+    body = request.get_json(silent=True)
+    if isinstance(body, dict) and isinstance(body.get('username'), str):
+        return body['username']
+    return None
+
+
+auth_limiter = RateLimiter()
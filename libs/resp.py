@@ -0,0 +1,117 @@
+"""
+Minimal client for the Redis wire protocol (RESP), for the shared backends of the rate limiter, identity
+cache and relationship event hub.  Works with Redis and the servers that speak its protocol, without adding a
+client library
+"""
+from typing import Callable, Iterator
+from urllib.parse import urlparse
+import os
+import socket
+import threading
+
+
+class RespClient:
+    """
+    One connection per process, reopened after a fork or an error.  Commands are serialised on a lock
+    """
+    def __init__(self, url: str, timeout: float = 0.5):
+        """
+        :param url: redis://host:port/db
+        :param timeout: Socket timeout in seconds
+        """
+        parsed = urlparse(url)
+        self.host = parsed.hostname or 'localhost'
+        self.port = parsed.port or 6379
+        self.db = int(parsed.path.lstrip('/') or 0)
+        self.timeout = timeout
+        self._sock = None
+        self._file = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _encode(*args) -> bytes:
+        parts = [b'*%d\r\n' % len(args)]
+        for arg in args:
+            arg = arg if isinstance(arg, bytes) else str(arg).encode('utf-8')
+            parts.append(b'$%d\r\n%s\r\n' % (len(arg), arg))
+        return b''.join(parts)
+
+    def _read(self):
+        return self._read_reply(self._file)
+
+    @classmethod
+    def _read_reply(cls, file):
+        line = file.readline()
+        if not line.endswith(b'\r\n'):
+            raise ConnectionError("Connection closed")
+        kind, rest = line[:1], line[1:-2]
+        if kind == b'+':
+            return rest.decode('utf-8')
+        if kind == b'-':
+            raise RuntimeError(rest.decode('utf-8'))
+        if kind == b':':
+            return int(rest)
+        if kind == b'$':
+            length = int(rest)
+            if length < 0:
+                return None
+            data = file.read(length + 2)
+            return data[:-2].decode('utf-8')
+        if kind == b'*':
+            return [cls._read_reply(file) for _ in range(int(rest))]
+        raise RuntimeError(f"Unexpected reply {line!r}")
+
+    def _connect(self) -> None:
+        self._sock = socket.create_connection((self.host, self.port), timeout=self.timeout)
+        self._file = self._sock.makefile('rb')
+        self._pid = os.getpid()
+        if self.db:
+            self._sock.sendall(self._encode('SELECT', self.db))
+            self._read()
+
+    def command(self, *args):
+        """
+        Send one command and return its decoded reply
+        :raises OSError: if the server cannot be reached - the connection is reopened on the next command
+        :raises RuntimeError: on an error reply
+        """
+        with self._lock:
+            try:
+                if self._sock is None or self._pid != os.getpid():
+                    self._connect()
+                self._sock.sendall(self._encode(*args))
+                return self._read()
+            except OSError:
+                if self._sock is not None:
+                    self._sock.close()
+                self._sock = None
+                raise
+
+    def subscribe(self, *patterns: str, on_subscribed: Callable[[], None] = None) -> Iterator[tuple]:
+        """
+        Subscribe to channel patterns on a connection of its own, and wait for messages.  Blocks until a message
+        arrives - the connection has no timeout once subscribed, only TCP keepalive
+        :param on_subscribed: Called once the server has confirmed the subscription
+        :return: iterator of (channel, data) for each message published to a matching channel
+        :raises OSError: when the connection fails - subscribe again to resume
+        """
+        sock = socket.create_connection((self.host, self.port), timeout=self.timeout)
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+            file = sock.makefile('rb')
+            sock.sendall(self._encode('PSUBSCRIBE', *patterns))
+            for _ in patterns:
+                self._read_reply(file)  # psubscribe confirmations
+            sock.settimeout(None)
+            if on_subscribed is not None:
+                on_subscribed()
+            while True:
+                reply = self._read_reply(file)
+                if isinstance(reply, list) and len(reply) == 4 and reply[0] == 'pmessage':
+                    yield reply[2], reply[3]
+        finally:
+            sock.close()
+
+    def __str__(self) -> str:
+        return f"{self.host}:{self.port}/{self.db}"
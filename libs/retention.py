@@ -0,0 +1,178 @@
+"""
+Safe event retention.  Raw safe_event rows older than CSAFE_EVENT_RETENTION_DAYS are rolled up into
+safe_event_rollup (per safe, per day, per event_code) and deleted in batches of CSAFE_EVENT_PURGE_BATCH rows.
+
+On PostgreSQL, safe_event may be range-partitioned by month (see the safe_event_rollup migration).  Partitions
+are then created ahead of time, and partitions lying wholly before the cutoff are rolled up and dropped in
+one go instead of deleted row by row.
+
+Run periodically with:
+
+    flask purge-events
+"""
+from datetime import date, datetime, time, timedelta
+from typing import List, Tuple, Union
+import logging
+import os
+import re
+
+import click
+from flask import Flask
+from sqlalchemy import text
+
+from db import db
+from models.safe import SafeEventModel, SafeEventRollupModel
+
+EVENT_RETENTION_DAYS = int(os.environ.get('CSAFE_EVENT_RETENTION_DAYS', 90))
+EVENT_PURGE_BATCH = int(os.environ.get('CSAFE_EVENT_PURGE_BATCH', 5000))
+PARTITIONS_AHEAD = 2  # Months of empty partitions to keep ready
+PARTITION_NAME = re.compile(r'^safe_event_p(\d{4})(\d{2})$')
+DEFAULT_PARTITION = 'safe_event_default'  # Catches rows outside every monthly partition
+
+
+def retention_cutoff(now: datetime, retention_days: int = EVENT_RETENTION_DAYS) -> datetime:
+    """
+    Start of the oldest day to keep - rolling up whole days keeps the daily rollups complete
+    """
+    return datetime.combine((now - timedelta(days=retention_days)).date(), time.min)
+
+
+def month_start(day: date, months_ahead: int = 0) -> date:
+    month = day.month - 1 + months_ahead
+    return date(day.year + month // 12, month % 12 + 1, 1)
+
+
+def is_partitioned() -> bool:
+    """
+    True if safe_event is a partitioned PostgreSQL table
+    """
+    if db.session.get_bind().dialect.name != 'postgresql':
+        return False
+    relkind = db.session.execute(text("SELECT relkind FROM pg_class WHERE relname = 'safe_event' "
+                                      "AND relnamespace = current_schema()::regnamespace")).scalar()
+    return relkind == 'p'
+
+
+def partition_name(start: date) -> str:
+    return f"safe_event_p{start:%Y%m}"
+
+
+def parse_partition_name(name: str) -> Union[date, None]:
+    """
+    :return: first day of the month a monthly partition covers, or None if name is not a monthly partition
+    """
+    match = PARTITION_NAME.match(name)
+    if match is None:
+        return None
+    return date(int(match.group(1)), int(match.group(2)), 1)
+
+
+def partition_tables() -> List[str]:
+    """
+    :return: names of all safe_event partitions, including the default partition
+    """
+    rows = db.session.execute(text(
+        "SELECT child.relname FROM pg_inherits "
+        "JOIN pg_class parent ON parent.oid = pg_inherits.inhparent "
+        "JOIN pg_class child ON child.oid = pg_inherits.inhrelid "
+        "WHERE parent.relname = 'safe_event'")).fetchall()
+    return [name for (name, ) in rows]
+
+
+def list_partitions() -> List[Tuple[str, date]]:
+    """
+    :return: (partition name, first day of its month) for each monthly safe_event partition, oldest first
+    """
+    partitions = [(name, parse_partition_name(name)) for name in partition_tables()]
+    return sorted((partition for partition in partitions if partition[1] is not None),
+                  key=lambda partition: partition[1])
+
+
+def create_partition_statements(start: date, has_default: bool) -> List[str]:
+    """
+    SQL creating the partition for the month from start.  PostgreSQL refuses a new partition while the default
+    partition holds rows in its range - e.g. future-dated events from a safe with a skewed clock, or months the
+    cron missed - so the default partition is detached, its rows in range moved across, and attached again
+    :param has_default: True if safe_event has a default partition
+    """
+    name = partition_name(start)
+    end = month_start(start, 1)
+    create = f"CREATE TABLE {name} PARTITION OF safe_event FOR VALUES FROM ('{start}') TO ('{end}')"
+    if not has_default:
+        return [create]
+    in_range = f"timestamp >= '{start}' AND timestamp < '{end}'"
+    return [f"ALTER TABLE safe_event DETACH PARTITION {DEFAULT_PARTITION}",
+            create,
+            f"INSERT INTO {name} SELECT hardware_id, timestamp, event_code, detail "
+            f"FROM {DEFAULT_PARTITION} WHERE {in_range}",
+            f"DELETE FROM {DEFAULT_PARTITION} WHERE {in_range}",
+            f"ALTER TABLE safe_event ATTACH PARTITION {DEFAULT_PARTITION} DEFAULT"]
+
+
+def ensure_partitions(today: date, months_ahead: int = PARTITIONS_AHEAD) -> List[str]:
+    """
+    Create any missing monthly partitions from this month to months_ahead months out, in one transaction
+    :return: names of the partitions created
+    """
+    tables = set(partition_tables())
+    created = []
+    for n in range(months_ahead + 1):
+        start = month_start(today, n)
+        name = partition_name(start)
+        if name not in tables:
+            for statement in create_partition_statements(start, DEFAULT_PARTITION in tables):
+                db.session.execute(text(statement))
+            created.append(name)
+    db.session.commit()
+    return created
+
+
+def drop_expired_partitions(cutoff: datetime) -> List[str]:
+    """
+    Roll up and drop each partition whose whole month lies before cutoff - one transaction per partition
+    :return: names of the partitions dropped
+    """
+    dropped = []
+    for name, start in list_partitions():
+        end = month_start(start, 1)
+        if datetime.combine(end, time.min) > cutoff:
+            break
+        SafeEventRollupModel.merge_counts(SafeEventModel.rollup_range(
+            SafeEventModel.timestamp >= datetime.combine(start, time.min),
+            SafeEventModel.timestamp < datetime.combine(end, time.min)))
+        db.session.execute(text(f"DROP TABLE {name}"))
+        db.session.commit()
+        dropped.append(name)
+    return dropped
+
+
+def purge_events(now: datetime, retention_days: int = EVENT_RETENTION_DAYS,
+                 batch_size: int = EVENT_PURGE_BATCH) -> dict:
+    """
+    Apply the retention policy
+    :return: summary of the work done
+    """
+    cutoff = retention_cutoff(now, retention_days)
+    summary = {"cutoff": cutoff, "partitions_created": [], "partitions_dropped": [], "rows_purged": 0}
+    if is_partitioned():
+        summary["partitions_created"] = ensure_partitions(now.date())
+        summary["partitions_dropped"] = drop_expired_partitions(cutoff)
+    while True:
+        deleted = SafeEventModel.rollup_and_purge_batch(cutoff, batch_size)
+        summary["rows_purged"] += deleted
+        if deleted == 0:
+            break
+    logging.info(f"RETENTION: {summary}")
+    return summary
+
+
+def init_app(app: Flask) -> None:
+    @app.cli.command('purge-events')
+    @click.option('--days', default=EVENT_RETENTION_DAYS, show_default=True, help='Days of raw events to keep')
+    @click.option('--batch', default=EVENT_PURGE_BATCH, show_default=True, help='Rows deleted per transaction')
+    def purge_events_command(days: int, batch: int):
+        """Roll up and purge safe events older than the retention period"""
+        summary = purge_events(datetime.utcnow(), retention_days=days, batch_size=batch)
+        click.echo(f"Events before {summary['cutoff']}: {summary['rows_purged']} rows purged, "
+                   f"partitions dropped {summary['partitions_dropped']}, "
+                   f"created {summary['partitions_created']}")
@@ -0,0 +1,104 @@
+"""
+Optional per-request timing of the checkin hot path, reported in a Server-Timing response header, e.g.
+
+    Server-Timing: crypto;dur=4.1, db;dur=2.3, serialization;dur=0.6, total;dur=7.0
+
+Enabled with CSAFE_SERVER_TIMING=1.  DB time covers statement execution and commits, crypto time covers code
+marked with phase('crypto') / @timed('crypto'), and serialization is the remainder of the request -
+JSON and message parsing and response rendering.  Used by benchmarks/load_test.py
+"""
+from contextlib import contextmanager
+from functools import wraps
+from time import perf_counter
+import os
+
+from flask import Flask, g, has_request_context
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session
+
+SERVER_TIMING = os.environ.get('CSAFE_SERVER_TIMING', '0') == '1'
+
+
+def _add(name: str, seconds: float) -> None:
+    if has_request_context() and 'phase_times' in g:
+        g.phase_times[name] = g.phase_times.get(name, 0.0) + seconds
+
+
+@contextmanager
+def phase(name: str):
+    """
+    Attribute the time spent in the block to the named phase
+    """
+    if not SERVER_TIMING:
+        yield
+        return
+    start = perf_counter()
+    try:
+        yield
+    finally:
+        _add(name, perf_counter() - start)
+
+
+def timed(name: str):
+    """
+    Decorator form of phase()
+    """
+    def decorator(func):
+        if not SERVER_TIMING:
+            return func
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with phase(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info['phase_start'] = perf_counter()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    # Statements run by a commit's flush are counted in the commit's time
+    if has_request_context() and 'phase_commit_start' not in g:
+        _add('db', perf_counter() - conn.info.pop('phase_start', perf_counter()))
+
+
+def _before_commit(session):
+    if has_request_context():
+        g.phase_commit_start = perf_counter()
+
+
+def _after_commit(session):
+    if has_request_context() and 'phase_commit_start' in g:
+        _add('db', perf_counter() - g.pop('phase_commit_start'))
+
+
+def init_app(app: Flask) -> None:
+    """
+    Register the request hooks and DB listeners if CSAFE_SERVER_TIMING is enabled
+    """
+    if not SERVER_TIMING:
+        return
+    event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+    event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+    event.listen(Session, 'before_commit', _before_commit)
+    event.listen(Session, 'after_commit', _after_commit)
+
+    @app.before_request
+    def start_timing():
+        g.phase_times = {}
+        g.phase_request_start = perf_counter()
+
+    @app.after_request
+    def add_timing_header(response):
+        if 'phase_times' in g:
+            total = perf_counter() - g.phase_request_start
+            times = dict(g.phase_times)
+            times['serialization'] = max(0.0, total - sum(times.values()))
+            times['total'] = total
+            response.headers['Server-Timing'] = ', '.join(f"{name};dur={seconds * 1000:.3f}"
+                                                          for name, seconds in times.items())
+        return response
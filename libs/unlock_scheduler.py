@@ -0,0 +1,180 @@
+import atexit
+import heapq
+import logging
+import os
+import socket
+import threading
+import uuid
+from datetime import datetime, timedelta
+from typing import Callable, List, Tuple
+
+from flask import Flask
+
+from libs.checkin_parser import to_naive_utc
+from libs.forksafe import PerProcess, start_thread
+
+UNLOCK_TICK_SECS = float(os.environ.get('CSAFE_UNLOCK_TICK_SECS', 1))  # 0 = unlock deadlines applied at checkin
+UNLOCK_RELOAD_SECS = float(os.environ.get('CSAFE_UNLOCK_RELOAD_SECS', 10))
+UNLOCK_LEASE_SECS = float(os.environ.get('CSAFE_UNLOCK_LEASE_SECS', 15))
+UNLOCK_BATCH = int(os.environ.get('CSAFE_UNLOCK_BATCH', 500))
+LEASE_NAME = 'unlock-scheduler'
+
+
+class UnlockScheduler:
+    """
+    Authorises safes to unlock when their unlock_time passes, rather than waiting for the safe's next checkin.
+    Pending deadlines are kept in a min-heap, so each tick only looks at the deadlines that are due, and due
+    safes are flipped in batched UPDATEs.
+    Every worker process runs the thread, but only the holder of a database lease acts on the heap, so
+    several uwsgi workers (or hosts) flip each safe once.  The leader reloads deadlines due within the next
+    two reload periods from the database when it takes the lease and every reload_secs, which picks up
+    changes made through other workers; changes made through the leader's own process are scheduled at once
+    """
+    def __init__(self, tick_secs: float = UNLOCK_TICK_SECS, reload_secs: float = UNLOCK_RELOAD_SECS,
+                 lease_secs: float = UNLOCK_LEASE_SECS, batch_size: int = UNLOCK_BATCH):
+        self.tick_secs = tick_secs
+        self.reload_secs = reload_secs
+        self.lease_secs = lease_secs
+        self.batch_size = batch_size
+        self.unlocked = 0
+        self.is_leader = False
+        self._heap = []  # (unlock_time, hardware_id)
+        self._deadlines = {}  # hardware_id: unlock_time - heap entries that no longer match are stale
+        self._next_reload = None
+        self._next_lease = None
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._app = None
+        self._loader = None
+        self._unlocker = None
+        self._acquire = None
+        self._release = None
+        self._holder = None
+        # Started on first request, and again in each forked worker process
+        self._thread = PerProcess(self._start_thread)
+
+    @property
+    def enabled(self) -> bool:
+        return self.tick_secs > 0 and self._app is not None
+
+    def init_app(self, app: Flask, loader: Callable[[datetime], List[Tuple[str, datetime]]],
+                 unlocker: Callable[[List[str], datetime], int],
+                 acquire: Callable[[str, str, float], bool], release: Callable[[str, str], None]) -> None:
+        """
+        :param app: Flask app - ticks run in its app context
+        :param loader: Returns (hardware_id, unlock_time) for safes not yet authorised whose unlock_time is
+                       before the given horizon
+        :param unlocker: Authorises the given safes if their unlock_time has passed, returning the number changed
+        :param acquire: Takes or renews a named lease for a holder for some seconds, returning True if held
+        :param release: Gives up a named lease if held by the holder
+        """
+        self._app = app
+        self._loader = loader
+        self._unlocker = unlocker
+        self._acquire = acquire
+        self._release = release
+        if self.tick_secs > 0:
+            app.before_request(self._ensure_thread)
+            atexit.register(self.stop)
+
+    def schedule(self, hwid: str, unlock_time: datetime) -> None:
+        """
+        Note a safe's new unlock_time - call once the change is committed.  Only the leader keeps a heap;
+        other workers' changes reach it on its next reload
+        """
+        if not self.enabled:
+            return
+        self._ensure_thread()
+        unlock_time = to_naive_utc(unlock_time)
+        with self._lock:
+            if not self.is_leader:
+                return
+            self._deadlines[hwid] = unlock_time
+            heapq.heappush(self._heap, (unlock_time, hwid))
+        self._wake.set()
+
+    def tick(self, now: datetime) -> int:
+        """
+        Renew the lease and, if leader, authorise every safe whose deadline has passed
+        :param now: Current (naive UTC) time
+        :return: number of safes authorised to unlock
+        """
+        if self._next_lease is None or now >= self._next_lease:
+            # Renewed well before it expires; followers only check back as often
+            leader = self._acquire(LEASE_NAME, self._holder, self.lease_secs)
+            self._next_lease = now + timedelta(seconds=self.lease_secs / 3)
+        else:
+            leader = self.is_leader
+        with self._lock:
+            if leader and not self.is_leader:
+                logging.info(f"UNLOCK: {self._holder} is now the unlock scheduler")
+                self._next_reload = None
+            self.is_leader = leader
+            if not leader:
+                self._heap, self._deadlines = [], {}
+                return 0
+        if self._next_reload is None or now >= self._next_reload:
+            self._reload(now)
+        due = []
+        with self._lock:
+            while self._heap and self._heap[0][0] <= now:
+                unlock_time, hwid = heapq.heappop(self._heap)
+                if self._deadlines.get(hwid) == unlock_time:
+                    del self._deadlines[hwid]
+                    due.append(hwid)
+        count = 0
+        for start in range(0, len(due), self.batch_size):
+            count += self._unlocker(due[start:start + self.batch_size], now)
+        self.unlocked += count
+        return count
+
+    def _reload(self, now: datetime) -> None:
+        pending = self._loader(now + timedelta(seconds=2 * self.reload_secs))
+        with self._lock:
+            self._deadlines = {hwid: unlock_time for hwid, unlock_time in pending}
+            self._heap = [(unlock_time, hwid) for hwid, unlock_time in self._deadlines.items()]
+            heapq.heapify(self._heap)
+        self._next_reload = now + timedelta(seconds=self.reload_secs)
+
+    def _sleep_secs(self) -> float:
+        with self._lock:
+            if not self._heap:
+                return self.tick_secs
+            until_due = (self._heap[0][0] - datetime.utcnow()).total_seconds()
+        return max(0.0, min(self.tick_secs, until_due))
+
+    def _ensure_thread(self) -> None:
+        self._thread.get()
+
+    def _start_thread(self) -> threading.Thread:
+        # A forked worker holds no lease and none of its parent's heap
+        with self._lock:
+            self._holder = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+            self._heap, self._deadlines, self.is_leader = [], {}, False
+            self._next_lease = None
+        return start_thread(self._run, 'unlock-scheduler')
+
+    def _run(self) -> None:
+        while True:
+            try:
+                with self._app.app_context():
+                    self.tick(datetime.utcnow())
+            except Exception as e:
+                logging.error(f"UNLOCK: Scheduler tick failed: {str(e)}")
+            self._wake.wait(self._sleep_secs())
+            self._wake.clear()
+
+    def stop(self) -> None:
+        """
+        Hand the lease on at shutdown rather than leaving it to expire
+        """
+        if self.is_leader and self._thread.started:
+            try:
+                with self._app.app_context():
+                    self._release(LEASE_NAME, self._holder)
+            except Exception as e:
+                logging.error(f"UNLOCK: Lease release failed: {str(e)}")
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"leader": self.is_leader, "pending": len(self._deadlines), "unlocked": self.unlocked}
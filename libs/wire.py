@@ -0,0 +1,222 @@
+"""
+Compact binary envelope for /api/register and /api/checkin, sent with Content-Type application/vnd.csafe.v1.
+It carries the same fields as the JSON bodies, but the signature, ciphertext and nonce are raw bytes rather
+than urlsafe base64, and there is no JSON to parse.  The encrypted message inside is unchanged.
+
+Every body starts with the 2-byte magic b'CS', a version byte and a kind byte, followed by length-prefixed
+fields (big-endian; u8 length for short fields, u16 for the rest):
+
+    Requests                                    Responses
+    0x01 RSA checkin  hwid(u8) sig(u16) msg(u16)    0x81 RSA      sig(u16) msg(u16)
+    0x02 Session      hwid(u8) nonce(u8) ct(u16)    0x82 Session  nonce(u8) ct(u16)
+    0x03 Register     hwid(u8) pkey(u16)            0x83 Key      key(u16) - PEM server public key
+                      - pkey is DER, not PEM        0xFF Error    error(u16) - UTF-8 text
+
+decode_request() returns the JSON-equivalent dict and encode_response() takes the dict a resource would
+return, so the resources handle both formats the same way - see request_body() and @negotiated.
+JSON remains the default for both directions
+"""
+from functools import wraps
+import base64
+import logging
+import struct
+import textwrap
+from typing import List, Tuple, Union
+
+from flask import Response, request
+
+CONTENT_TYPE = 'application/vnd.csafe.v1'
+MAGIC = b'CS'
+VERSION = 1
+
+RSA_CHECKIN = 0x01
+SESSION_CHECKIN = 0x02
+REGISTER = 0x03
+RSA_RESPONSE = 0x81
+SESSION_RESPONSE = 0x82
+KEY_RESPONSE = 0x83
+ERROR_RESPONSE = 0xFF
+
+# Field layout of each kind - (name, length prefix format, form in the JSON body: text, b64 or pem)
+LAYOUTS = {
+    RSA_CHECKIN: (('hwid', 'B', 'text'), ('sig', 'H', 'b64'), ('msg', 'H', 'b64')),
+    SESSION_CHECKIN: (('hwid', 'B', 'text'), ('nonce', 'B', 'b64'), ('ct', 'H', 'b64')),
+    REGISTER: (('hwid', 'B', 'text'), ('pkey', 'H', 'pem')),
+    RSA_RESPONSE: (('sig', 'H', 'b64'), ('msg', 'H', 'b64')),
+    SESSION_RESPONSE: (('nonce', 'B', 'b64'), ('ct', 'H', 'b64')),
+    KEY_RESPONSE: (('key', 'H', 'text'),),
+    ERROR_RESPONSE: (('error', 'H', 'text'),),
+}
+_HEADER = struct.Struct('>2sBB')
+
+
+class WireFormatError(ValueError):
+    pass
+
+
+def der_to_pem(der: bytes) -> str:
+    """
+    Wrap a DER SubjectPublicKeyInfo as the PEM text stored on SafeModel.public_key
+    """
+    body = '\n'.join(textwrap.wrap(base64.b64encode(der).decode('ascii'), 64))
+    return f"-----BEGIN PUBLIC KEY-----\n{body}\n-----END PUBLIC KEY-----\n"
+
+
+def pem_to_der(pem: str) -> bytes:
+    lines = [line for line in pem.strip().splitlines() if not line.startswith('-----')]
+    return base64.b64decode(''.join(lines))
+
+
+def pack(kind: int, values: List[bytes]) -> bytes:
+    """
+    Build a binary body from raw field values, in the order given by LAYOUTS[kind]
+    """
+    parts = [_HEADER.pack(MAGIC, VERSION, kind)]
+    for (name, prefix, _), value in zip(LAYOUTS[kind], values):
+        if len(value) >= 1 << (8 * struct.calcsize(prefix)):
+            raise WireFormatError(f"{name} too long for the binary format")
+        parts.append(struct.pack('>' + prefix, len(value)))
+        parts.append(value)
+    return b''.join(parts)
+
+
+def unpack(data: bytes) -> Tuple[int, List[bytes]]:
+    """
+    Split a binary body into its kind and raw field values
+    :raises WireFormatError: if the body is truncated, has trailing bytes or an unknown header
+    """
+    if len(data) < _HEADER.size:
+        raise WireFormatError("Body too short")
+    magic, version, kind = _HEADER.unpack_from(data)
+    if magic != MAGIC or version != VERSION or kind not in LAYOUTS:
+        raise WireFormatError("Unrecognised header")
+    offset = _HEADER.size
+    values = []
+    for name, prefix, _ in LAYOUTS[kind]:
+        size = struct.calcsize(prefix)
+        if offset + size > len(data):
+            raise WireFormatError(f"Truncated before {name}")
+        length, = struct.unpack_from('>' + prefix, data, offset)
+        offset += size
+        if offset + length > len(data):
+            raise WireFormatError(f"Truncated {name}")
+        values.append(data[offset:offset + length])
+        offset += length
+    if offset != len(data):
+        raise WireFormatError("Trailing bytes")
+    return kind, values
+
+
+def _to_json_form(kind: int, values: List[bytes]) -> dict:
+    body = {}
+    for (name, _, form), value in zip(LAYOUTS[kind], values):
+        if form == 'b64':
+            body[name] = base64.urlsafe_b64encode(value).decode('ascii')
+        elif form == 'pem':
+            body[name] = der_to_pem(value)
+        else:
+            body[name] = value.decode('utf-8')
+    return body
+
+
+def _from_json_form(kind: int, body: dict) -> List[bytes]:
+    values = []
+    for name, _, form in LAYOUTS[kind]:
+        value = body[name]
+        if isinstance(value, str):
+            if form == 'b64':
+                value = base64.urlsafe_b64decode(value)
+            elif form == 'pem':
+                value = pem_to_der(value)
+            else:
+                value = value.encode('utf-8')
+        values.append(value)
+    return values
+
+
+def decode_request(data: bytes) -> dict:
+    """
+    Decode a binary request body into the dict the JSON form of the request would give
+    :raises WireFormatError: if the body is malformed or is not a request
+    """
+    kind, values = unpack(data)
+    if kind not in (RSA_CHECKIN, SESSION_CHECKIN, REGISTER):
+        raise WireFormatError("Not a request")
+    try:
+        return _to_json_form(kind, values)
+    except UnicodeDecodeError:
+        raise WireFormatError("Invalid text field")
+
+
+def encode_request(body: dict) -> bytes:
+    """
+    Encode the JSON form of a checkin or register request - the safe side of decode_request()
+    """
+    if 'pkey' in body:
+        kind = REGISTER
+    else:
+        kind = SESSION_CHECKIN if 'nonce' in body else RSA_CHECKIN
+    return pack(kind, _from_json_form(kind, body))
+
+
+def response_kind(body: dict) -> int:
+    if 'error' in body:
+        return ERROR_RESPONSE
+    if 'nonce' in body:
+        return SESSION_RESPONSE
+    if 'key' in body:
+        return KEY_RESPONSE
+    return RSA_RESPONSE
+
+
+def encode_response(body: dict) -> bytes:
+    """
+    Encode the dict a resource returns - error, RSA, session or server key response
+    """
+    kind = response_kind(body)
+    return pack(kind, _from_json_form(kind, body))
+
+
+def decode_response(data: bytes) -> dict:
+    """
+    Decode a binary response into its JSON form - the safe side of encode_response()
+    """
+    kind, values = unpack(data)
+    if kind not in (RSA_RESPONSE, SESSION_RESPONSE, KEY_RESPONSE, ERROR_RESPONSE):
+        raise WireFormatError("Not a response")
+    return _to_json_form(kind, values)
+
+
+def wants_binary() -> bool:
+    """
+    True if the current request is binary, or asks for a binary response in preference to JSON
+    """
+    return request.mimetype == CONTENT_TYPE or \
+        request.accept_mimetypes.best_match(['application/json', CONTENT_TYPE]) == CONTENT_TYPE
+
+
+def request_body() -> Union[dict, None]:
+    """
+    The current request body as a dict, from either format - None if a binary body is malformed
+    """
+    if request.mimetype != CONTENT_TYPE:
+        return request.get_json()
+    try:
+        return decode_request(request.get_data())
+    except WireFormatError as e:
+        logging.info(f"Malformed binary request: {e}")
+        return None
+
+
+def negotiated(func):
+    """
+    Decorator for a resource method returning (dict, status) - sends the dict in the binary format when the
+    request was binary or the client prefers it
+    """
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        body, status = func(*args, **kwargs)
+        if wants_binary():
+            return Response(encode_response(body), status=status, mimetype=CONTENT_TYPE)
+        return body, status
+    return wrapper
@@ -10,6 +10,8 @@ USER_ACTIVATED = "User {} has ben activated"
 CREATED = "'{}' has been created"
 DELETED = "'{}' has been deleted"
 INVALID_PASSWORD = "Invalid credentials"
+HASHING_BUSY = "The server is busy - please try again shortly"
+TOO_MANY_REQUESTS = "Too many attempts - please wait and try again"
 OWN_RECORD_ONLY = "You are only permitted to delete your own record"
 NOT_CONFIRMED = "You have not confirmed your ID. Check your email - <{}>"
 FAILED_TO_MAIL = (
@@ -113,6 +115,8 @@ RESEND_FAILED = 'Failed to resend confirmation mail.  Problem with the Mailgun s
 # Safe message
 SAFE_REGISTRATION_ERROR = "Registration error"
 SAFE_CHECKIN_ERROR = "Checkin error"
+SAFE_SESSION_EXPIRED = "Session key expired or not negotiated"
+SAFE_BATCH_TOO_LARGE = "Batch checkin is limited to {} safes"
 
 # Operations messages
 CLAIM_NO_SAFE = "That safe does not exist"
@@ -0,0 +1,28 @@
+"""Add safe session key columns
+
+Revision ID: 3f1c9a2b7d10
+Revises: 
+Create Date: 2026-10-18 10:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3f1c9a2b7d10'
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('safe') as batch_op:
+        batch_op.add_column(sa.Column('session_key', sa.LargeBinary(length=32), nullable=True))
+        batch_op.add_column(sa.Column('session_expires', sa.DateTime(), nullable=True))
+
+
+def downgrade():
+    with op.batch_alter_table('safe') as batch_op:
+        batch_op.drop_column('session_expires')
+        batch_op.drop_column('session_key')
@@ -0,0 +1,25 @@
+"""Index safe events by safe, event code and time
+
+Revision ID: 5e8a0c3f9d47
+Revises: c4d7e9a1b258
+Create Date: 2026-10-18 11:30:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5e8a0c3f9d47'
+down_revision = 'c4d7e9a1b258'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index('ix_safe_event_hardware_id_event_code_timestamp', 'safe_event',
+                    ['hardware_id', 'event_code', 'timestamp'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_safe_event_hardware_id_event_code_timestamp', table_name='safe_event')
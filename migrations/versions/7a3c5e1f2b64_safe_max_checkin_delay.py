@@ -0,0 +1,26 @@
+"""Add keyholder limit on how long the server may defer a safe's checkin
+
+Revision ID: 7a3c5e1f2b64
+Revises: d2f6a8b3c519
+Create Date: 2026-10-18 15:20:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '7a3c5e1f2b64'
+down_revision = 'd2f6a8b3c519'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('safe', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('max_checkin_delay', sa.Integer(), nullable=True))
+
+
+def downgrade():
+    with op.batch_alter_table('safe', schema=None) as batch_op:
+        batch_op.drop_column('max_checkin_delay')
@@ -0,0 +1,26 @@
+"""Add safe settings version
+
+Revision ID: 8b2e4d6f0a31
+Revises: 3f1c9a2b7d10
+Create Date: 2026-10-18 10:30:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8b2e4d6f0a31'
+down_revision = '3f1c9a2b7d10'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('safe') as batch_op:
+        batch_op.add_column(sa.Column('settings_version', sa.Integer(), server_default='0', nullable=False))
+
+
+def downgrade():
+    with op.batch_alter_table('safe') as batch_op:
+        batch_op.drop_column('settings_version')
@@ -0,0 +1,30 @@
+"""Record the algorithm and iteration count of each user's password hash
+
+Revision ID: 9c4e2a7d1f83
+Revises: 7a3c5e1f2b64
+Create Date: 2026-10-18 16:30:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '9c4e2a7d1f83'
+down_revision = '7a3c5e1f2b64'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Existing hashes were all made with PBKDF2-SHA256 at 100,000 iterations
+    with op.batch_alter_table('users', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('pw_algorithm', sa.String(length=20), nullable=False,
+                                      server_default='pbkdf2_sha256'))
+        batch_op.add_column(sa.Column('pw_iterations', sa.Integer(), nullable=False, server_default='100000'))
+
+
+def downgrade():
+    with op.batch_alter_table('users', schema=None) as batch_op:
+        batch_op.drop_column('pw_iterations')
+        batch_op.drop_column('pw_algorithm')
@@ -0,0 +1,48 @@
+"""Registry of active relationships, one per safe
+
+Revision ID: a4c2e7f5d913
+Revises: f1a6c8e4b372
+Create Date: 2026-10-18 20:05:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a4c2e7f5d913'
+down_revision = 'f1a6c8e4b372'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('active_relationship',
+    sa.Column('safe_id', sa.String(length=64), nullable=False),
+    sa.Column('relationship_id', sa.Integer(), nullable=False),
+    sa.Column('keyholder_id', sa.Integer(), nullable=False),
+    sa.Column('safeholder_id', sa.Integer(), nullable=False),
+    sa.ForeignKeyConstraint(['keyholder_id'], ['users.id'], name=op.f('fk_active_relationship_keyholder_id_users')),
+    sa.ForeignKeyConstraint(['relationship_id'], ['relationship.id'],
+                            name=op.f('fk_active_relationship_relationship_id_relationship')),
+    sa.ForeignKeyConstraint(['safe_id'], ['safe.hardware_id'], name=op.f('fk_active_relationship_safe_id_safe')),
+    sa.ForeignKeyConstraint(['safeholder_id'], ['users.id'], name=op.f('fk_active_relationship_safeholder_id_users')),
+    sa.PrimaryKeyConstraint('safe_id', name=op.f('pk_active_relationship')),
+    sa.UniqueConstraint('keyholder_id', 'safe_id', name=op.f('uq_active_relationship_keyholder_id')),
+    sa.UniqueConstraint('relationship_id', name=op.f('uq_active_relationship_relationship_id'))
+    )
+    # Where a safe has several relationships without an end date, only the latest is live - end the older ones
+    # on the day it started, so nothing else goes on treating them as active.  Not undone on downgrade
+    op.execute("UPDATE relationship SET end_date = (SELECT latest.start_date FROM relationship latest "
+               "WHERE latest.id = (SELECT MAX(r.id) FROM relationship r "
+               "WHERE r.safe_id = relationship.safe_id AND r.end_date IS NULL)) "
+               "WHERE end_date IS NULL AND id NOT IN "
+               "(SELECT MAX(id) FROM relationship WHERE end_date IS NULL GROUP BY safe_id)")
+    # Register the relationships without an end date
+    op.execute("INSERT INTO active_relationship (safe_id, relationship_id, keyholder_id, safeholder_id) "
+               "SELECT r.safe_id, r.id, r.keyholder_id, r.safeholder_id FROM relationship r "
+               "WHERE r.id IN (SELECT MAX(id) FROM relationship WHERE end_date IS NULL GROUP BY safe_id)")
+
+
+def downgrade():
+    op.drop_table('active_relationship')
@@ -0,0 +1,89 @@
+"""Add safe event rollups and partition safe_event by month on PostgreSQL
+
+Revision ID: c4d7e9a1b258
+Revises: 8b2e4d6f0a31
+Create Date: 2026-10-18 11:00:00.000000
+
+"""
+from datetime import date
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c4d7e9a1b258'
+down_revision = '8b2e4d6f0a31'
+branch_labels = None
+depends_on = None
+
+
+def month_start(day, months_ahead=0):
+    month = day.month - 1 + months_ahead
+    return date(day.year + month // 12, month % 12 + 1, 1)
+
+
+def upgrade():
+    op.create_table('safe_event_rollup',
+                    sa.Column('hardware_id', sa.String(length=64), nullable=False),
+                    sa.Column('day', sa.Date(), nullable=False),
+                    sa.Column('event_code', sa.Integer(), nullable=False),
+                    sa.Column('count', sa.Integer(), nullable=False),
+                    sa.Column('first_timestamp', sa.DateTime(), nullable=False),
+                    sa.Column('last_timestamp', sa.DateTime(), nullable=False),
+                    sa.ForeignKeyConstraint(['hardware_id'], ['safe.hardware_id'],
+                                            name=op.f('fk_safe_event_rollup_hardware_id_safe')),
+                    sa.PrimaryKeyConstraint('hardware_id', 'day', 'event_code', name=op.f('pk_safe_event_rollup'))
+                    )
+
+    bind = op.get_bind()
+    if bind.dialect.name != 'postgresql':
+        return
+    # Rebuild safe_event as a table partitioned by month, with partitions covering the existing rows,
+    # this month and the next two.  libs/retention.py keeps partitions created ahead and drops expired ones
+    op.execute("ALTER TABLE safe_event RENAME TO safe_event_unpartitioned")
+    op.execute("ALTER TABLE safe_event_unpartitioned RENAME CONSTRAINT pk_safe_event TO pk_safe_event_unpartitioned")
+    op.execute("ALTER TABLE safe_event_unpartitioned "
+               "RENAME CONSTRAINT fk_safe_event_hardware_id_safe TO fk_safe_event_unpartitioned_hardware_id_safe")
+    op.execute("CREATE TABLE safe_event ("
+               "hardware_id VARCHAR(64) NOT NULL, "
+               "timestamp TIMESTAMP WITHOUT TIME ZONE NOT NULL, "
+               "event_code INTEGER NOT NULL, "
+               "detail VARCHAR(40) NOT NULL, "
+               "CONSTRAINT pk_safe_event PRIMARY KEY (hardware_id, timestamp), "
+               "CONSTRAINT fk_safe_event_hardware_id_safe FOREIGN KEY (hardware_id) REFERENCES safe (hardware_id)"
+               ") PARTITION BY RANGE (timestamp)")
+    oldest = bind.execute(sa.text("SELECT min(timestamp) FROM safe_event_unpartitioned")).scalar()
+    start = month_start(oldest.date() if oldest else date.today())
+    end = month_start(date.today(), 3)
+    while start < end:
+        op.execute(f"CREATE TABLE safe_event_p{start:%Y%m} PARTITION OF safe_event "
+                   f"FOR VALUES FROM ('{start}') TO ('{month_start(start, 1)}')")
+        start = month_start(start, 1)
+    # Rows outside every monthly partition - libs.retention.ensure_partitions moves them out as their month is created
+    op.execute("CREATE TABLE safe_event_default PARTITION OF safe_event DEFAULT")
+    op.execute("INSERT INTO safe_event SELECT hardware_id, timestamp, event_code, detail "
+               "FROM safe_event_unpartitioned")
+    op.execute("DROP TABLE safe_event_unpartitioned")
+
+
+def downgrade():
+    bind = op.get_bind()
+    if bind.dialect.name == 'postgresql':
+        op.execute("ALTER TABLE safe_event RENAME TO safe_event_partitioned")
+        op.execute("ALTER TABLE safe_event_partitioned RENAME CONSTRAINT pk_safe_event TO pk_safe_event_partitioned")
+        op.execute("ALTER TABLE safe_event_partitioned "
+                   "RENAME CONSTRAINT fk_safe_event_hardware_id_safe TO fk_safe_event_partitioned_hardware_id_safe")
+        op.create_table('safe_event',
+                        sa.Column('hardware_id', sa.String(length=64), nullable=False),
+                        sa.Column('timestamp', sa.DateTime(), nullable=False),
+                        sa.Column('event_code', sa.Integer(), nullable=False),
+                        sa.Column('detail', sa.String(length=40), nullable=False),
+                        sa.ForeignKeyConstraint(['hardware_id'], ['safe.hardware_id'],
+                                                name=op.f('fk_safe_event_hardware_id_safe')),
+                        sa.PrimaryKeyConstraint('hardware_id', 'timestamp', name=op.f('pk_safe_event'))
+                        )
+        op.execute("INSERT INTO safe_event SELECT hardware_id, timestamp, event_code, detail "
+                   "FROM safe_event_partitioned")
+        op.execute("DROP TABLE safe_event_partitioned CASCADE")
+    op.drop_table('safe_event_rollup')
@@ -0,0 +1,25 @@
+"""Index relationship messages for keyset pagination
+
+Revision ID: c8e1d5a7f296
+Revises: a4c2e7f5d913
+Create Date: 2026-10-18 20:40:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c8e1d5a7f296'
+down_revision = 'a4c2e7f5d913'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index('ix_relationship_message_relationship_id_message_timestamp_id', 'relationship_message',
+                    ['relationship_id', 'message_timestamp', 'id'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_relationship_message_relationship_id_message_timestamp_id', table_name='relationship_message')
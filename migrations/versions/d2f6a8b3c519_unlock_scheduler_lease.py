@@ -0,0 +1,34 @@
+"""Lease table for the unlock scheduler and index on safe unlock_time
+
+Revision ID: d2f6a8b3c519
+Revises: 5e8a0c3f9d47
+Create Date: 2026-10-18 14:10:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd2f6a8b3c519'
+down_revision = '5e8a0c3f9d47'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('lease',
+    sa.Column('name', sa.String(length=40), nullable=False),
+    sa.Column('holder', sa.String(length=120), nullable=False),
+    sa.Column('expires_at', sa.DateTime(), nullable=False),
+    sa.PrimaryKeyConstraint('name', name=op.f('pk_lease'))
+    )
+    with op.batch_alter_table('safe', schema=None) as batch_op:
+        batch_op.create_index(batch_op.f('ix_safe_unlock_time'), ['unlock_time'], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('safe', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_safe_unlock_time'))
+
+    op.drop_table('lease')
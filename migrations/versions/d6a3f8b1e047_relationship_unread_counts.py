@@ -0,0 +1,32 @@
+"""Unread message counts per relationship and side
+
+Revision ID: d6a3f8b1e047
+Revises: c8e1d5a7f296
+Create Date: 2026-10-18 21:10:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd6a3f8b1e047'
+down_revision = 'c8e1d5a7f296'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('relationship', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('unread_by_kh', sa.Integer(), server_default='0', nullable=False))
+        batch_op.add_column(sa.Column('unread_by_sh', sa.Integer(), server_default='0', nullable=False))
+    # Count the messages each side has not seen so far
+    for side in ('kh', 'sh'):
+        op.execute(f"UPDATE relationship SET unread_by_{side} = (SELECT COUNT(*) FROM relationship_message m "
+                   f"WHERE m.relationship_id = relationship.id AND m.seen_by_{side} IS NULL)")
+
+
+def downgrade():
+    with op.batch_alter_table('relationship', schema=None) as batch_op:
+        batch_op.drop_column('unread_by_sh')
+        batch_op.drop_column('unread_by_kh')
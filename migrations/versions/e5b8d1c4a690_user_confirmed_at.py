@@ -0,0 +1,48 @@
+"""Denormalise confirmation state onto users and index confirmations by user and expiry
+
+Revision ID: e5b8d1c4a690
+Revises: 9c4e2a7d1f83
+Create Date: 2026-10-18 17:40:00.000000
+
+"""
+from datetime import datetime
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e5b8d1c4a690'
+down_revision = '9c4e2a7d1f83'
+branch_labels = None
+depends_on = None
+
+CONFIRMATION_EXPIRATION_DELTA = 1800  # As in models/confirmation.py
+
+
+def upgrade():
+    with op.batch_alter_table('users', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('confirmed_at', sa.DateTime(), nullable=True))
+    op.create_index('ix_confirmations_user_id_expire_at', 'confirmations', ['user_id', 'expire_at'], unique=False)
+
+    # Backfill from confirmed confirmations.  The time of confirmation was never stored, so use the time the
+    # confirmation was issued - its expiry less the link lifetime
+    users = sa.table('users', sa.column('id', sa.Integer), sa.column('confirmed_at', sa.DateTime))
+    confirmations = sa.table('confirmations', sa.column('user_id', sa.Integer), sa.column('expire_at', sa.Integer),
+                             sa.column('confirmed', sa.Boolean))
+    bind = op.get_bind()
+    rows = bind.execute(sa.select([confirmations.c.user_id, sa.func.max(confirmations.c.expire_at)])
+                        .where(confirmations.c.confirmed == sa.true())
+                        .group_by(confirmations.c.user_id)).fetchall()
+    if rows:
+        bind.execute(users.update().where(users.c.id == sa.bindparam('uid'))
+                     .values(confirmed_at=sa.bindparam('confirmed_at')),
+                     [{"uid": user_id, "confirmed_at": datetime.utcfromtimestamp(expire_at -
+                                                                              CONFIRMATION_EXPIRATION_DELTA)}
+                      for user_id, expire_at in rows])
+
+
+def downgrade():
+    op.drop_index('ix_confirmations_user_id_expire_at', table_name='confirmations')
+    with op.batch_alter_table('users', schema=None) as batch_op:
+        batch_op.drop_column('confirmed_at')
@@ -0,0 +1,26 @@
+"""Add the timestamp of each safe's last accepted session handshake
+
+Revision ID: e9f2b6d4a183
+Revises: d6a3f8b1e047
+Create Date: 2026-10-18 21:40:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e9f2b6d4a183'
+down_revision = 'd6a3f8b1e047'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('safe', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('session_requested', sa.DateTime(), nullable=True))
+
+
+def downgrade():
+    with op.batch_alter_table('safe', schema=None) as batch_op:
+        batch_op.drop_column('session_requested')
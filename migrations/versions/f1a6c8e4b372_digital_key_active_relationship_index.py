@@ -0,0 +1,30 @@
+"""Unique index on safe digital_key and index on active relationships by safe
+
+Revision ID: f1a6c8e4b372
+Revises: b7d3f9e2c845
+Create Date: 2026-10-18 19:20:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f1a6c8e4b372'
+down_revision = 'b7d3f9e2c845'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Digital keys are random UUIDs, so existing rows should not collide - the upgrade fails if they do
+    with op.batch_alter_table('safe', schema=None) as batch_op:
+        batch_op.create_index(batch_op.f('ix_safe_digital_key'), ['digital_key'], unique=True)
+    op.create_index('ix_relationship_safe_id_active', 'relationship', ['safe_id'], unique=False,
+                    postgresql_where=sa.text('end_date IS NULL'), sqlite_where=sa.text('end_date IS NULL'))
+
+
+def downgrade():
+    op.drop_index('ix_relationship_safe_id_active', table_name='relationship')
+    with op.batch_alter_table('safe', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_safe_digital_key'))
@@ -1,5 +1,6 @@
 from time import time
 from uuid import uuid4
+from sqlalchemy.sql import expression
 
 from db import db
 
@@ -8,6 +9,9 @@ CONFIRMATION_EXPIRATION_DELTA = 1800  # 30 minutes
 
 class ConfirmationModel(db.Model):
     __tablename__ = 'confirmations'
+    __table_args__ = (
+        db.Index('ix_confirmations_user_id_expire_at', 'user_id', 'expire_at'),
+    )
 
     id = db.Column(db.String(80), primary_key=True)
     expire_at = db.Column(db.Integer, nullable=False)
@@ -26,6 +30,23 @@ class ConfirmationModel(db.Model):
     def find_by_id(cls, _id: str) -> "ConfirmationModel":
         return cls.query.filter_by(id=_id).first()
 
+    @classmethod
+    def purge_expired_batch(cls, expired_before: int, batch_size: int) -> int:
+        """
+        Delete up to batch_size unconfirmed confirmations that expired before the given time, in one transaction
+        :param expired_before: Epoch seconds
+        :param batch_size: Rows per batch
+        :return: number of rows deleted - 0 when none are left
+        """
+        ids = [row[0] for row in db.session.query(cls.id).filter(cls.confirmed == expression.false(),
+                                                                 cls.expire_at < expired_before
+                                                                 ).limit(batch_size).all()]
+        if not ids:
+            return 0
+        deleted = cls.query.filter(cls.id.in_(ids)).delete(synchronize_session=False)
+        db.session.commit()
+        return deleted
+
     @property
     def expired(self) -> bool:
         return time() > self.expire_at
@@ -0,0 +1,54 @@
+from datetime import datetime, timedelta
+from sqlalchemy import or_
+from sqlalchemy.exc import IntegrityError
+
+from db import db
+
+
+class LeaseModel(db.Model):
+    """
+    Named, time-limited leases - lets one of several server processes take a job such as the unlock scheduler.
+    A lease is held until expires_at and must be renewed by its holder before then
+    """
+    __tablename__ = "lease"
+
+    name = db.Column(db.String(40), primary_key=True)
+    holder = db.Column(db.String(120), nullable=False)
+    expires_at = db.Column(db.DateTime(), nullable=False)
+
+    @classmethod
+    def acquire(cls, name: str, holder: str, seconds: float) -> bool:
+        """
+        Take or renew a lease - succeeds if the lease is free, expired or already held by this holder
+        :param name: Lease name
+        :param holder: Identity of the process asking
+        :param seconds: How long the lease is held for
+        :return: True if holder now holds the lease
+        """
+        now = datetime.utcnow()
+        expires_at = now + timedelta(seconds=seconds)
+        updated = cls.query.filter(cls.name == name, or_(cls.holder == holder, cls.expires_at < now)
+                                   ).update({"holder": holder, "expires_at": expires_at}, synchronize_session=False)
+        if updated:
+            db.session.commit()
+            return True
+        if cls.query.get(name) is not None:
+            db.session.rollback()
+            return False
+        try:
+            db.session.add(cls(name=name, holder=holder, expires_at=expires_at))
+            db.session.commit()
+        except IntegrityError:
+            # Another process created it first
+            db.session.rollback()
+            return False
+        return True
+
+    @classmethod
+    def release(cls, name: str, holder: str) -> None:
+        """
+        Give up a lease early, if holder still holds it
+        """
+        cls.query.filter_by(name=name, holder=holder).update({"expires_at": datetime.utcnow()},
+                                                             synchronize_session=False)
+        db.session.commit()
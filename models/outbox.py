@@ -0,0 +1,116 @@
+from datetime import datetime, timedelta
+from typing import List, Tuple, Union
+from uuid import uuid4
+import json
+
+from sqlalchemy import bindparam
+
+from db import db
+from libs.mailgun import Mailgun
+from libs.outbox import MailSender, OutboxMessage, TEMPLATES
+
+mail_sender = MailSender()
+
+
+class OutboxModel(db.Model):
+    """
+    Emails waiting to be sent, or recently sent, by the mail sender.  A row is pending until sent, or failed
+    once it has run out of attempts.  A pending row is due at next_attempt_at - claiming a row pushes that out
+    by the claim time and marks it with the claim, so only one sender takes it
+    """
+    __tablename__ = "email_outbox"
+    __table_args__ = (
+        db.Index('ix_email_outbox_status_next_attempt_at', 'status', 'next_attempt_at'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    template = db.Column(db.String(40), nullable=False)
+    to_email = db.Column(db.String(80), nullable=False)
+    variables = db.Column(db.Text, nullable=False)  # JSON
+    status = db.Column(db.String(10), nullable=False, default='pending')  # pending, sent or failed
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    created_at = db.Column(db.DateTime(), nullable=False)
+    next_attempt_at = db.Column(db.DateTime(), nullable=False)
+    claimed_by = db.Column(db.String(40), nullable=True)
+    sent_at = db.Column(db.DateTime(), nullable=True)
+    last_error = db.Column(db.String(500), nullable=True)
+
+    @classmethod
+    def enqueue(cls, template: str, to_email: str, variables: dict) -> "OutboxModel":
+        """
+        Queue an email for the mail sender, committing the session
+        :param template: A key of libs.outbox.TEMPLATES
+        :param to_email: Recipient address
+        :param variables: Values for the template's placeholders
+        :raises MailGunException: if mail is not configured, so the caller can fail as it would have on sending
+        """
+        if template not in TEMPLATES:
+            raise ValueError(f"Unknown email template {template}")
+        Mailgun.check_config()
+        now = datetime.utcnow()
+        message = cls(template=template, to_email=to_email, variables=json.dumps(variables), status='pending',
+                      attempts=0, created_at=now, next_attempt_at=now)
+        db.session.add(message)
+        db.session.commit()
+        mail_sender.notify()
+        return message
+
+    @classmethod
+    def claim_due(cls, now: datetime, limit: int, claim_secs: float) -> List[OutboxMessage]:
+        """
+        Claim up to limit due messages, oldest first, for claim_secs
+        """
+        ids = [row[0] for row in db.session.query(cls.id).filter(cls.status == 'pending', cls.next_attempt_at <= now
+                                                                 ).order_by(cls.next_attempt_at).limit(limit).all()]
+        if not ids:
+            db.session.rollback()
+            return []
+        claim = uuid4().hex
+        # Rows another sender claimed since the SELECT no longer match
+        cls.query.filter(cls.id.in_(ids), cls.status == 'pending', cls.next_attempt_at <= now).update(
+            {"claimed_by": claim, "next_attempt_at": now + timedelta(seconds=claim_secs)},
+            synchronize_session=False)
+        db.session.commit()
+        rows = db.session.query(cls.id, cls.template, cls.to_email, cls.variables, cls.attempts).filter(
+            cls.id.in_(ids), cls.claimed_by == claim).all()
+        db.session.rollback()
+        return [OutboxMessage(_id, template, to_email, json.loads(variables), attempts)
+                for _id, template, to_email, variables, attempts in rows]
+
+    @classmethod
+    def record_results(cls, sent: List[int], failed: List[Tuple[int, Union[datetime, None], str]],
+                       now: datetime) -> None:
+        """
+        :param sent: Ids of messages sent
+        :param failed: (id, next attempt time - None if given up, error) for each message not sent
+        :param now: Time of sending
+        """
+        if sent:
+            cls.query.filter(cls.id.in_(sent)).update(
+                {"status": 'sent', "sent_at": now, "claimed_by": None, "attempts": cls.attempts + 1},
+                synchronize_session=False)
+        if failed:
+            table = cls.__table__
+            statement = table.update().where(table.c.id == bindparam('_id')).values(
+                attempts=table.c.attempts + 1, claimed_by=None, status=bindparam('_status'),
+                next_attempt_at=bindparam('_retry_at'), last_error=bindparam('_error'))
+            db.session.execute(statement, [{"_id": _id, "_status": 'failed' if retry_at is None else 'pending',
+                                            "_retry_at": retry_at or now, "_error": error[:500]}
+                                           for _id, retry_at, error in failed])
+        db.session.commit()
+
+    @classmethod
+    def purge_sent(cls, sent_before: datetime, batch_size: int = 1000) -> int:
+        """
+        Delete messages sent before the given time, in batches
+        :return: number of rows deleted
+        """
+        total = 0
+        while True:
+            ids = [row[0] for row in db.session.query(cls.id).filter(cls.status == 'sent', cls.sent_at < sent_before
+                                                                     ).limit(batch_size).all()]
+            if not ids:
+                db.session.rollback()
+                return total
+            total += cls.query.filter(cls.id.in_(ids)).delete(synchronize_session=False)
+            db.session.commit()
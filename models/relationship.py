@@ -1,16 +1,34 @@
-from requests import Response
 from sqlalchemy.sql import expression
-from sqlalchemy import and_, or_, not_
-from typing import List, Union
+from sqlalchemy import and_, or_, not_, text, case
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import aliased
+from datetime import date, datetime
+from typing import List, NamedTuple, Union
 
 from db import db
+from libs.event_hub import EventHub
 from models.user import UserModel
-import messages.en as msgs
-from libs.mailgun import Mailgun
+from models.safe import SafeModel
+from models.outbox import OutboxModel
+
+# New messages and status changes for the relationships' event streams - see resources.operations.MessageStream
+relationship_events = EventHub()
+
+
+class ActiveRelationship(NamedTuple):
+    relationship_id: int
+    safe_id: str
+    keyholder_id: int
+    safeholder_id: int
 
 
 class RelationshipModel(db.Model):
     __tablename__ = "relationship"
+    __table_args__ = (
+        # Only active relationships are looked up by safe - keep the ended history out of the index
+        db.Index('ix_relationship_safe_id_active', 'safe_id', postgresql_where=text('end_date IS NULL'),
+                 sqlite_where=text('end_date IS NULL')),
+    )
 
     id = db.Column(db.Integer, primary_key=True)
     keyholder_id = db.Column(db.Integer, db.ForeignKey("users.id"), nullable=False)
@@ -18,6 +36,9 @@ class RelationshipModel(db.Model):
     safe_id = db.Column(db.String(64), db.ForeignKey("safe.hardware_id"), nullable=False)
     start_date = db.Column(db.Date, nullable=False)
     end_date = db.Column(db.Date, nullable=True)
+    # Messages each side has not seen yet - kept in step by RelationshipMessageModel.send and mark_read
+    unread_by_kh = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    unread_by_sh = db.Column(db.Integer, nullable=False, default=0, server_default='0')
 
     safeholder = db.relationship("UserModel", backref='safeholder', foreign_keys=[safeholder_id])
     keyholder = db.relationship("UserModel", backref='keyholder', foreign_keys=[keyholder_id])
@@ -37,33 +58,58 @@ class RelationshipModel(db.Model):
         db.session.delete(self)
         db.session.commit()
 
-    def send_relationship_email(self, status: str) -> Union[Response, None]:
+    def start(self) -> None:
+        """
+        Save a new relationship and register it as its safe's active relationship, in one transaction
+        :raises IntegrityError: if the safe already has an active relationship - the session is rolled back
+        """
+        db.session.add(self)
+        try:
+            db.session.flush()
+            db.session.add(ActiveRelationshipModel(safe_id=self.safe_id, relationship_id=self.id,
+                                                   keyholder_id=self.keyholder_id, safeholder_id=self.safeholder_id))
+            db.session.commit()
+        except IntegrityError:
+            db.session.rollback()
+            raise
+
+    def end(self, end_date: date) -> None:
+        """
+        End the relationship and remove it from the registry, in one transaction.  Commits any other pending
+        changes in the session with it
+        """
+        self.end_date = end_date
+        db.session.add(self)
+        ActiveRelationshipModel.query.filter_by(relationship_id=self.id).delete(synchronize_session=False)
+        db.session.commit()
+        relationship_events.publish(self.channel, 'status', self.status())
+
+    @property
+    def channel(self) -> str:
+        """
+        The relationship's channel on relationship_events
+        """
+        return f"relationship:{self.id}"
+
+    def status(self) -> dict:
+        return {"relationship_id": self.id,
+                "active": self.end_date is None,
+                "end_date": self.end_date.isoformat() if self.end_date else None}
+
+    def send_relationship_email(self, status: str) -> Union[OutboxModel, None]:
         """
-        Send an email to the Safeholder on start of stop of a new relationship.
+        Queue an email to the Safeholder on start of stop of a new relationship.
         status='start' for a new relationship, 'end' for a termination
         """
         if status == 'start':
-            return Mailgun.send_email(from_email=msgs.FROM_EMAIL,
-                                      from_title=msgs.FROM_TITLE,
-                                      to_email=[self.safeholder.email],
-                                      subject=msgs.RELATIONSHIP_MAIL_SUBJECT,
-                                      text=msgs.RELATIONSHIP_START_MAIL_BODY.format(name=self.safeholder.username,
-                                                                                    kh_displayname=self.keyholder.displayname),
-                                      html=msgs.RELATIONSHIP_START_MAIL_BODY_HTML.format(name=self.safeholder.username,
-                                                                                         kh_displayname=self.keyholder.displayname)
-                                      )
+            return OutboxModel.enqueue('relationship_start', self.safeholder.email,
+                                       {"name": self.safeholder.username,
+                                        "kh_displayname": self.keyholder.displayname})
         if status == 'end':
-            return Mailgun.send_email(from_email=msgs.FROM_EMAIL,
-                                      from_title=msgs.FROM_TITLE,
-                                      to_email=[self.safeholder.email],
-                                      subject=msgs.RELATIONSHIP_MAIL_SUBJECT,
-                                      text=msgs.RELATIONSHIP_END_MAIL_BODY.format(name=self.safeholder.username,
-                                                                                  kh_displayname=self.keyholder.displayname,
-                                                                                  digital_key=self.safe.digital_key),
-                                      html=msgs.RELATIONSHIP_END_MAIL_BODY_HTML.format(name=self.safeholder.username,
-                                                                                       kh_displayname=self.keyholder.displayname,
-                                                                                       digital_key=self.safe.digital_key)
-                                      )
+            return OutboxModel.enqueue('relationship_end', self.safeholder.email,
+                                       {"name": self.safeholder.username,
+                                        "kh_displayname": self.keyholder.displayname,
+                                        "digital_key": self.safe.digital_key})
 
     @classmethod
     def find_by_id(cls, _id) -> "RelationshipModel":
@@ -81,6 +127,14 @@ class RelationshipModel(db.Model):
     def find_by_safe_id(cls, _safe_id: int) -> List["RelationshipModel"]:
         return cls.query.filter_by(safe_id=_safe_id).all()
 
+    @classmethod
+    def find_active_by_safe_id(cls, _safe_id: str, **filters) -> "RelationshipModel":
+        """
+        The safe's current relationship, if it has one
+        :param filters: Further column values it must have, e.g. keyholder_id
+        """
+        return cls.query.filter(and_(cls.safe_id == _safe_id, cls.end_date == None)).filter_by(**filters).first()
+
     @classmethod
     def find_all(cls) -> List["RelationshipModel"]:
         """
@@ -95,9 +149,91 @@ class RelationshipModel(db.Model):
         """
         return cls.query.filter(and_(cls.end_date == None, or_(cls.safeholder_id == _id, cls.keyholder_id == _id))).all()
 
+    @classmethod
+    def find_summary_rows(cls, _id: int) -> List[tuple]:
+        """
+        Everything SafeSummary shows, in one query - each safe the user owns or is in an active relationship for,
+        with its active relationship (if any) and the displaynames involved
+        :return: list of (hardware_id, hinge_closed, lid_closed, bolt_engaged, safe owner's displayname,
+                 relationship safeholder_id, relationship keyholder_id, safeholder displayname,
+                 keyholder displayname), relationship columns None when the safe has no active relationship
+        """
+        owner, safeholder, keyholder = aliased(UserModel), aliased(UserModel), aliased(UserModel)
+        return db.session.query(
+            SafeModel.hardware_id, SafeModel.hinge_closed, SafeModel.lid_closed, SafeModel.bolt_engaged,
+            owner.displayname, cls.safeholder_id, cls.keyholder_id, safeholder.displayname, keyholder.displayname
+        ).select_from(SafeModel).outerjoin(
+            cls, and_(cls.safe_id == SafeModel.hardware_id, cls.end_date == None)
+        ).outerjoin(owner, owner.id == SafeModel.safeholder_id
+        ).outerjoin(safeholder, safeholder.id == cls.safeholder_id
+        ).outerjoin(keyholder, keyholder.id == cls.keyholder_id
+        ).filter(or_(cls.safeholder_id == _id, cls.keyholder_id == _id, SafeModel.safeholder_id == _id)
+        ).order_by(cls.id, SafeModel.hardware_id).all()
+
+    @classmethod
+    def find_unread_counts(cls, _id: int) -> List[tuple]:
+        """
+        Unread message badges for all the user's relationships, in one query - every active relationship, and any
+        ended one still holding messages the user has not seen
+        :return: list of (relationship id, safe_id, end_date, 'safeholder' or 'keyholder', messages unread by the user)
+        """
+        is_safeholder = cls.safeholder_id == _id
+        unread = case([(is_safeholder, cls.unread_by_sh)], else_=cls.unread_by_kh)
+        role = case([(is_safeholder, 'safeholder')], else_='keyholder')
+        return db.session.query(cls.id, cls.safe_id, cls.end_date, role, unread).filter(
+            or_(is_safeholder, cls.keyholder_id == _id), or_(cls.end_date == None, unread > 0)
+        ).order_by(cls.id).all()
+
+
+class ActiveRelationshipModel(db.Model):
+    """
+    Registry of active relationships - one row per safe in a relationship, so the primary key allows only one
+    active relationship per safe.  Written only by RelationshipModel.start and end, in the same transaction as
+    the relationship itself.  Authorisation checks read it directly, never from a per-process cache - once a
+    relationship has ended, no worker may go on treating its keyholder as active
+    """
+    __tablename__ = "active_relationship"
+    __table_args__ = (
+        db.UniqueConstraint('keyholder_id', 'safe_id'),
+    )
+
+    safe_id = db.Column(db.String(64), db.ForeignKey("safe.hardware_id"), primary_key=True)
+    relationship_id = db.Column(db.Integer, db.ForeignKey("relationship.id"), nullable=False, unique=True)
+    keyholder_id = db.Column(db.Integer, db.ForeignKey("users.id"), nullable=False)
+    safeholder_id = db.Column(db.Integer, db.ForeignKey("users.id"), nullable=False)
+
+    @classmethod
+    def find(cls, _safe_id: str, for_update: bool = False) -> Union[ActiveRelationship, None]:
+        """
+        The safe's active relationship, if it has one - one primary key read
+        :param for_update: Lock the registry row until the transaction ends, so the relationship cannot be ended
+               while a change it authorises is being written (where the database supports row locks)
+        """
+        query = db.session.query(cls.relationship_id, cls.safe_id, cls.keyholder_id, cls.safeholder_id
+                                 ).filter(cls.safe_id == _safe_id)
+        if for_update:
+            query = query.with_for_update()
+        row = query.first()
+        return ActiveRelationship(*row) if row is not None else None
+
+    @classmethod
+    def find_for_keyholder(cls, _keyholder_id: int, _safe_id: str,
+                           for_update: bool = False) -> Union[ActiveRelationship, None]:
+        """
+        The safe's active relationship if this user is its keyholder
+        """
+        active = cls.find(_safe_id, for_update=for_update)
+        if active is None or active.keyholder_id != _keyholder_id:
+            return None
+        return active
+
 
 class RelationshipMessageModel(db.Model):
     __tablename__ = "relationship_message"
+    __table_args__ = (
+        db.Index('ix_relationship_message_relationship_id_message_timestamp_id',
+                 'relationship_id', 'message_timestamp', 'id'),
+    )
 
     id = db.Column(db.Integer, primary_key=True)
     relationship_id = db.Column(db.Integer, db.ForeignKey("relationship.id"), nullable=False)
@@ -124,6 +260,45 @@ class RelationshipMessageModel(db.Model):
         db.session.delete(self)
         db.session.commit()
 
+    def send(self) -> None:
+        """
+        Save a new message and add it to the unread count of the side that has not seen it, in one transaction
+        """
+        db.session.add(self)
+        counts = {}
+        for side in ('kh', 'sh'):
+            if getattr(self, f"seen_by_{side}") is None:
+                unread = getattr(RelationshipModel, f"unread_by_{side}")
+                counts[unread] = unread + 1
+        if counts:
+            RelationshipModel.query.filter_by(id=self.relationship_id).update(counts, synchronize_session=False)
+        db.session.commit()
+
+    @classmethod
+    def mark_read(cls, _relationship_id: int, side: str, up_to_id: int, now: datetime) -> int:
+        """
+        Mark one side's unseen messages as seen, up to and including up_to_id in the order Message.get pages them,
+        and take them off that side's unread count - one UPDATE of each table, in one transaction
+        :param side: 'kh' or 'sh'
+        :param up_to_id: Newest message read - a message id of another relationship marks nothing
+        :param now: Time to record as seen
+        :return: Number of messages newly marked as seen
+        """
+        seen = getattr(cls, f"seen_by_{side}")
+        unread = getattr(RelationshipModel, f"unread_by_{side}")
+        cursor_timestamp = db.session.query(cls.message_timestamp).filter(
+            cls.id == up_to_id, cls.relationship_id == _relationship_id).as_scalar()
+        marked = cls.query.filter(cls.relationship_id == _relationship_id, seen == None,
+                                  cls.message_timestamp <= cursor_timestamp,
+                                  or_(cls.message_timestamp < cursor_timestamp, cls.id <= up_to_id)
+                                  ).update({seen: now}, synchronize_session=False)
+        # Only rows this statement changed are counted, so concurrent mark_reads never take a message off twice
+        if marked:
+            RelationshipModel.query.filter_by(id=_relationship_id).update({unread: unread - marked},
+                                                                         synchronize_session=False)
+        db.session.commit()
+        return marked
+
     @classmethod
     def find_unread_by_relationship(cls, _relationship_id: int) -> List["RelationshipMessageModel"]:
         """
@@ -143,3 +318,32 @@ class RelationshipMessageModel(db.Model):
         """
         return cls.query.filter_by(relationship_id=_relationship_id).order_by(cls.message_timestamp.desc()).all()
 
+    @classmethod
+    def find_page(cls, _relationship_id: int, limit: int, before_id: int = None, after_id: int = None,
+                  unread: bool = False) -> List["RelationshipMessageModel"]:
+        """
+        One page of a relationship's messages, using keyset pagination on (relationship_id, message_timestamp, id).
+        The cursor message's position is looked up in the same query
+        :param limit: Maximum number of messages
+        :param before_id: Only messages older than this one - newest first
+        :param after_id: Only messages newer than this one - oldest first, so polling never skips any
+        :param unread: Only messages one side has not seen
+        """
+        query = cls.query.filter(cls.relationship_id == _relationship_id)
+        if unread:
+            query = query.filter(or_(cls.seen_by_kh == None, cls.seen_by_sh == None))
+        cursor_id = before_id if before_id is not None else after_id
+        if cursor_id is not None:
+            cursor_timestamp = db.session.query(cls.message_timestamp).filter(
+                cls.id == cursor_id, cls.relationship_id == _relationship_id).as_scalar()
+            # The bare range on message_timestamp lets the index seek to the cursor rather than scan up to it
+            if before_id is not None:
+                query = query.filter(cls.message_timestamp <= cursor_timestamp,
+                                     or_(cls.message_timestamp < cursor_timestamp, cls.id < cursor_id))
+            else:
+                query = query.filter(cls.message_timestamp >= cursor_timestamp,
+                                     or_(cls.message_timestamp > cursor_timestamp, cls.id > cursor_id))
+        if after_id is not None:
+            return query.order_by(cls.message_timestamp, cls.id).limit(limit).all()
+        return query.order_by(cls.message_timestamp.desc(), cls.id.desc()).limit(limit).all()
+
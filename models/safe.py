@@ -1,14 +1,26 @@
 from sqlalchemy.sql import expression
+from sqlalchemy.dialects import postgresql
+from sqlalchemy import and_, bindparam, func
+from sqlalchemy.exc import IntegrityError
+from datetime import date, datetime
 
 from db import db
-from typing import List
+from typing import Dict, List
+from libs.crypto import public_key_cache
+from libs.heartbeat import HeartbeatBuffer
+from libs.unlock_scheduler import UnlockScheduler
+
+# Heartbeat-only checkins, written to safe.last_update in bulk - see SafeModel.save_heartbeats
+heartbeat_buffer = HeartbeatBuffer()
+# Authorises safes to unlock at their unlock_time - see SafeModel.find_pending_unlocks and SafeModel.authorise_unlocks
+unlock_scheduler = UnlockScheduler()
 
 
 class SafeModel(db.Model):
     __tablename__ = "safe"
 
     hardware_id = db.Column(db.String(64), primary_key=True)
-    digital_key = db.Column(db.String(80), nullable=True)
+    digital_key = db.Column(db.String(80), nullable=True, unique=True, index=True)
     bolt_engaged = db.Column(db.Boolean, server_default=expression.false())
     hinge_closed = db.Column(db.Boolean, server_default=expression.false())
     lid_closed = db.Column(db.Boolean, server_default=expression.false())
@@ -16,14 +28,40 @@ class SafeModel(db.Model):
     last_update = db.Column(db.DateTime(), nullable=False)
     public_key = db.Column(db.Text, nullable=True)
     auth_to_unlock = db.Column(db.Boolean, server_default=expression.false())
-    unlock_time = db.Column(db.DateTime(), nullable=False)
+    unlock_time = db.Column(db.DateTime(), nullable=False, index=True)
     scan_freq = db.Column(db.Integer, server_default='300', nullable=False)
     report_freq = db.Column(db.Integer, server_default='1', nullable=False)
+    max_checkin_delay = db.Column(db.Integer, nullable=True)  # Seconds - longest the server may defer a report
     proximity_unit = db.Column(db.Enum('M', 'H', 'D', 'W', name='_proximity_unit'), nullable=False, server_default="M")
     display_proximity = db.Column(db.Boolean, server_default=expression.true(), nullable=False)
+    session_key = db.Column(db.LargeBinary(32), nullable=True)
+    session_expires = db.Column(db.DateTime(), nullable=True)
+    session_requested = db.Column(db.DateTime(), nullable=True)  # Timestamp of the last accepted session handshake
+    settings_version = db.Column(db.Integer, server_default='0', nullable=False, default=0)
 
     safeholder = db.relationship("UserModel")
 
+    def settings_changed(self) -> None:
+        """
+        Record that something the safe is told in its checkin response has changed - bumps settings_version
+        so safes holding the old version are brought up to date.  Does not commit
+        """
+        self.settings_version = (self.settings_version or 0) + 1
+
+    def unlock_due(self, now: datetime) -> bool:
+        """
+        True if the unlock time has passed but the safe is not yet authorised to unlock
+        :param now: Current (naive UTC) time
+        """
+        return not self.auth_to_unlock and self.unlock_time < now
+
+    def session_active(self, now: datetime) -> bool:
+        """
+        True if the safe has negotiated a session key that has not yet expired
+        :param now: Current (naive UTC) time
+        """
+        return self.session_key is not None and self.session_expires is not None and self.session_expires > now
+
 
     def save_to_db(self) -> None:
         """
@@ -38,15 +76,77 @@ class SafeModel(db.Model):
         """
         db.session.delete(self)
         db.session.commit()
+        public_key_cache.invalidate(self.hardware_id)
 
     @classmethod
-    def find_by_digital_key(cls, digi_key) -> List["SafeModel"]:
-        return cls.query.filter_by(digital_key=digi_key).all()
+    def save_checkins_to_db(cls, safes: List["SafeModel"], events: List[dict]) -> None:
+        """
+        Save a batch of checked-in safes and their events in a single transaction
+        :param safes: Updated safe records
+        :param events: New event rows - see SafeEventModel.bulk_insert
+        """
+        db.session.add_all(safes)
+        db.session.flush()
+        SafeEventModel.bulk_insert(events)
+        db.session.commit()
+
+    @classmethod
+    def save_heartbeats(cls, heartbeats: Dict[str, datetime]) -> None:
+        """
+        Write buffered heartbeat times in one bulk UPDATE.  A row is only moved forward, so a newer last_update
+        written through in the meantime is not overwritten
+        :param heartbeats: {hardware_id: last_update}
+        """
+        statement = cls.__table__.update().where(and_(
+            cls.__table__.c.hardware_id == bindparam('hwid'),
+            cls.__table__.c.last_update < bindparam('last_update'))).values(last_update=bindparam('last_update'))
+        db.session.execute(statement, [{"hwid": hwid, "last_update": timestamp}
+                                       for hwid, timestamp in heartbeats.items()])
+        db.session.commit()
+
+    @classmethod
+    def find_pending_unlocks(cls, horizon: datetime) -> List[tuple]:
+        """
+        Safes not yet authorised to unlock whose unlock_time falls before horizon
+        :param horizon: Latest (naive UTC) unlock_time to return
+        :return: list of (hardware_id, unlock_time)
+        """
+        return db.session.query(cls.hardware_id, cls.unlock_time).filter(
+            cls.auth_to_unlock == expression.false(), cls.unlock_time < horizon).all()
+
+    @classmethod
+    def authorise_unlocks(cls, hwids: List[str], now: datetime) -> int:
+        """
+        Authorise the given safes to unlock in one UPDATE, skipping any whose unlock_time has since moved
+        into the future or that are already authorised.  Bumps settings_version so the safes pick it up
+        :param hwids: hardware_ids that are due
+        :param now: Current (naive UTC) time
+        :return: number of safes changed
+        """
+        updated = cls.query.filter(cls.hardware_id.in_(hwids), cls.auth_to_unlock == expression.false(),
+                                   cls.unlock_time <= now
+                                   ).update({cls.auth_to_unlock: True,
+                                             cls.settings_version: cls.settings_version + 1},
+                                            synchronize_session=False)
+        db.session.commit()
+        return updated
+
+    @classmethod
+    def find_by_digital_key(cls, digi_key: str) -> "SafeModel":
+        return cls.query.filter_by(digital_key=digi_key).first()
 
     @classmethod
     def find_by_id(cls, _id) -> "SafeModel":
         return cls.query.filter_by(hardware_id=_id).first()
 
+    @classmethod
+    def find_by_ids(cls, _ids: List[str]) -> List["SafeModel"]:
+        """
+        Load several safes in one query
+        :param _ids: hardware_ids to load
+        """
+        return cls.query.filter(cls.hardware_id.in_(_ids)).all()
+
     @classmethod
     def find_all(cls) -> List["SafeModel"]:
         """
@@ -70,6 +170,9 @@ class SafeModel(db.Model):
 
 class SafeEventModel(db.Model):
     __tablename__ = 'safe_event'
+    __table_args__ = (
+        db.Index('ix_safe_event_hardware_id_event_code_timestamp', 'hardware_id', 'event_code', 'timestamp'),
+    )
 
     hardware_id = db.Column(db.String(64), db.ForeignKey("safe.hardware_id"), primary_key=True)
     timestamp = db.Column(db.DateTime(), primary_key=True)
@@ -85,6 +188,43 @@ class SafeEventModel(db.Model):
         db.session.add(self)
         db.session.commit()
 
+    @classmethod
+    def insert_ignore(cls):
+        """
+        Build an INSERT for the event table that skips rows whose (hardware_id, timestamp) key already exists,
+        using whichever insert-or-ignore form the database supports
+        :return: the statement, or None if the database has no insert-or-ignore form
+        """
+        dialect = db.session.get_bind().dialect.name
+        if dialect == 'postgresql':
+            return postgresql.insert(cls.__table__).on_conflict_do_nothing(index_elements=['hardware_id', 'timestamp'])
+        if dialect == 'sqlite':
+            return cls.__table__.insert().prefix_with('OR IGNORE')
+        if dialect == 'mysql':
+            return cls.__table__.insert().prefix_with('IGNORE')
+        return None
+
+    @classmethod
+    def bulk_insert(cls, events: List[dict]) -> None:
+        """
+        Insert many events in one statement as part of the current transaction - does not commit.
+        Events already stored (e.g. retransmitted by a safe) are skipped rather than failing the transaction.
+        Databases with no insert-or-ignore form get one INSERT per event, each in a savepoint
+        :param events: list of dicts with hardware_id, timestamp, event_code and detail
+        """
+        if not events:
+            return
+        statement = cls.insert_ignore()
+        if statement is not None:
+            db.session.execute(statement, events)
+            return
+        for event in events:
+            try:
+                with db.session.begin_nested():
+                    db.session.execute(cls.__table__.insert(), event)
+            except IntegrityError:
+                pass  # Already stored - the savepoint is rolled back, the rest of the transaction kept
+
     @classmethod
     def find_all(cls) -> List["SafeEventModel"]:
         """
@@ -93,3 +233,105 @@ class SafeEventModel(db.Model):
         """
         return cls.query.all()
 
+    @classmethod
+    def find_page(cls, hardware_id: str, limit: int, before: datetime = None, since: datetime = None,
+                  until: datetime = None, min_code: int = None, max_code: int = None) -> List["SafeEventModel"]:
+        """
+        One page of a safe's events, newest first, using keyset pagination on (hardware_id, timestamp)
+        :param hardware_id: Safe
+        :param limit: Maximum number of events
+        :param before: Cursor - timestamp of the last event on the previous page
+        :param since: Earliest timestamp, inclusive
+        :param until: Latest timestamp, exclusive
+        :param min_code: Lowest event_code, inclusive
+        :param max_code: Highest event_code, inclusive
+        """
+        query = cls.query.filter(cls.hardware_id == hardware_id)
+        if min_code is not None:
+            query = query.filter(cls.event_code >= min_code)
+        if max_code is not None:
+            query = query.filter(cls.event_code <= max_code)
+        if since is not None:
+            query = query.filter(cls.timestamp >= since)
+        if until is not None:
+            query = query.filter(cls.timestamp < until)
+        if before is not None:
+            query = query.filter(cls.timestamp < before)
+        return query.order_by(cls.timestamp.desc()).limit(limit).all()
+
+    @classmethod
+    def rollup_range(cls, *criteria) -> List[tuple]:
+        """
+        Aggregate the events matching criteria into per-safe, per-day, per-event_code counts
+        :return: list of (hardware_id, day, event_code, count, first_timestamp, last_timestamp)
+        """
+        day = func.date(cls.timestamp)
+        return db.session.query(cls.hardware_id, day, cls.event_code, func.count(),
+                                func.min(cls.timestamp), func.max(cls.timestamp)
+                                ).filter(*criteria).group_by(cls.hardware_id, day, cls.event_code).all()
+
+    @classmethod
+    def rollup_and_purge_batch(cls, cutoff: datetime, batch_size: int) -> int:
+        """
+        Roll up and delete (about) the oldest batch_size events older than cutoff, in one transaction, so an
+        event is either still raw or counted in the rollups - never both.  Ties on the batch's last timestamp
+        are included, so a batch can be slightly larger than batch_size
+        :param cutoff: Events before this time are rolled up - should be a day boundary so days are complete
+        :param batch_size: Rows per batch
+        :return: number of events deleted - 0 when nothing older than cutoff remains
+        """
+        criteria = [cls.timestamp < cutoff]
+        upper = db.session.query(cls.timestamp).filter(*criteria).order_by(cls.timestamp
+                                                                          ).offset(batch_size - 1).limit(1).scalar()
+        if upper is not None:
+            criteria.append(cls.timestamp <= upper)
+        SafeEventRollupModel.merge_counts(cls.rollup_range(*criteria))
+        deleted = cls.query.filter(*criteria).delete(synchronize_session=False)
+        db.session.commit()
+        return deleted
+
+
+class SafeEventRollupModel(db.Model):
+    """
+    Daily per-safe counts of each event_code, kept after the raw safe_event rows have been purged
+    """
+    __tablename__ = 'safe_event_rollup'
+
+    hardware_id = db.Column(db.String(64), db.ForeignKey("safe.hardware_id"), primary_key=True)
+    day = db.Column(db.Date(), primary_key=True)
+    event_code = db.Column(db.Integer, primary_key=True)
+    count = db.Column(db.Integer, nullable=False)
+    first_timestamp = db.Column(db.DateTime(), nullable=False)
+    last_timestamp = db.Column(db.DateTime(), nullable=False)
+
+    @classmethod
+    def merge_counts(cls, rows: List[tuple]) -> None:
+        """
+        Add aggregated event counts to the rollups as part of the current transaction - does not commit
+        :param rows: (hardware_id, day, event_code, count, first_timestamp, last_timestamp) as from
+                     SafeEventModel.rollup_range
+        """
+        for hardware_id, day, event_code, count, first_timestamp, last_timestamp in rows:
+            if isinstance(day, str):  # SQLite returns date() as text
+                day = date.fromisoformat(day)
+            rollup = cls.query.get((hardware_id, day, event_code))
+            if rollup is None:
+                db.session.add(cls(hardware_id=hardware_id, day=day, event_code=event_code, count=count,
+                                   first_timestamp=first_timestamp, last_timestamp=last_timestamp))
+            else:
+                rollup.count += count
+                rollup.first_timestamp = min(rollup.first_timestamp, first_timestamp)
+                rollup.last_timestamp = max(rollup.last_timestamp, last_timestamp)
+        db.session.flush()
+
+    @classmethod
+    def find_by_safe(cls, hardware_id: str, since: date = None) -> List["SafeEventRollupModel"]:
+        """
+        :param hardware_id: Safe
+        :param since: Earliest day to return
+        """
+        query = cls.query.filter_by(hardware_id=hardware_id)
+        if since is not None:
+            query = query.filter(cls.day >= since)
+        return query.order_by(cls.day, cls.event_code).all()
+
@@ -1,11 +1,11 @@
-from requests import Response
 from flask import request, url_for
 from db import db
 from typing import List, Union
 
-from libs.mailgun import Mailgun
+from libs.passwords import password_hasher, HashingBusy, PasswordHash
+from libs.identity_cache import identity_cache, CachedUser
 from models.confirmation import ConfirmationModel
-import messages.en as msgs
+from models.outbox import OutboxModel
 
 
 class UserModel(db.Model):
@@ -16,7 +16,10 @@ class UserModel(db.Model):
     email = db.Column(db.String(80), nullable=False, unique=True)
     pw_salt = db.Column(db.LargeBinary(80), nullable=False)
     pw_hash = db.Column(db.LargeBinary(100), nullable=False)
+    pw_algorithm = db.Column(db.String(20), nullable=False, server_default='pbkdf2_sha256')
+    pw_iterations = db.Column(db.Integer, nullable=False, server_default='100000')
     displayname = db.Column(db.String(100), nullable=False, unique=True)
+    confirmed_at = db.Column(db.DateTime(), nullable=True)  # Set by Confirmation.get - None until confirmed
     confirmation = db.relationship(
             "ConfirmationModel", lazy="dynamic", cascade="all, delete-orphan"
     )
@@ -26,34 +29,61 @@ class UserModel(db.Model):
         # ordered by expiration time (in descending order)
         return self.confirmation.order_by(db.desc(ConfirmationModel.expire_at)).first()
 
+    def set_password(self, password: str) -> None:
+        """
+        Hash and store a new password with the current algorithm and work factor.  Does not commit
+        :raises HashingBusy: if the hashing pool is full
+        """
+        self.pw_salt, self.pw_hash, self.pw_algorithm, self.pw_iterations = password_hasher.hash_new(password)
+
+    def check_password(self, password: str) -> bool:
+        """
+        :raises HashingBusy: if the hashing pool is full
+        """
+        return password_hasher.verify(PasswordHash(self.pw_salt, self.pw_hash, self.pw_algorithm,
+                                                   self.pw_iterations), password)
+
+    def upgrade_password(self, password: str) -> bool:
+        """
+        Rehash a correct password if it was stored with an outdated algorithm or work factor, and save.
+        The rehash is skipped, to be retried at the next login, if the hashing pool is full
+        :return: True if the password was rehashed
+        """
+        if not password_hasher.needs_rehash(PasswordHash(self.pw_salt, self.pw_hash, self.pw_algorithm,
+                                                         self.pw_iterations)):
+            return False
+        try:
+            self.set_password(password)
+        except HashingBusy:
+            return False
+        self.save_to_db()
+        return True
+
     def save_to_db(self) -> None:
         """
         Save the User record to the database
         """
         db.session.add(self)
         db.session.commit()
+        identity_cache.invalidate(self.id)
 
     def delete_from_db(self) -> None:
         """
         Delete the user record from the database
         """
+        user_id = self.id
         db.session.delete(self)
         db.session.commit()
+        identity_cache.invalidate(user_id)
 
-    def send_confirmation_email(self) -> Union[Response, None]:
+    def send_confirmation_email(self) -> OutboxModel:
         """
-        Send an address confirmation email to the user
+        Queue an address confirmation email to the user
         """
         link = request.url_root[:-1] + url_for(
             "confirmation", confirmation_id=self.most_recent_confirmation.id
         )
-        return Mailgun.send_email(from_email=msgs.FROM_EMAIL,
-                                  from_title=msgs.FROM_TITLE,
-                                  to_email=[self.email],
-                                  subject=msgs.CONFIRMATION_MAIL_SUBJECT,
-                                  text=msgs.CONFIRMATION_MAIL_BODY.format(name=self.username, link=link),
-                                  html=msgs.CONFIRMATION_MAIL_BODY_HTML.format(name=self.username, link=link)
-                                  )
+        return OutboxModel.enqueue('confirmation', self.email, {"name": self.username, "link": link})
 
     @classmethod
     def find_all(cls) -> List['UserModel']:
@@ -74,6 +104,17 @@ class UserModel(db.Model):
     def find_by_id(cls, _id: int) -> 'UserModel':
         return cls.query.filter_by(id=_id).first()
 
+    @classmethod
+    def find_identity(cls, _id: int) -> Union[CachedUser, None]:
+        """
+        Load the identity columns of a user for the identity cache - see libs.identity_cache
+        """
+        row = db.session.query(cls.id, cls.username, cls.email, cls.displayname).filter(cls.id == _id).first()
+        return CachedUser(*row) if row else None
+
     @classmethod
     def find_by_displayname(cls, displayname: str) -> 'UserModel':
         return cls.query.filter_by(displayname=displayname).first()
+
+
+identity_cache.init_loader(UserModel.find_identity)
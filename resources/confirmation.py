@@ -1,4 +1,5 @@
 import traceback
+from datetime import datetime
 from time import time
 import logging
 
@@ -42,8 +43,9 @@ class Confirmation(Resource):
             )
 
         else:
-            # No errors so we can set the confirmation
+            # No errors so we can set the confirmation - and record it on the user, where login checks it
             confirmation.confirmed = True
+            confirmation.user.confirmed_at = datetime.utcnow()
             confirmation.save_to_db()
 
             logging.debug(f"Returning confirmation page for {confirmation.user.username}")
@@ -89,11 +91,11 @@ class ConfirmationByUser(Resource):
             return {"message": msgs.USER_NONEXISTANT.format(user_id)}, 404
         logging.debug(f"Processing confirmation resend for {user.username}")
         try:
+            if user.confirmed_at is not None:
+                return {"message": msgs.ALREADY_CONFIRMED}, 400
             # find the most current confirmation for the user
             confirmation = user.most_recent_confirmation  # using property decorator
             if confirmation:
-                if confirmation.confirmed:
-                    return {"message": msgs.ALREADY_CONFIRMED}, 400
                 confirmation.force_to_expire()
 
             new_confirmation = ConfirmationModel(user_id)  # create a new confirmation
@@ -0,0 +1,30 @@
+from flask_restful import Resource
+from flask_jwt_extended import jwt_required
+
+from models.safe import heartbeat_buffer, unlock_scheduler
+from models.outbox import mail_sender
+from models.relationship import relationship_events
+from resources.safe import admission
+from libs.crypto import public_key_cache
+from libs.passwords import password_hasher
+from libs.ratelimit import auth_limiter
+from libs.identity_cache import identity_cache
+
+
+class ServerMetrics(Resource):
+    """
+    Current load and cache figures for this server process - admission is the checkin rate and concurrency
+    that drive the Next_checkin delay given to safes
+    """
+    @classmethod
+    @jwt_required
+    def get(cls):
+        return {"admission": admission.stats(),
+                "heartbeats": heartbeat_buffer.stats(),
+                "unlock_scheduler": unlock_scheduler.stats(),
+                "public_key_cache": public_key_cache.stats(),
+                "password_hashing": password_hasher.stats(),
+                "auth_rate_limit": auth_limiter.stats(),
+                "identity_cache": identity_cache.stats(),
+                "mail_sender": mail_sender.stats(),
+                "relationship_events": relationship_events.stats()}, 200
@@ -1,21 +1,32 @@
 from uuid import uuid4
+from time import monotonic
+import hashlib
+import json
 import logging
+import os
 from flask_restful import Resource
-from flask import request
+from flask import Response, make_response, request
 from flask_jwt_extended import (
     jwt_required,
     get_jwt_identity,
 )
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.sql import expression
 from datetime import date, datetime, timezone
 
-from models.safe import SafeModel
+from models.safe import SafeModel, SafeEventModel, unlock_scheduler
 from models.user import UserModel
-from models.relationship import RelationshipModel, RelationshipMessageModel
+from libs.identity_cache import identity_cache
+from models.relationship import RelationshipModel, RelationshipMessageModel, ActiveRelationshipModel, \
+    relationship_events
+from libs.checkin_parser import to_naive_utc
+from libs.event_hub import Subscription
 from schemas.safe import SafeSchema
 from schemas.user import UserSchema
-from schemas.operations import SafeClaimSchema, KH_Claim_SHSchema, SafeOpsSchema, SafeSummarySchema
-from schemas.relationship import RelationshipMessageSchema, MessageGetSchema, MessagePostSchema
+from schemas.operations import SafeClaimSchema, KH_Claim_SHSchema, SafeOpsSchema, SafeSummarySchema, \
+    SafeEventsGetSchema, SafeEventSchema
+from schemas.relationship import MessageSchema, MessageGetSchema, MessagePostSchema, MessageReadSchema, \
+    MessageStreamSchema, UnreadCountSchema
 import messages.en as msgs
 
 # Set up the schema objects
@@ -25,9 +36,21 @@ user_schema = UserSchema()
 safe_schema = SafeSchema()
 message_get_schema = MessageGetSchema()
 message_post_schema = MessagePostSchema()
-relationship_message_schema = RelationshipMessageSchema()
+message_schema = MessageSchema()
+message_read_schema = MessageReadSchema()
+message_stream_schema = MessageStreamSchema()
+unread_count_schema = UnreadCountSchema()
 safe_ops_schema = SafeOpsSchema()
 safe_summary_schema = SafeSummarySchema()
+safe_events_get_schema = SafeEventsGetSchema()
+safe_event_schema = SafeEventSchema()
+
+# A stream is ended after this long, so each worker thread is freed and the token checked again as clients
+# reconnect.  Clients reconnect after STREAM_RETRY_MS, resuming from the last message id they were sent
+STREAM_MAX_SECS = float(os.environ.get('CSAFE_STREAM_MAX_SECS', 300))
+STREAM_KEEPALIVE_SECS = float(os.environ.get('CSAFE_STREAM_KEEPALIVE_SECS', 15))
+STREAM_RETRY_MS = int(os.environ.get('CSAFE_STREAM_RETRY_MS', 1000))
+STREAM_REPLAY_LIMIT = 200  # Missed messages sent per connection - the client reconnects at once for the rest
 
 
 class ClaimSafe(Resource):
@@ -43,16 +66,16 @@ class ClaimSafe(Resource):
         Generate, save and return a digital key for the Safeholder to pass to their chosen Keyholder
         """
         parms = safe_claim_schema.load(request.get_json())
-        this_user = UserModel.find_by_id(get_jwt_identity())
+        this_user = identity_cache.current()
         # Check if we have this safe
         requested_safe = SafeModel.find_by_id(parms['hardware_id'])
         if not requested_safe:
             return {"error": msgs.CLAIM_NO_SAFE}, 400
         # Then check if the safe is already claimed
-        if requested_safe.safeholder:
+        if requested_safe.safeholder_id is not None:
             return {"error": msgs.CLAIM_NOT_AVAILABLE}, 400
         # Allocate this user as safeholder - generate the digital key first
-        requested_safe.safeholder = this_user
+        requested_safe.safeholder_id = this_user.id
         digital_key = str(uuid4())
         requested_safe.digital_key = digital_key
         requested_safe.save_to_db()
@@ -65,16 +88,16 @@ class ClaimSafe(Resource):
         Remove the current logged-on user as the holder of this safe - make it available for re-claiming
         """
         parms = safe_claim_schema.load(request.get_json())
-        this_user = UserModel.find_by_id(get_jwt_identity())
+        this_user = identity_cache.current()
         # Check if we have this safe
         requested_safe = SafeModel.find_by_id(parms['hardware_id'])
         if not requested_safe:
             return {"error": msgs.CLAIM_NO_SAFE}, 400
         # Next check if the safe is owned by this_user
-        if requested_safe.safeholder is None:
+        if requested_safe.safeholder_id is None:
             # The safe does not have an owner - cannot delete it
             return {"error": msgs.RELEASE_NOT_OWNED}, 400
-        if requested_safe.safeholder.id != this_user.id:
+        if requested_safe.safeholder_id != this_user.id:
             # The safe does not belong to you
             return {"error": msgs.RELEASE_NOT_OWNED}, 400
         # TODO - Need to also check if the safeholder is in a relationship - should not permit release if so
@@ -99,40 +122,37 @@ class KHClaimSH(Resource):
         """
         parms = kh_claim_sh_schema.load(request.get_json())
         safeholder = UserModel.find_by_displayname(parms['displayname'])
-        potential_kh = UserModel.find_by_id(get_jwt_identity())
+        potential_kh = identity_cache.current()
         # First check if the safeholder exists
         if not safeholder:
             return {"msg": msgs.USER_NONEXISTANT.format(parms['displayname'])}, 400
         # Then check if potential KH is trying to claim themself as a SH
         if safeholder.id == potential_kh.id:
             return {"msg": msgs.KH_EQ_SH}, 401
-        # Now check if the safeholder has a safe - and its digital key matches
-        safeholder_safes = SafeModel.find_by_safeholder_id(safeholder.id)
-        if not safeholder_safes:  # Safeholder has no safes
+        # Now check the digital key belongs to one of the safeholder's safes
+        safe = SafeModel.find_by_digital_key(parms['digital_key'])
+        if not safe or safe.safeholder_id != safeholder.id:
             return {"msg": msgs.INCORRECT_KEY}, 401
-        for safe in safeholder_safes:
-            if safe.digital_key == parms['digital_key']:
-                # We have a hit - now check if the SH is not already in a relationship for that safe
-                relationship_list = RelationshipModel.find_by_safe_id(safe.hardware_id)
-                for relationship in relationship_list:
-                    if (relationship.safeholder_id == safeholder.id) and (relationship.end_date is None):
-                        return {"msg": msgs.SH_IN_RELATIONSHIP}, 401
-                # OK now we can set up the relationship
-                relationship = RelationshipModel(
-                        keyholder_id=potential_kh.id,
-                        safeholder_id=safeholder.id,
-                        safe_id=safe.hardware_id,
-                        start_date=date.today()
-                )
-                relationship.save_to_db()
-                # Send email to Safeholder to confirm start of relationship
-                relationship.send_relationship_email(status='start')
-                # Log the start of the relationship
-                logging.info(f"RELATIONSHIP: START {relationship.keyholder.username} - "
-                             f"{relationship.safeholder.username}")
-                return {"msg": msgs.RELATIONSHIP_ESTABLISHED}, 200
-        # If we get here the safeholder had no safes that the digital key fitted
-        return {"msg": msgs.INCORRECT_KEY}, 401
+        # We have a hit - now check the safe is not already in a relationship
+        if ActiveRelationshipModel.find(safe.hardware_id):
+            return {"msg": msgs.SH_IN_RELATIONSHIP}, 401
+        # OK now we can set up the relationship
+        relationship = RelationshipModel(
+                keyholder_id=potential_kh.id,
+                safeholder_id=safeholder.id,
+                safe_id=safe.hardware_id,
+                start_date=date.today()
+        )
+        try:
+            relationship.start()
+        except IntegrityError:
+            # Another request set up a relationship for the safe first
+            return {"msg": msgs.SH_IN_RELATIONSHIP}, 401
+        # Send email to Safeholder to confirm start of relationship
+        relationship.send_relationship_email(status='start')
+        # Log the start of the relationship
+        logging.info(f"RELATIONSHIP: START {potential_kh.username} - {relationship.safeholder.username}")
+        return {"msg": msgs.RELATIONSHIP_ESTABLISHED}, 200
 
     @classmethod
     @jwt_required
@@ -143,40 +163,35 @@ class KHClaimSH(Resource):
         """
         parms = kh_claim_sh_schema.load(request.get_json())
         safeholder = UserModel.find_by_displayname(parms['displayname'])
-        keyholder = UserModel.find_by_id(get_jwt_identity())
+        keyholder = identity_cache.current()
         now = datetime.now(timezone.utc)
         # First check if the safeholder exists
         if not safeholder:
             return {"msg": msgs.USER_NONEXISTANT.format(parms['displayname'])}, 400
-        # Now check if the safeholder has a safe - and its digital key matches
-        safeholder_safes = SafeModel.find_by_safeholder_id(safeholder.id)
-        if not safeholder_safes:  # Safeholder has no safes
+        # Now check the digital key belongs to one of the safeholder's safes
+        safe = SafeModel.find_by_digital_key(parms['digital_key'])
+        if not safe or safe.safeholder_id != safeholder.id:
             return {"msg": msgs.INCORRECT_KEY}, 401
-        for safe in safeholder_safes:
-            if safe.digital_key == parms['digital_key']:
-                # We have a hit - now check if the KH is the KH for that relationship
-                relationship_list = RelationshipModel.find_by_safe_id(safe.hardware_id)
-                for relationship in relationship_list:
-                    if (relationship.keyholder_id == keyholder.id) and (relationship.end_date is None):
-                        # OK, we have an active relationship between this KH and the SH
-                        # Set a new digital_key for the safe - and unlock it (for safety)
-                        digital_key = str(uuid4())
-                        safe.digital_key = digital_key
-                        safe.auth_to_unlock = expression.true()
-                        safe.unlock_time = now
-                        safe.last_update = now
-                        safe.save_to_db()
-                        # Then terminate the relationship - and send a mail to the safeholder
-                        relationship.end_date = date.today()
-                        relationship.send_relationship_email(status='end')
-                        relationship.save_to_db()
-                        # Log the end of the relationship
-                        logging.info(f"RELATIONSHIP: END {relationship.keyholder.username} - "
-                                     f"{relationship.safeholder.username}")
+        # We have a hit - now check if the KH is the KH for that relationship
+        active = ActiveRelationshipModel.find_for_keyholder(keyholder.id, safe.hardware_id)
+        if not active:
+            return {"msg": msgs.INCORRECT_KH}, 401
+        relationship = RelationshipModel.find_by_id(active.relationship_id)
+        # OK, we have an active relationship between this KH and the SH
+        # Set a new digital_key for the safe - and unlock it (for safety)
+        digital_key = str(uuid4())
+        safe.digital_key = digital_key
+        safe.auth_to_unlock = expression.true()
+        safe.unlock_time = now
+        safe.last_update = now
+        safe.settings_changed()
+        # Then terminate the relationship, committing the safe changes with it - and send a mail to the safeholder
+        relationship.end(date.today())
+        relationship.send_relationship_email(status='end')
+        # Log the end of the relationship
+        logging.info(f"RELATIONSHIP: END {keyholder.username} - {relationship.safeholder.username}")
 
-                        return {"msg": msgs.RELATIONSHIP_TERMINATED}, 200
-                return {"msg": msgs.INCORRECT_KH}, 401
-        return {"msg": msgs.INCORRECT_KEY}, 401
+        return {"msg": msgs.RELATIONSHIP_TERMINATED}, 200
 
 
 class Message(Resource):
@@ -188,25 +203,36 @@ class Message(Resource):
     @jwt_required
     def get(cls):
         """
-        Request argument type may be 'all', 'unread',  argument relationship = unique ID for the relationship
+        Request argument type may be 'all', 'unread',  argument relationship = unique ID for the relationship.
+        Returns up to limit (default 50) messages, newest first.  Page back through the history with the before_id
+        returned - it is None once the oldest message has been returned.  Poll for new messages with the after_id
+        returned - the newest messages come back a page at a time, with more set while there are further pages
         :parameter
         """
         parms = message_get_schema.load(request.args)
-
-        if parms['type'] == 'unread':
-            return {
-                       "messages": [relationship_message_schema.dump(message) for message in
-                                    RelationshipMessageModel.find_unread_by_relationship(
-                                        _relationship_id=parms['relationship_id'])]
-                   }, 200
-        elif parms['type'] == 'all':
-            return {
-                       "messages": [relationship_message_schema.dump(message) for message in
-                                    RelationshipMessageModel.find_all(
-                                        _relationship_id=parms['relationship_id'])]
-                   }, 200
-        else:
+        if parms['type'] not in ('all', 'unread'):
             return{"error": msgs.BAD_REQUEST}, 400
+        this_user_id = get_jwt_identity()
+        relationship = RelationshipModel.find_by_id(parms['relationship_id'])
+        if not relationship or this_user_id not in (relationship.safeholder_id, relationship.keyholder_id):
+            return {"error": msgs.NOT_AUTHORISED}, 401
+        # One extra message is fetched to tell whether there is another page
+        messages = RelationshipMessageModel.find_page(parms['relationship_id'],
+                                                      limit=parms['limit'] + 1,
+                                                      before_id=parms.get('before_id'),
+                                                      after_id=parms.get('after_id'),
+                                                      unread=parms['type'] == 'unread')
+        more = len(messages) > parms['limit']
+        messages = messages[:parms['limit']]
+        before_id = None
+        if 'after_id' in parms:
+            messages.reverse()
+        elif more:
+            before_id = messages[-1].id
+        return {"messages": [message_schema.dump(message) for message in messages],
+                "before_id": before_id,
+                "after_id": messages[0].id if messages else parms.get('after_id'),
+                "more": more}, 200
 
     @classmethod
     @jwt_required
@@ -240,12 +266,142 @@ class Message(Resource):
                     seen_by_kh=seen_by_kh,
                     seen_by_sh=seen_by_sh
                     )
-            message.save_to_db()
+            channel = requested_relationship.channel
+            message.send()
+            relationship_events.publish(channel, 'message', message_schema.dump(message), message.id)
             return {"msg": "OK"}, 200
         # No relationship exists
         return {"error": msgs.NOT_AUTHORISED}, 400
 
 
+class MessageStream(Resource):
+    """
+    Server-Sent Events stream of a relationship's new messages and status changes, for either party - instead of
+    polling Message.get.  The stream opens with a 'status' event, then sends each new message as a 'message'
+    event whose id is the message id.  After a reconnect the messages since the Last-Event-ID header (or
+    last_event_id argument) are sent first.  A 'status' event with active false ends the stream, and once the
+    relationship has ended and nothing is left to send the stream returns 204, which stops the client reconnecting
+    :parameter
+    """
+    @classmethod
+    @jwt_required
+    def get(cls):
+        """
+        :parameter
+        """
+        parms = message_stream_schema.load(request.args)
+        last_event_id = request.headers.get('Last-Event-ID', parms.get('last_event_id'))
+        try:
+            last_event_id = int(last_event_id) if last_event_id not in (None, '') else None
+        except ValueError:
+            return {"error": msgs.BAD_REQUEST}, 400
+        this_user_id = get_jwt_identity()
+        relationship = RelationshipModel.find_by_id(parms['relationship_id'])
+        if not relationship or this_user_id not in (relationship.safeholder_id, relationship.keyholder_id):
+            return {"error": msgs.NOT_AUTHORISED}, 401
+        # Subscribe before reading the missed messages, so none is committed unseen in between
+        subscription = relationship_events.subscribe(relationship.channel)
+        try:
+            missed = []
+            if last_event_id is not None:
+                missed = RelationshipMessageModel.find_page(relationship.id, limit=STREAM_REPLAY_LIMIT + 1,
+                                                            after_id=last_event_id)
+            status = relationship.status()
+            if not status['active'] and not missed:
+                relationship_events.unsubscribe(subscription)
+                return make_response('', 204)
+            more = len(missed) > STREAM_REPLAY_LIMIT
+            replay = [message_schema.dump(message) for message in missed[:STREAM_REPLAY_LIMIT]]
+        except Exception:
+            relationship_events.unsubscribe(subscription)
+            raise
+        return Response(cls.stream(subscription, status, replay, more), mimetype='text/event-stream',
+                        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+    @staticmethod
+    def event(event_type: str, data: dict, event_id: int = None) -> str:
+        id_line = f"id: {event_id}\n" if event_id is not None else ''
+        return f"{id_line}event: {event_type}\ndata: {json.dumps(data)}\n\n"
+
+    @classmethod
+    def stream(cls, subscription: Subscription, status: dict, replay: list, more: bool):
+        """
+        The body of the stream.  Runs after the request has ended, so touches only the subscription - never the
+        database
+        """
+        try:
+            yield f"retry: {STREAM_RETRY_MS}\n\n"
+            yield cls.event('status', status)
+            sent = set()
+            for message in replay:
+                sent.add(message['id'])
+                yield cls.event('message', message, message['id'])
+            if more or not status['active']:
+                return
+            deadline = monotonic() + STREAM_MAX_SECS
+            while monotonic() < deadline:
+                event = subscription.get(timeout=min(STREAM_KEEPALIVE_SECS, max(deadline - monotonic(), 0.01)))
+                if event is None:
+                    if subscription.closed:
+                        return
+                    yield ": keepalive\n\n"
+                elif event.id is None or event.id not in sent:
+                    yield cls.event(event.type, event.data, event.id)
+                    if event.type == 'status' and not event.data['active']:
+                        return
+        finally:
+            relationship_events.unsubscribe(subscription)
+
+
+class MessageRead(Resource):
+    """
+    Endpoint for either party to mark a relationship's messages as read
+    :parameter
+    """
+    @classmethod
+    @jwt_required
+    def post(cls):
+        """
+        Mark every message up to and including up_to_id as seen by this user's side of the relationship.
+        Returns how many were newly marked and how many the user still has unread
+        :parameter
+        """
+        parms = message_read_schema.load(request.get_json())
+        this_user_id = get_jwt_identity()
+        relationship = RelationshipModel.find_by_id(parms['relationship_id'])
+        if relationship and this_user_id == relationship.safeholder_id:
+            side = 'sh'
+        elif relationship and this_user_id == relationship.keyholder_id:
+            side = 'kh'
+        else:
+            return {"error": msgs.NOT_AUTHORISED}, 401
+        marked = RelationshipMessageModel.mark_read(relationship.id, side, parms['up_to_id'],
+                                                    datetime.now(timezone.utc))
+        return {"marked": marked, "unread": getattr(relationship, f"unread_by_{side}")}, 200
+
+
+class MessageUnread(Resource):
+    """
+    GET method only with no parameters - unread message badges for all the logged on user's relationships,
+    from a single query of the counts kept on each relationship
+    :parameter
+    """
+    @classmethod
+    @jwt_required
+    def get(cls):
+        """
+        :parameter
+        """
+        this_user_id = get_jwt_identity()
+        return {"relationships": [unread_count_schema.dump({'relationship_id': relationship_id,
+                                                            'safe_id': safe_id,
+                                                            'role': role,
+                                                            'active': end_date is None,
+                                                            'unread': unread})
+                                  for relationship_id, safe_id, end_date, role, unread
+                                  in RelationshipModel.find_unread_counts(this_user_id)]}, 200
+
+
 class SafeOps(Resource):
     """
     Endpoints associated with getting and setting safe parameters
@@ -261,14 +417,11 @@ class SafeOps(Resource):
         """
         parms = safe_ops_schema.load(request.args)
         this_user_id = get_jwt_identity()
-        relationship_list = RelationshipModel.find_by_keyholder_id(this_user_id)
-        for relationship in relationship_list:
-            if relationship.safe_id == parms['hardware_id']:
-                requested_safe = relationship.safe
-                return {"safe": safe_ops_schema.dump(requested_safe)}, 200
-        # The user is not a KH for that safe so retrun an error
-        else:
+        if not ActiveRelationshipModel.find_for_keyholder(this_user_id, parms['hardware_id']):
+            # The user is not the KH for that safe so return an error
             return {"error": msgs.INCORRECT_KH}, 400
+        requested_safe = SafeModel.find_by_id(parms['hardware_id'])
+        return {"safe": safe_ops_schema.dump(requested_safe)}, 200
 
     @classmethod
     @jwt_required
@@ -282,27 +435,67 @@ class SafeOps(Resource):
         parms = safe_ops_schema.load(request.get_json())
         now = datetime.now(timezone.utc)
         this_user_id = get_jwt_identity()
-        relationship_list = RelationshipModel.find_by_keyholder_id(this_user_id)
-        for relationship in relationship_list:
-            if relationship.safe_id == parms['hardware_id']:
-                # Delete hardware_id from parms since we do not want to use to update the model object
-                parms.pop('hardware_id', None)
-                # Then update the safe object with the remaining values
-                for key, value in parms.items():
-                    print(key, value)
-                    setattr(relationship.safe, key, value)
-                # The set the last_updated field
-                relationship.safe.last_update = now
-                relationship.safe.save_to_db()
-                return {"safe": safe_ops_schema.dump(relationship.safe)}, 200
-        # The user is not a KH for that safe so retrun an error
-        return {"error": msgs.INCORRECT_KH}, 400
+        # The registry row stays locked until the safe is saved, so a concurrent release cannot slip in between
+        if not ActiveRelationshipModel.find_for_keyholder(this_user_id, parms['hardware_id'], for_update=True):
+            # The user is not the KH for that safe so return an error
+            return {"error": msgs.INCORRECT_KH}, 400
+        requested_safe = SafeModel.find_by_id(parms['hardware_id'])
+        # Delete hardware_id from parms since we do not want to use to update the model object
+        parms.pop('hardware_id', None)
+        # Then update the safe object with the remaining values
+        for key, value in parms.items():
+            setattr(requested_safe, key, value)
+        # The set the last_updated field - and make sure the safe picks up the new settings
+        requested_safe.last_update = now
+        requested_safe.settings_changed()
+        requested_safe.save_to_db()
+        if 'unlock_time' in parms:
+            unlock_scheduler.schedule(requested_safe.hardware_id, requested_safe.unlock_time)
+        return {"safe": safe_ops_schema.dump(requested_safe)}, 200
+
+
+class SafeEvents(Resource):
+    """
+    GET a page of a safe's event history, newest first.  Only the safeholder and the active keyholder may see it.
+    Request args: hardware_id (mandatory), min_code/max_code event_code range, since/until time window,
+    limit (default 50) and cursor - the next_cursor returned with the previous page
+    :parameter
+    """
+    @classmethod
+    @jwt_required
+    def get(cls):
+        """
+        :parameter
+        """
+        parms = safe_events_get_schema.load(request.args)
+        this_user_id = get_jwt_identity()
+        requested_safe = SafeModel.find_by_id(parms['hardware_id'])
+        if not requested_safe:
+            return {"error": msgs.CLAIM_NO_SAFE}, 400
+        if requested_safe.safeholder_id != this_user_id:
+            if not ActiveRelationshipModel.find_for_keyholder(this_user_id, requested_safe.hardware_id):
+                return {"error": msgs.NOT_AUTHORISED}, 401
+        events = SafeEventModel.find_page(hardware_id=requested_safe.hardware_id,
+                                          limit=parms['limit'] + 1,
+                                          before=to_naive_utc(parms.get('cursor')),
+                                          since=to_naive_utc(parms.get('since')),
+                                          until=to_naive_utc(parms.get('until')),
+                                          min_code=parms.get('min_code'),
+                                          max_code=parms.get('max_code'))
+        # One extra event was fetched to tell whether there is another page
+        next_cursor = None
+        if len(events) > parms['limit']:
+            events = events[:parms['limit']]
+            next_cursor = events[-1].timestamp.isoformat()
+        return {"events": [safe_event_schema.dump(event) for event in events], "next_cursor": next_cursor}, 200
 
 
 class SafeSummary(Resource):
     """
     GET method only with no parameters to request summary of the logged on user's relationships; the safe, its status
-    the keyholder and safeholder displaynames
+    the keyholder and safeholder displaynames.
+    The mobile app polls this, so it is built from a single query and carries an ETag of its content - a poll
+    sending the ETag back in If-None-Match gets 304 Not Modified if nothing has changed
     :parameter
     """
     @classmethod
@@ -312,31 +505,30 @@ class SafeSummary(Resource):
         :parameter
         """
         this_user_id = get_jwt_identity()
-        this_user = UserModel.find_by_id(this_user_id)
-        relationship_list = RelationshipModel.find_any(this_user_id)
-        safe_list = SafeModel.find_by_safeholder_id(this_user_id)
         summary_list = []
-        safe_ids = []
-        # First scan the safes in relationships
-        for relationship in relationship_list:
-            safe_ids.append(relationship.safe.hardware_id)
-            summary_item = {'hardware_id': relationship.safe.hardware_id,
-                            'locked': all([relationship.safe.hinge_closed,
-                                          relationship.safe.lid_closed,
-                                          relationship.safe.bolt_engaged]),
-                            'safeholder_displayname': relationship.safeholder.displayname,
-                            'keyholder_displayname': relationship.keyholder.displayname}
-            summary_list.append(summary_item)
-        # then scan the safes not not in relationships
-        for safe in safe_list:
-            if safe.hardware_id not in safe_ids:
-                summary_item = {
-                    'hardware_id': safe.hardware_id,
-                    'locked': all([safe.hinge_closed,
-                                   safe.lid_closed,
-                                   safe.bolt_engaged]),
-                    'safeholder_displayname': this_user.displayname,
-                    'keyholder_displayname': None
-                }
+        own_safes = []
+        safe_ids = set()
+        # First the safes in relationships, then the user's safes not in relationships
+        for hardware_id, hinge_closed, lid_closed, bolt_engaged, owner_displayname, safeholder_id, keyholder_id, \
+                safeholder_displayname, keyholder_displayname in RelationshipModel.find_summary_rows(this_user_id):
+            locked = all([hinge_closed, lid_closed, bolt_engaged])
+            if this_user_id in (safeholder_id, keyholder_id):
+                safe_ids.add(hardware_id)
+                summary_list.append({'hardware_id': hardware_id,
+                                     'locked': locked,
+                                     'safeholder_displayname': safeholder_displayname,
+                                     'keyholder_displayname': keyholder_displayname})
+            else:
+                own_safes.append({'hardware_id': hardware_id,
+                                  'locked': locked,
+                                  'safeholder_displayname': owner_displayname,
+                                  'keyholder_displayname': None})
+        for summary_item in own_safes:
+            if summary_item['hardware_id'] not in safe_ids:
+                safe_ids.add(summary_item['hardware_id'])
                 summary_list.append(summary_item)
-        return {"safe_list": [safe_summary_schema.dump(item) for item in summary_list]}, 200
\ No newline at end of file
+        etag = hashlib.sha1(repr(summary_list).encode()).hexdigest()
+        headers = {"ETag": f'"{etag}"', "Cache-Control": "private, no-cache"}
+        if request.if_none_match.contains(etag):
+            return make_response('', 304, headers)
+        return {"safe_list": [safe_summary_schema.dump(item) for item in summary_list]}, 200, headers
\ No newline at end of file
@@ -1,18 +1,24 @@
-from typing import Tuple
-from datetime import datetime, timezone
+from typing import Tuple, List, Union
+from datetime import datetime, timedelta
 import logging
+import base64
 
 from flask_restful import Resource
 from flask import request, jsonify
 from flask_jwt_extended import jwt_required
 
-from models.safe import SafeModel, SafeEventModel
+from models.safe import SafeModel, heartbeat_buffer, unlock_scheduler
 from schemas.safe import SafeSchema
-from libs.crypto import Crypto
+from libs.checkin_parser import parse_checkin, parse_timestamp, to_naive_utc, CheckinMessage, CheckinParseError
+from libs.timing import timed
+from libs.admission import AdmissionMeter
+from libs.wire import negotiated, request_body, wants_binary
+from libs.crypto import make_crypto_handler, public_key_cache, SessionCrypto, SESSION_KEY_LIFETIME, SESSION_MAX_SKEW
 import messages.en as msgs
 
 safe_schema = SafeSchema()
-crypto_handler = Crypto()
+crypto_handler = make_crypto_handler()
+admission = AdmissionMeter()
 
 # Event codes, stored in the SAFE_EVENT table enable filtering of events that are of less interest
 event_codes = {
@@ -22,21 +28,8 @@ event_codes = {
     "SAFE_TERMINATED": 999
 }
 DEFAULT_EVENT = 800
+MAX_BATCH_CHECKINS = 100  # Largest number of safes accepted in one batch checkin
 
-def convert_timestamp(tstamp_str: str) -> datetime:
-    """
-    Convert a timestamp in string form into a timezone-aware python datetime object
-    :param tstamp: Timestamp in format YYYY-MM-DD HH:MM:SS.SSSSS
-    :return: pythin timestamp
-    """
-    # print(f"Diagnostic: convert timestamp: {tstamp_str} -> ", end='')
-    if "+" in tstamp_str or '-' in tstamp_str:
-        tstamp = datetime.strptime(tstamp_str, '%Y-%m-%d %H:%M:%S.%f%z')
-        tstamp = tstamp.replace(tzinfo=timezone.utc)
-    else:
-        tstamp = datetime.strptime(tstamp_str, '%Y-%m-%d %H:%M:%S.%f')
-    # print(tstamp)
-    return tstamp
 
 class SafeList(Resource):
     @classmethod
@@ -52,11 +45,12 @@ class AvailableSafes(Resource):
 
 class SafeRegister(Resource):
     @classmethod
+    @negotiated
     def post(cls):
         public_key = crypto_handler.pub_key()
-        parms = request.get_json()
-        print(f"Received register request: {parms}")
-        if 'hwid' in parms and 'pkey' in parms:
+        parms = request_body()
+        logging.debug(f"Received register request: {parms}")
+        if isinstance(parms, dict) and 'hwid' in parms and 'pkey' in parms:
             # Check if we have a safe with this id already
             this_safe = SafeModel.find_by_id(parms['hwid'])
             if this_safe:
@@ -72,78 +66,355 @@ class SafeRegister(Resource):
                         unlock_time=now
                 )
                 this_safe.save_to_db()
+                public_key_cache.invalidate(this_safe.hardware_id)
                 logging.info(f"SAFE: Registered new safe with hw_id: {parms['hwid']}")
                 return {"key": public_key.decode("utf-8")}, 200
         else:
             return {"error": msgs.SAFE_REGISTRATION_ERROR}, 400
 
+
+def session_request_time(this_safe: SafeModel, value: str, now: datetime) -> Union[datetime, None]:
+    """
+    Timestamp of a session handshake, as naive UTC, if it is fresh - within SESSION_MAX_SKEW seconds of now and
+    later than the last handshake accepted from the safe, so a captured handshake cannot be replayed to rotate
+    the safe's key
+    :return: the timestamp, or None if it is malformed or not fresh
+    """
+    try:
+        timestamp = to_naive_utc(parse_timestamp(value))
+    except CheckinParseError:
+        return None
+    if abs((timestamp - now).total_seconds()) > SESSION_MAX_SKEW:
+        return None
+    if this_safe.session_requested is not None and timestamp <= this_safe.session_requested:
+        return None
+    return timestamp
+
+
+class SafeSession(Resource):
+    """
+    RSA-authenticated handshake for a safe to obtain a short-lived AES-GCM session key.  The safe sends
+    {"hwid":, "msg":, "sig":} as for a checkin, where msg is "SESSION,<hwid>,<timestamp>" and the timestamp is
+    current and later than the safe's previous handshake.  Subsequent checkins may then be sent as
+    {"hwid":, "nonce":, "ct":} until the key expires.  Safes that never call this endpoint continue to use RSA
+    for every checkin
+    """
+    @classmethod
+    def post(cls):
+        now = datetime.utcnow()
+        parms = request.get_json(silent=True)
+        if isinstance(parms, dict) and isinstance(parms.get('hwid'), str) and \
+                all(map(lambda x: x in parms, ['sig', 'msg'])):
+            this_safe = SafeModel.find_by_id(parms['hwid'])
+            if this_safe:
+                msg_valid, message = crypto_handler.decrypt(msg=parms['msg'], sig=parms['sig'],
+                                                            pkey=this_safe.public_key,
+                                                            hwid=this_safe.hardware_id)
+                request_parts = message.split(',')
+                requested = None
+                if msg_valid and len(request_parts) == 3 and request_parts[0] == 'SESSION' \
+                        and request_parts[1] == this_safe.hardware_id:
+                    requested = session_request_time(this_safe, request_parts[2], now)
+                if requested is not None:
+                    session_key = SessionCrypto.new_key()
+                    this_safe.session_key = session_key
+                    this_safe.session_requested = requested
+                    this_safe.session_expires = now + timedelta(seconds=SESSION_KEY_LIFETIME)
+                    this_safe.save_to_db()
+                    logging.info(f"SAFE: Session key issued to {this_safe.hardware_id} "
+                                 f"expiring {this_safe.session_expires}")
+                    server_message = 'Session_key:{}\nExpires:{}'.format(
+                        base64.urlsafe_b64encode(session_key).decode('utf-8'), this_safe.session_expires)
+                    msg_enc_64, msg_sig_64 = crypto_handler.encrypt(msg=server_message,
+                                                                    safe_pkey=this_safe.public_key,
+                                                                    hwid=this_safe.hardware_id)
+                    return {"msg": msg_enc_64.decode('utf-8'), "sig": msg_sig_64.decode('utf-8')}, 200
+                logging.info(f"Invalid session request received from {parms['hwid']}")
+        return {"error": msgs.SAFE_CHECKIN_ERROR}, 400
+
+
+@timed('crypto')
+def open_checkin(this_safe: SafeModel, parms: dict, now: datetime) -> Tuple[bool, str]:
+    """
+    Authenticate and decrypt a checkin envelope - session-key mode if it carries nonce/ct, otherwise RSA
+    :param this_safe: Safe the envelope claims to come from
+    :param parms: The envelope
+    :param now: Time the checkin was received
+    :return: validity, decrypted message
+    """
+    if 'nonce' in parms and 'ct' in parms:
+        if not this_safe.session_active(now):
+            return False, ''
+        return SessionCrypto.decrypt(key=this_safe.session_key, hwid=this_safe.hardware_id,
+                                     nonce=parms['nonce'], ct=parms['ct'])
+    return crypto_handler.decrypt(msg=parms['msg'], sig=parms['sig'],
+                                  pkey=this_safe.public_key,
+                                  hwid=this_safe.hardware_id)
+
+
+def is_checkin_envelope(parms) -> bool:
+    """
+    True if parms has the fields of an RSA or a session-key checkin
+    """
+    return isinstance(parms, dict) and isinstance(parms.get('hwid'), str) and (
+        all(map(lambda x: x in parms, ['sig', 'msg'])) or all(map(lambda x: x in parms, ['nonce', 'ct'])))
+
+
+def apply_unlock_deadline(this_safe: SafeModel, now: datetime) -> bool:
+    """
+    Authorise the safe to unlock if its unlock time has passed.  Nothing is committed.
+    Only needed when the unlock scheduler is not running - otherwise it has already done this
+    :return: True if the safe was changed
+    """
+    if not unlock_scheduler.enabled and this_safe.unlock_due(now):
+        this_safe.auth_to_unlock = True
+        this_safe.settings_changed()
+        return True
+    return False
+
+
+def read_checkin(this_safe: SafeModel, parms: dict, now: datetime) -> Union[CheckinMessage, None]:
+    """
+    Authenticate, decrypt and parse a checkin envelope.  Timestamps are converted to naive UTC, as stored
+    :return: the parsed checkin, or None if it is invalid or malformed
+    """
+    msg_valid, message = open_checkin(this_safe, parms, now)
+    if not msg_valid:
+        logging.info(f"Invalid checkin message received from {this_safe.hardware_id}")
+        return None
+    try:
+        checkin = parse_checkin(message)
+    except CheckinParseError as e:
+        logging.info(f"Malformed checkin message received from {this_safe.hardware_id}: {e}")
+        return None
+    for error in checkin.errors:
+        logging.info(f"Skipped malformed checkin line from {this_safe.hardware_id}: {error}")
+    return checkin._replace(timestamp=to_naive_utc(checkin.timestamp),
+                            events=[event._replace(timestamp=to_naive_utc(event.timestamp))
+                                    for event in checkin.events])
+
+
+@timed('crypto')
+def seal_response(this_safe: SafeModel, server_message: str, session: bool = False) -> dict:
+    """
+    Encrypt a server message for the safe - signed RSA, or with its session key in session mode
+    :return: dict with encrypted message and signature, or nonce and ciphertext in session mode
+    """
+    if session:
+        nonce_64, ct_64 = SessionCrypto.encrypt(key=this_safe.session_key, hwid=this_safe.hardware_id,
+                                                msg=server_message)
+        return {"nonce": nonce_64, "ct": ct_64}
+    msg_enc_64, msg_sig_64 = crypto_handler.encrypt(msg=server_message,
+                                                    safe_pkey=this_safe.public_key,
+                                                    hwid=this_safe.hardware_id)
+    return {"msg": msg_enc_64.decode('utf-8'), "sig": msg_sig_64.decode('utf-8')}
+
+
+def next_checkin_delay(this_safe: SafeModel) -> int:
+    """
+    Seconds until the safe should check in again - its configured report interval, stretched under load
+    """
+    return admission.next_checkin(this_safe.hardware_id, this_safe.scan_freq, this_safe.report_freq,
+                                  this_safe.max_checkin_delay)
+
+
+def unchanged_response(this_safe: SafeModel, timestamp: datetime, session: bool = False) -> dict:
+    """
+    Response telling the safe its settings are still current, and when to check in next.  It echoes the
+    checkin's timestamp, so the safe can tell it apart from a replayed response to an earlier checkin
+    :param timestamp: Timestamp of the checkin being answered, as naive UTC
+    """
+    server_message = 'Unchanged:{}\nTimestamp:{}\nNext_checkin:{}'.format(this_safe.settings_version, timestamp,
+                                                                         next_checkin_delay(this_safe))
+    return seal_response(this_safe, server_message, session=session)
+
+
+def is_heartbeat(this_safe: SafeModel, checkin: CheckinMessage, now: datetime) -> bool:
+    """
+    True if applying this checkin would change nothing but last_update - no events, no new lock flags and
+    no unlock due - so it can go to the write-behind heartbeat buffer instead of being written through
+    """
+    if not heartbeat_buffer.enabled or checkin.events:
+        return False
+    if not unlock_scheduler.enabled and this_safe.unlock_due(now):
+        return False
+    return not ((checkin.hinge_closed and not this_safe.hinge_closed) or
+                (checkin.lid_closed and not this_safe.lid_closed) or
+                (checkin.bolt_engaged and not this_safe.bolt_engaged))
+
+
+def apply_checkin_message(this_safe: SafeModel, checkin: CheckinMessage, now: datetime) -> List[dict]:
+    """
+    Apply a parsed status checkin to the safe.  Nothing is committed.
+    :param this_safe: Safe that sent the message
+    :param checkin: Parsed checkin - a status line with its events
+    :param now: Time the checkin was received
+    :return: list of event rows to be stored
+    """
+    this_safe.last_update = checkin.timestamp
+    if checkin.hinge_closed:
+        this_safe.hinge_closed = True
+    if checkin.lid_closed:
+        this_safe.lid_closed = True
+    if checkin.bolt_engaged:
+        this_safe.bolt_engaged = True
+    # Now check if there are any time-based updates to make
+    apply_unlock_deadline(this_safe, now)
+    # Collect entries for the Safe events database
+    return [{"hardware_id": this_safe.hardware_id,
+             "event_code": event_codes.get(event.name, DEFAULT_EVENT),
+             "detail": event.name,
+             "timestamp": event.timestamp} for event in checkin.events]
+
+
+def checkin_response(this_safe: SafeModel, now: datetime, session: bool = False, versioned: bool = True) -> dict:
+    """
+    Construct the server's response to a checkin, encrypt and sign it
+    :param this_safe: Safe being responded to
+    :param now: Time the checkin was received
+    :param session: Respond with the safe's session key rather than RSA
+    :param versioned: Add the Version and Next_checkin lines.  Legacy firmware, which only sends RSA STATUS
+                      checkins as JSON, gets the original response without them
+    :return: dict with encrypted message and signature, or nonce and ciphertext in session mode
+    """
+    server_message_base = 'Auth_to_unlock:{}:{}\nUnlock_time:{}\nSettings:SCANFREQ={' \
+                          '}:REPORTFREQ={}:PROXIMITYUNIT={}:DISPLAYPROXIMITY={}'
+    if this_safe.auth_to_unlock:
+        auth_msg = 'TRUE'
+    else:
+        auth_msg = 'FALSE'
+    if this_safe.display_proximity:
+        disp_msg = 'TRUE'
+    else:
+        disp_msg = 'FALSE'
+    server_message = server_message_base.format(auth_msg, now, this_safe.unlock_time,
+                                                this_safe.scan_freq, this_safe.report_freq,
+                                                this_safe.proximity_unit, disp_msg)
+    if versioned:
+        server_message += '\nVersion:{}\nNext_checkin:{}'.format(this_safe.settings_version,
+                                                                 next_checkin_delay(this_safe))
+    return seal_response(this_safe, server_message, session=session)
+
+
 class SafeCheckin(Resource):
+    """
+    Safe checkin - JSON, or the binary envelope from libs.wire with Content-Type application/vnd.csafe.v1
+    """
     @classmethod
+    @admission.tracked
+    @negotiated
     def post(cls):
-        valid_request = False
         now = datetime.utcnow()
-        parms = request.get_json()
-        if all(map(lambda x: x in parms, ['hwid', 'sig', 'msg'])):
+        admission.record()
+        parms = request_body()
+        if is_checkin_envelope(parms):
             # Check if we have a safe with this ID
             this_safe = SafeModel.find_by_id(parms[ 'hwid' ])
             if this_safe:
+                session = 'nonce' in parms
+                if session and not this_safe.session_active(now):
+                    # Safe must renegotiate its session key, or fall back to RSA
+                    return {"error": msgs.SAFE_SESSION_EXPIRED}, 401
                 # Check message is valid
-                msg_valid, message = crypto_handler.decrypt(msg=parms['msg'], sig=parms['sig'],
-                                                            pkey=this_safe.public_key)
-                if msg_valid:
-                    # Interpret content and update database
-                    # Remember, message may be multiple lines
-                    print(f"Message received = {message}")
-                    if '\n' in message:
-                        message_lines = message.split('\n')
-                    else:
-                        message_lines = [message, ]
-                    status_parts = message_lines[0].split(',')
-                    if len(status_parts) == 6:
-                        this_safe.last_update = convert_timestamp(status_parts[2])
-                        if status_parts[3] == 'True':
-                            this_safe.hinge_closed = True
-                        if status_parts[4] == 'True':
-                            this_safe.lid_closed = True
-                        if status_parts[5] == 'True':
-                            this_safe.bolt_engaged = True
-                        # Now check if there are any time-based updates to make
-                        if this_safe.unlock_time < now:
-                            this_safe.auth_to_unlock = True
-                        this_safe.save_to_db()
-                        if len(message_lines) > 1:
-                            # Add entries to Safe events database
-                            for i in range(len(message_lines) - 1):
-                                if message_lines[i + 1].startswith('EVENT'):
-                                    event_parts = message_lines[i + 1].split(',')
-                                    if len(event_parts) == 3:
-                                        event = SafeEventModel(hardware_id=this_safe.hardware_id,
-                                                               event_code=event_codes.get(event_parts[2], DEFAULT_EVENT),
-                                                               detail=event_parts[2],
-                                                               timestamp=convert_timestamp(event_parts[1]))
-                                        event.save_to_db()
-                        logging.info(f"Safe parameters updated for {this_safe.hardware_id}")
-                        # Now construct a response, encrypt, sign and return it
-                        server_message_base = 'Auth_to_unlock:{}:{}\nUnlock_time:{}\nSettings:SCANFREQ={' \
-                                              '}:REPORTFREQ={}:PROXIMITYUNIT={}:DISPLAYPROXIMITY={}'
-                        if this_safe.auth_to_unlock:
-                            auth_msg = 'TRUE'
-                        else:
-                            auth_msg = 'FALSE'
-                        if this_safe.display_proximity:
-                            disp_msg = 'TRUE'
-                        else:
-                            disp_msg = 'FALSE'
-                        server_message = server_message_base.format(auth_msg, now, this_safe.unlock_time,
-                                                                    this_safe.scan_freq, this_safe.report_freq,
-                                                                    this_safe.proximity_unit, disp_msg)
-                        msg_enc_64, msg_sig_64 = crypto_handler.encrypt(msg=server_message,
-                                                                        safe_pkey=this_safe.public_key)
-                        return {"msg": msg_enc_64.decode('utf-8'), "sig": msg_sig_64.decode('utf-8')}, 200
-                else:
-                    logging.info(f"Invalid checking message received from {parms['hwid']}")
+                checkin = read_checkin(this_safe, parms, now)
+                if checkin is None:
                     return {"error": msgs.SAFE_CHECKIN_ERROR}, 400
+                if checkin.unchanged:
+                    # Nothing changed at the safe - only write through if the unlock deadline has passed
+                    if apply_unlock_deadline(this_safe, now) or not heartbeat_buffer.enabled:
+                        this_safe.last_update = checkin.timestamp
+                        this_safe.save_to_db()
+                    else:
+                        heartbeat_buffer.record(this_safe.hardware_id, checkin.timestamp)
+                    if checkin.settings_version == this_safe.settings_version:
+                        return unchanged_response(this_safe, checkin.timestamp, session=session), 200
+                    return checkin_response(this_safe, now, session=session), 200
+                # Legacy firmware sends RSA STATUS checkins as JSON, and expects the original response
+                versioned = session or wants_binary()
+                if is_heartbeat(this_safe, checkin, now):
+                    heartbeat_buffer.record(this_safe.hardware_id, checkin.timestamp)
+                    return checkin_response(this_safe, now, session=session, versioned=versioned), 200
+                # Interpret content and update database
+                events = apply_checkin_message(this_safe, checkin, now)
+                SafeModel.save_checkins_to_db([this_safe], events)
+                logging.info(f"Safe parameters updated for {this_safe.hardware_id}")
+                # Now construct a response, encrypt, sign and return it
+                return checkin_response(this_safe, now, session=session, versioned=versioned), 200
             else:
                 return {"error": msgs.SAFE_CHECKIN_ERROR}, 400
         logging.info(f"Improperly formed checkin request: {parms}")
         return {"error": msgs.SAFE_CHECKIN_ERROR}, 400
+
+
+class SafeBatchCheckin(Resource):
+    """
+    Checkin for several safes in one request - used by site gateways fronting many safes.
+    Body is {"checkins": [{"hwid":, "msg":, "sig":}, ...]} - session-key envelopes {"hwid":, "nonce":, "ct":} may
+    be mixed in.  All safes are loaded in one query and all updates and events are committed in one transaction.
+    Each item gets its own response or error, in request order
+    """
+    @classmethod
+    @admission.tracked
+    def post(cls):
+        now = datetime.utcnow()
+        parms = request.get_json()
+        checkins = parms.get('checkins') if isinstance(parms, dict) else None
+        if not isinstance(checkins, list) or not checkins:
+            logging.info(f"Improperly formed batch checkin request: {parms}")
+            return {"error": msgs.SAFE_CHECKIN_ERROR}, 400
+        if len(checkins) > MAX_BATCH_CHECKINS:
+            return {"error": msgs.SAFE_BATCH_TOO_LARGE.format(MAX_BATCH_CHECKINS)}, 400
+        admission.record(len(checkins))
+
+        # Items with a hwid that is not a string get the per-item error below
+        hwids = {item['hwid'] for item in checkins if isinstance(item, dict) and isinstance(item.get('hwid'), str)}
+        safes = {safe.hardware_id: safe for safe in SafeModel.find_by_ids(list(hwids))}
+        results = []
+        accepted = []
+        events = []
+        for item in checkins:
+            if not is_checkin_envelope(item):
+                results.append({"hwid": item.get('hwid') if isinstance(item, dict) else None,
+                                "error": msgs.SAFE_CHECKIN_ERROR})
+                continue
+            this_safe = safes.get(item['hwid'])
+            if this_safe is None:
+                results.append({"hwid": item['hwid'], "error": msgs.SAFE_CHECKIN_ERROR})
+                continue
+            if 'nonce' in item and not this_safe.session_active(now):
+                results.append({"hwid": item['hwid'], "error": msgs.SAFE_SESSION_EXPIRED})
+                continue
+            checkin = read_checkin(this_safe, item, now)
+            if checkin is None:
+                results.append({"hwid": item['hwid'], "error": msgs.SAFE_CHECKIN_ERROR})
+                continue
+            if checkin.unchanged:
+                if apply_unlock_deadline(this_safe, now) or not heartbeat_buffer.enabled:
+                    this_safe.last_update = checkin.timestamp
+                    accepted.append(this_safe)
+                else:
+                    heartbeat_buffer.record(this_safe.hardware_id, checkin.timestamp)
+                results.append({"hwid": item['hwid'], "session": 'nonce' in item,
+                                "version": checkin.settings_version, "timestamp": checkin.timestamp})
+                continue
+            if is_heartbeat(this_safe, checkin, now):
+                heartbeat_buffer.record(this_safe.hardware_id, checkin.timestamp)
+                results.append({"hwid": item['hwid'], "session": 'nonce' in item})
+                continue
+            events.extend(apply_checkin_message(this_safe, checkin, now))
+            accepted.append(this_safe)
+            results.append({"hwid": item['hwid'], "session": 'nonce' in item})
+        if accepted:
+            SafeModel.save_checkins_to_db(accepted, events)
+            logging.info(f"Safe parameters updated for {len(accepted)} safes in batch")
+        # Build responses once the batch is committed
+        for result in results:
+            if "error" not in result:
+                this_safe = safes[result['hwid']]
+                session = result.pop('session')
+                timestamp = result.pop('timestamp', None)
+                if result.pop('version', None) == this_safe.settings_version:
+                    result.update(unchanged_response(this_safe, timestamp, session=session))
+                else:
+                    result.update(checkin_response(this_safe, now, session=session))
+        return {"results": results}, 200
@@ -1,9 +1,4 @@
-from typing import Tuple
 import logging
-import os
-import hashlib
-import hmac
-import json
 import traceback
 
 from flask_restful import Resource
@@ -20,43 +15,23 @@ from models.confirmation import ConfirmationModel
 from models.user import UserModel
 from schemas.user import UserSchema
 from libs.mailgun import MailGunException
+from libs.ratelimit import auth_limiter, json_username
 import messages.en as msgs
 
 
 user_schema = UserSchema()
 
 
-def hash_new_password(password: str) -> Tuple[bytes, bytes]:
-    """
-    Hash the provided password with a randomly-generated salt and return the
-    salt and hash to store in the database.
-    """
-    salt = os.urandom(16)
-    pw_hash = hashlib.pbkdf2_hmac("sha256", password.encode(), salt, 100000)
-    return salt, pw_hash
-
-
-def is_correct_password(salt: bytes, pw_hash: bytes, password: str) -> bool:
-    """
-    Given a previously-stored salt and hash, and a password provided by a user
-    trying to log in, check whether the password is correct.
-    """
-    return hmac.compare_digest(
-        pw_hash, hashlib.pbkdf2_hmac("sha256", password.encode(), salt, 100000)
-    )
-
-
 def authenticate(username, password) -> "UserModel":
     this_user = UserModel.find_by_username(username)
     print(f"Calling Authenticate: User found = {username}")
-    if this_user and is_correct_password(
-        this_user.pw_salt, this_user.pw_hash, password
-    ):
+    if this_user and this_user.check_password(password):
         return this_user
 
 
 class UserRegister(Resource):
     @classmethod
+    @auth_limiter.throttled('register')
     def post(cls):
         user = user_schema.load(request.get_json())
         logging.info(f"USER REGISTER:  Passed user= {user}")
@@ -66,22 +41,19 @@ class UserRegister(Resource):
         if UserModel.find_by_email(user["email"]):
             return {"message": msgs.EMAIL_EXISTS}, 400
 
-        pw_salt, pw_hash = hash_new_password(password=user["password"])
         this_user = UserModel(
             id=None,
             username=user["username"],
             email=user["email"],
-            pw_salt=pw_salt,
-            pw_hash=pw_hash,
             displayname=user["displayname"]
         )
+        this_user.set_password(user["password"])
         try:
             this_user.save_to_db()
             confirmation = ConfirmationModel(this_user.id)
             confirmation.save_to_db()
-            resp = this_user.send_confirmation_email()
-            if resp:
-                logging.info(f"USER: Confirmation email sent: {json.loads(resp.text)['id']}")
+            message = this_user.send_confirmation_email()
+            logging.info(f"USER: Confirmation email queued: {message.id}")
             return {"message": msgs.CREATED.format(this_user.username)}, 201
         except MailGunException as e:
             logging.error(f"USER: Mailgun exception caught: {str(e)}")
@@ -94,6 +66,7 @@ class UserRegister(Resource):
             return {"error": msgs.FAILED_TO_CREATE.format(str(e))}, 500
 
     @classmethod
+    @auth_limiter.throttled('delete', username=json_username)
     @jwt_required
     def delete(cls):
         """
@@ -108,7 +81,7 @@ class UserRegister(Resource):
             f"Delete called by {db_user.id}: {db_user.username} with data: {user['username']}"
         )
         if db_user.username == user['username']:
-            if is_correct_password(db_user.pw_salt, db_user.pw_hash, user['password']):
+            if db_user.check_password(user['password']):
                 db_user.delete_from_db()
                 return {"message": msgs.DELETED.format(db_user.username)}, 200
             else:
@@ -118,17 +91,17 @@ class UserRegister(Resource):
 
 class UserLogin(Resource):
     @classmethod
+    @auth_limiter.throttled('login', username=json_username)
     def post(cls):
         login_user = user_schema.load(
             request.get_json(), partial=(["email","displayname"])  # OK to ignore absence of these when logging in
         )  # Login user is a dict
         this_user = UserModel.find_by_username(login_user["username"])
         # now check the user model returned from the login has the same password as the database user
-        if this_user and is_correct_password(
-            this_user.pw_salt, this_user.pw_hash, login_user["password"]
-        ):
-            confirmation = this_user.most_recent_confirmation
-            if confirmation and confirmation.confirmed:
+        if this_user and this_user.check_password(login_user["password"]):
+            if this_user.upgrade_password(login_user["password"]):
+                logging.info(f"LOGIN: Password rehashed for UserID {this_user.id}")
+            if this_user.confirmed_at is not None:
                 access_token = create_access_token(identity=this_user.id, fresh=True)
                 refresh_token = create_refresh_token(this_user.id)
                 return (
@@ -1,4 +1,4 @@
-from marshmallow import Schema, fields
+from marshmallow import Schema, fields, validate
 from marshmallow_sqlalchemy import SQLAlchemyAutoSchema
 
 
@@ -16,12 +16,29 @@ class SafeOpsSchema(Schema):
     unlock_time = fields.DateTime()
     scan_freq = fields.Int()
     report_freq = fields.Int()
+    max_checkin_delay = fields.Int(allow_none=True, validate=validate.Range(min=1))
     proximity_unit = fields.String()
     display_proximity = fields.Boolean()
     bolt_engaged = fields.Boolean(dump_only=True)
     hinge_closed = fields.Boolean(dump_only=True)
     lid_closed = fields.Boolean(dump_only=True)
 
+class SafeEventsGetSchema(Schema):
+    hardware_id = fields.String(required=True)
+    min_code = fields.Int()
+    max_code = fields.Int()
+    since = fields.DateTime()
+    until = fields.DateTime()
+    cursor = fields.DateTime()
+    limit = fields.Int(validate=validate.Range(min=1, max=500), missing=50)
+
+
+class SafeEventSchema(Schema):
+    timestamp = fields.DateTime()
+    event_code = fields.Int()
+    detail = fields.String()
+
+
 class SafeSummarySchema(Schema):
     hardware_id = fields.String()
     locked = fields.Boolean()
@@ -1,5 +1,5 @@
 from marshmallow_sqlalchemy import SQLAlchemyAutoSchema
-from marshmallow import Schema, fields
+from marshmallow import Schema, fields, validate, validates_schema, ValidationError
 
 from models.relationship import RelationshipModel, RelationshipMessageModel
 
@@ -19,12 +19,51 @@ class RelationshipMessageSchema(SQLAlchemyAutoSchema):
         load_instance = False
 
 
+class MessageSchema(Schema):
+    """
+    A relationship message as RelationshipMessageSchema dumps it, from the message's own columns - dumping
+    through the ORM relationships would load them for every message
+    """
+    id = fields.Int()
+    message = fields.String()
+    message_timestamp = fields.DateTime()
+    seen_by_kh = fields.DateTime()
+    seen_by_sh = fields.DateTime()
+    originator = fields.Int(attribute='originator_id')
+    relationship = fields.Int(attribute='relationship_id')
+
+
 class MessageGetSchema(Schema):
     type = fields.String(required=True)
     relationship_id = fields.Int(required=True)
+    before_id = fields.Int()  # Older messages than this one - the before_id of the previous page
+    after_id = fields.Int()  # Newer messages than this one - the after_id of the last poll
+    limit = fields.Int(validate=validate.Range(min=1, max=200), missing=50)
+
+    @validates_schema
+    def validate_cursor(self, data, **kwargs):
+        if 'before_id' in data and 'after_id' in data:
+            raise ValidationError('Give before_id or after_id, not both', 'after_id')
 
 
 class MessagePostSchema(Schema):
     relationship_id = fields.Int(required=True)
     message = fields.String(required=True)
 
+
+class MessageStreamSchema(Schema):
+    relationship_id = fields.Int(required=True)
+    last_event_id = fields.Int()  # For clients that cannot send the Last-Event-ID header
+
+
+class MessageReadSchema(Schema):
+    relationship_id = fields.Int(required=True)
+    up_to_id = fields.Int(required=True)  # Newest message the user has read
+
+
+class UnreadCountSchema(Schema):
+    relationship_id = fields.Int()
+    safe_id = fields.String()
+    role = fields.String()
+    active = fields.Boolean()
+    unread = fields.Int()
@@ -8,5 +8,6 @@ class SafeSchema(SQLAlchemyAutoSchema):
     class Meta:
         model = SafeModel
         load_only = ('public_key', 'displayname')
+        exclude = ('session_key',)
         include_relationships = True
         load_instance = True
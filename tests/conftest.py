@@ -0,0 +1,170 @@
+"""
+Fixtures for the test suite.  The app is imported once, against an in-memory SQLite database and
+default_config, with the background threads (mail sender, unlock scheduler, heartbeat flushes) turned off so
+only the test's own requests touch the database.  Every test starts with empty tables, caches and rate limits.
+
+    python -m pytest -q
+"""
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+import os
+import sys
+import threading
+
+import pytest
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+
+def server_key(password: str = 'test'):
+    """
+    A throwaway server key in the form Crypto() expects - PEM with escaped newlines, and its passphrase
+    """
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048, backend=default_backend())
+    pem = key.private_bytes(encoding=serialization.Encoding.PEM,
+                            format=serialization.PrivateFormat.PKCS8,
+                            encryption_algorithm=serialization.BestAvailableEncryption(password.encode('utf-8')))
+    return pem.decode('utf-8').strip().replace('\n', '\\n'), password
+
+
+# Set before collection - test modules that import libs or models at the top read their settings then
+os.environ['APPLICATION_SETTINGS'] = os.path.join(ROOT, 'default_config.py')
+os.environ['DATABASE_URL'] = 'sqlite://'
+os.environ.update({'MAIL_DOMAIN': 'test.example', 'MAILGUN_API_KEY': 'key-test', 'CSAFE_MAIL_POLL_SECS': '0',
+                   'CSAFE_UNLOCK_TICK_SECS': '0', 'CSAFE_HEARTBEAT_FLUSH_SECS': '0'})
+os.environ['CSAFE_KEY'], os.environ['CSAFE_KPWD'] = server_key()
+
+
+@pytest.fixture(scope='session')
+def app():
+    from app import app as flask_app
+    flask_app.config['TESTING'] = True
+    return flask_app
+
+
+@pytest.fixture
+def db(app):
+    from db import db as database
+    from libs.identity_cache import identity_cache, LocalIdentityBackend
+    from libs.ratelimit import auth_limiter, LocalBackend
+    with app.app_context():
+        database.drop_all()
+        database.create_all()
+        identity_cache.backend = LocalIdentityBackend()
+        auth_limiter.backend = LocalBackend()
+        yield database
+        database.session.remove()
+
+
+@pytest.fixture
+def client(app, db):
+    return app.test_client()
+
+
+@pytest.fixture
+def auth_headers(app):
+    from flask_jwt_extended import create_access_token
+
+    def headers(user_id: int) -> dict:
+        with app.app_context():
+            return {'Authorization': f"Bearer {create_access_token(identity=user_id, fresh=True)}"}
+    return headers
+
+
+@pytest.fixture
+def make_user(db):
+    from models.user import UserModel
+
+    def make(username: str, displayname: str = None) -> int:
+        user = UserModel(username=username, email=f"{username}@example.com", displayname=displayname or username,
+                         pw_salt=b'-', pw_hash=b'-')
+        db.session.add(user)
+        db.session.commit()
+        return user.id
+    return make
+
+
+@pytest.fixture
+def count_queries(db):
+    """
+    Context manager counting the SQL statements this thread runs inside it - yields a one-item list
+    """
+    from sqlalchemy import event
+
+    @contextmanager
+    def counting():
+        count = [0]
+        thread = threading.get_ident()
+
+        def listener(*_):
+            if threading.get_ident() == thread:
+                count[0] += 1
+        event.listen(db.engine, 'before_cursor_execute', listener)
+        try:
+            yield count
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', listener)
+    return counting
+
+
+@pytest.fixture
+def safe(db):
+    """
+    A registered safe 'HW1', as a benchmarks.sim_safe.SimulatedSafe holding the server's public key
+    """
+    from benchmarks.sim_safe import SimulatedSafe
+    from models.safe import SafeModel
+    from resources.safe import crypto_handler
+    simulated = SimulatedSafe('HW1')
+    simulated.set_server_key(crypto_handler.pub_key().decode('utf-8'))
+    now = datetime.utcnow()
+    db.session.add(SafeModel(hardware_id='HW1', public_key=simulated.public_key_pem, last_update=now,
+                             unlock_time=now + timedelta(days=1)))
+    db.session.commit()
+    return simulated
+
+
+@pytest.fixture
+def relationship(client, make_user, auth_headers):
+    """
+    A keyholder in an active relationship with the safeholder of safe 'HW-R', set up through the claim endpoint.
+    Has the user ids, their auth headers, the relationship_id and the claim body that releases it
+    """
+    from types import SimpleNamespace
+    from db import db
+    from models.safe import SafeModel
+    sh_id, kh_id = make_user('sh', displayname='SH'), make_user('kh', displayname='KH')
+    now = datetime.utcnow()
+    db.session.add(SafeModel(hardware_id='HW-R', safeholder_id=sh_id, digital_key='key-r', last_update=now,
+                             unlock_time=now + timedelta(days=1)))
+    db.session.commit()
+    kh_headers = auth_headers(kh_id)
+    claim = {'displayname': 'SH', 'digital_key': 'key-r'}
+    response = client.post('/operation/claim_sh', headers=kh_headers, json=claim)
+    assert response.status_code == 200, response.json
+    relationship_id = client.get('/operation/message/unread', headers=kh_headers).json['relationships'][0][
+        'relationship_id']
+    return SimpleNamespace(sh_id=sh_id, kh_id=kh_id, sh_headers=auth_headers(sh_id), kh_headers=kh_headers,
+                           hwid='HW-R', relationship_id=relationship_id, claim=claim)
+
+
+@pytest.fixture
+def post_messages(client, relationship):
+    """
+    Post count messages to the relationship, from the safeholder unless other headers are given
+    :return: ids of all the relationship's messages, oldest first
+    """
+    def post(count: int, headers: dict = None) -> list:
+        for i in range(count):
+            response = client.post('/operation/message', headers=headers or relationship.sh_headers,
+                                   json={'relationship_id': relationship.relationship_id, 'message': f"m{i}"})
+            assert response.status_code == 200, response.json
+        response = client.get('/operation/message', headers=relationship.kh_headers,
+                              query_string={'relationship_id': relationship.relationship_id, 'type': 'all',
+                                            'limit': 200})
+        return [message['id'] for message in reversed(response.json['messages'])]
+    return post
@@ -0,0 +1,66 @@
+"""
+Safe checkins - timestamps are stored as naive UTC whatever offset the safe sends, the "unchanged" response
+echoes the checkin's timestamp, so a response captured for one checkin is not a valid answer to another, and
+legacy RSA STATUS checkins get the original response
+"""
+from datetime import datetime, timedelta, timezone
+
+
+def unchanged(timestamp: datetime) -> str:
+    return f"UNCHANGED,HW1,{timestamp},0"
+
+
+def test_unchanged_response_echoes_timestamp(client, safe):
+    first, second = datetime.now(timezone.utc), datetime.now(timezone.utc) + timedelta(seconds=1)
+    responses = []
+    for timestamp in (first, second):
+        response = client.post('/api/checkin', json=safe.envelope(unchanged(timestamp)))
+        assert response.status_code == 200, response.json
+        responses.append(safe.read_response(response.json).split('\n'))
+    assert responses[0][0] == responses[1][0] == 'Unchanged:0'
+    assert responses[0][1] == f"Timestamp:{first.replace(tzinfo=None)}"
+    assert responses[1][1] == f"Timestamp:{second.replace(tzinfo=None)}"
+    assert responses[0][2].startswith('Next_checkin:')
+
+
+def test_batch_unchanged_response_echoes_timestamp(client, safe):
+    timestamp = datetime.now(timezone.utc)
+    response = client.post('/api/checkin/batch', json={'checkins': [safe.envelope(unchanged(timestamp))]})
+    assert response.status_code == 200, response.json
+    result = response.json['results'][0]
+    assert safe.read_response(result).split('\n')[:2] == ['Unchanged:0', f"Timestamp:{timestamp.replace(tzinfo=None)}"]
+
+
+def test_timestamps_stored_as_naive_utc(client, safe):
+    from models.safe import SafeModel, SafeEventModel
+    offset = timezone(timedelta(hours=10))
+    timestamp = datetime(2026, 3, 1, 20, 30, tzinfo=offset)
+    message = f"STATUS,HW1,{timestamp},True,True,True\nEVENT,{timestamp - timedelta(minutes=1)},SAFE_LOCKED"
+    response = client.post('/api/checkin', json=safe.envelope(message))
+    assert response.status_code == 200, response.json
+    assert SafeModel.find_by_id('HW1').last_update == datetime(2026, 3, 1, 10, 30)
+    assert [event.timestamp for event in SafeEventModel.query.all()] == [datetime(2026, 3, 1, 10, 29)]
+
+
+def test_unicode_digit_version_rejected(client, safe):
+    response = client.post('/api/checkin', json=safe.envelope(f"UNCHANGED,HW1,{datetime.now(timezone.utc)},\u00b2"))
+    assert response.status_code == 400
+
+
+def test_legacy_status_response_unchanged(client, safe):
+    from models.safe import SafeModel
+    timestamp = datetime.now(timezone.utc)
+    response = client.post('/api/checkin', json=safe.envelope(f"STATUS,HW1,{timestamp},True,True,True"))
+    assert response.status_code == 200, response.json
+    this_safe = SafeModel.find_by_id('HW1')
+    lines = safe.read_response(response.json).split('\n')
+    assert len(lines) == 3 and lines[0].startswith('Auth_to_unlock:FALSE:')
+    assert lines[1:] == [f"Unlock_time:{this_safe.unlock_time}",
+                         "Settings:SCANFREQ=300:REPORTFREQ=1:PROXIMITYUNIT=M:DISPLAYPROXIMITY=TRUE"]
+
+
+def test_stale_unchanged_gets_versioned_response(client, safe):
+    response = client.post('/api/checkin', json=safe.envelope(f"UNCHANGED,HW1,{datetime.now(timezone.utc)},7"))
+    assert response.status_code == 200, response.json
+    lines = safe.read_response(response.json).split('\n')
+    assert lines[3] == 'Version:0' and lines[4].startswith('Next_checkin:')
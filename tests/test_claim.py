@@ -0,0 +1,78 @@
+"""
+POST and DELETE /operation/claim_sh - a keyholder claiming and releasing a safeholder looks the safe up by its
+digital key and its active relationship directly, so the work does not grow with the safe's ended relationships
+"""
+from datetime import date, datetime, timedelta
+
+import pytest
+
+
+@pytest.fixture
+def safe_with_history(db, make_user):
+    """
+    A safe with its own safeholder and a number of ended relationships with the keyholder
+    """
+    from models.relationship import RelationshipModel
+    from models.safe import SafeModel
+
+    def make(keyholder_id: int, history: int) -> dict:
+        now = datetime.utcnow()
+        safeholder_id = make_user(f"sh{history}", displayname=f"SH {history}")
+        db.session.add(SafeModel(hardware_id=f"HW{history}", safeholder_id=safeholder_id,
+                                 digital_key=f"key-{history}", last_update=now, unlock_time=now))
+        db.session.add_all([RelationshipModel(keyholder_id=keyholder_id, safeholder_id=safeholder_id,
+                                              safe_id=f"HW{history}", start_date=date.today() - timedelta(days=i + 1),
+                                              end_date=date.today() - timedelta(days=i))
+                            for i in range(history)])
+        db.session.commit()
+        return {'displayname': f"SH {history}", 'digital_key': f"key-{history}"}
+    return make
+
+
+def test_claim_and_release_query_count_is_bounded(client, make_user, auth_headers, count_queries,
+                                                  safe_with_history):
+    keyholder_id = make_user('kh')
+    headers = auth_headers(keyholder_id)
+    claims = {history: safe_with_history(keyholder_id, history) for history in (0, 50)}
+    # Warm up on a safe of its own, so both measured runs find the same users already loaded
+    warm_up = safe_with_history(keyholder_id, 1)
+    client.post('/operation/claim_sh', headers=headers, json=warm_up)
+    client.delete('/operation/claim_sh', headers=headers, json=warm_up)
+    counts = {}
+    for history, claim in claims.items():
+        with count_queries() as claim_queries:
+            response = client.post('/operation/claim_sh', headers=headers, json=claim)
+        assert response.status_code == 200, response.json
+        with count_queries() as release_queries:
+            response = client.delete('/operation/claim_sh', headers=headers, json=claim)
+        assert response.status_code == 200, response.json
+        counts[history] = (claim_queries[0], release_queries[0])
+    assert counts[0] == counts[50]
+
+
+def test_claim_refused_while_safe_in_relationship(client, make_user, auth_headers, safe_with_history):
+    keyholder_id = make_user('kh')
+    claim = safe_with_history(keyholder_id, 3)
+    assert client.post('/operation/claim_sh', headers=auth_headers(keyholder_id), json=claim).status_code == 200
+    other_headers = auth_headers(make_user('kh2'))
+    response = client.post('/operation/claim_sh', headers=other_headers, json=claim)
+    assert response.status_code == 401
+    # Only the keyholder in the active relationship may release it
+    assert client.delete('/operation/claim_sh', headers=other_headers, json=claim).status_code == 401
+
+
+def test_release_ends_relationship_and_unlocks(client, db, make_user, auth_headers, safe_with_history):
+    from models.relationship import ActiveRelationshipModel, RelationshipModel
+    from models.safe import SafeModel
+    keyholder_id = make_user('kh')
+    headers = auth_headers(keyholder_id)
+    claim = safe_with_history(keyholder_id, 2)
+    client.post('/operation/claim_sh', headers=headers, json=claim)
+    assert client.delete('/operation/claim_sh', headers=headers, json=claim).status_code == 200
+    assert ActiveRelationshipModel.find('HW2') is None
+    assert all(r.end_date is not None for r in RelationshipModel.find_by_safe_id('HW2'))
+    safe = SafeModel.find_by_id('HW2')
+    assert safe.auth_to_unlock and safe.digital_key != claim['digital_key']
+    # The released keyholder can no longer change the safe
+    response = client.post('/operation/safe', headers=headers, json={'hardware_id': 'HW2', 'scan_freq': 60})
+    assert response.status_code == 400
@@ -0,0 +1,30 @@
+"""
+Confirmations - following the link confirms the user, and `flask purge-confirmations` deletes unconfirmed
+confirmations once their grace period after expiry has passed, keeping confirmed and recently expired ones
+"""
+from time import time
+
+
+def test_confirm_then_purge(app, client, db, make_user):
+    from models.confirmation import ConfirmationModel
+    from models.user import UserModel
+    user_id = make_user('carol')
+    used, stale, recent = (ConfirmationModel(user_id) for _ in range(3))
+    db.session.add_all([used, stale, recent])
+    db.session.commit()
+    response = client.get(f"/confirm/{used.id}")
+    assert response.status_code == 200
+    assert UserModel.query.get(user_id).confirmed_at is not None
+    assert client.get(f"/confirm/{used.id}").status_code == 400
+
+    now = int(time())
+    used.expire_at = stale.expire_at = now - 25 * 3600
+    recent.expire_at = now - 3600
+    db.session.commit()
+    ids = {'used': used.id, 'stale': stale.id, 'recent': recent.id}
+    result = app.test_cli_runner().invoke(args=['purge-confirmations', '--grace-hours', '24', '--batch', '1'])
+    assert result.exit_code == 0, result.output
+    assert result.output.strip() == "1 expired confirmations purged"
+    assert {name for name, _id in ids.items() if ConfirmationModel.find_by_id(_id)} == {'used', 'recent'}
+    assert client.get(f"/confirm/{ids['stale']}").status_code == 404
+    assert client.get(f"/confirm/{ids['recent']}").status_code == 400
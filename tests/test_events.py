@@ -0,0 +1,64 @@
+"""
+Safe events - bulk_insert skips events a safe retransmits, with the database's insert-or-ignore form or, where
+it has none, one savepoint per event; GET /operation/events pages through them newest first by timestamp cursor
+"""
+from datetime import datetime, timedelta
+
+import pytest
+
+
+@pytest.fixture
+def safe(db):
+    from models.safe import SafeModel
+    now = datetime.utcnow()
+    db.session.add(SafeModel(hardware_id='HW1', last_update=now, unlock_time=now))
+    db.session.commit()
+    return 'HW1'
+
+
+def events(start: int, stop: int) -> list:
+    t0 = datetime(2026, 1, 1)
+    return [{'hardware_id': 'HW1', 'timestamp': t0 + timedelta(seconds=i), 'event_code': i, 'detail': f"e{i}"}
+            for i in range(start, stop)]
+
+
+@pytest.mark.parametrize('insert_or_ignore', [True, False])
+def test_bulk_insert_skips_stored_events(db, safe, monkeypatch, insert_or_ignore):
+    from models.safe import SafeEventModel
+    if not insert_or_ignore:
+        monkeypatch.setattr(SafeEventModel, 'insert_ignore', classmethod(lambda cls: None))
+    SafeEventModel.bulk_insert(events(0, 5))
+    db.session.commit()
+    # Overlaps what is stored, and repeats an event within the batch
+    SafeEventModel.bulk_insert(events(3, 8) + events(7, 8))
+    db.session.commit()
+    stored = SafeEventModel.query.filter_by(hardware_id='HW1').order_by(SafeEventModel.timestamp).all()
+    assert [event.event_code for event in stored] == list(range(8))
+
+
+def test_event_history_pages_by_cursor(client, relationship, make_user, auth_headers):
+    from db import db
+    from models.safe import SafeEventModel
+    t0 = datetime(2026, 1, 1)
+    SafeEventModel.bulk_insert([{'hardware_id': relationship.hwid, 'timestamp': t0 + timedelta(minutes=i),
+                                 'event_code': i % 3 + 1, 'detail': f"e{i}"} for i in range(7)])
+    db.session.commit()
+    query = {'hardware_id': relationship.hwid, 'limit': 3}
+    pages = []
+    while True:
+        response = client.get('/operation/events', headers=relationship.sh_headers, query_string=query)
+        assert response.status_code == 200, response.json
+        pages.append([event['detail'] for event in response.json['events']])
+        if response.json['next_cursor'] is None:
+            break
+        query['cursor'] = response.json['next_cursor']
+    assert pages == [['e6', 'e5', 'e4'], ['e3', 'e2', 'e1'], ['e0']]
+    # Filtered by code and time window, as the active keyholder
+    response = client.get('/operation/events', headers=relationship.kh_headers,
+                          query_string={'hardware_id': relationship.hwid, 'min_code': 2, 'max_code': 2,
+                                        'since': (t0 + timedelta(minutes=1)).isoformat(),
+                                        'until': (t0 + timedelta(minutes=5)).isoformat()})
+    assert [event['detail'] for event in response.json['events']] == ['e4', 'e1']
+    response = client.get('/operation/events', headers=auth_headers(make_user('eve')),
+                          query_string={'hardware_id': relationship.hwid})
+    assert response.status_code == 401
@@ -0,0 +1,40 @@
+"""
+libs/forksafe.py - a PerProcess value is made once per process, and again in a forked child
+"""
+import os
+
+from libs.forksafe import PerProcess
+
+
+def test_made_once_per_process():
+    made = []
+    value = PerProcess(lambda: made.append(os.getpid()) or len(made))
+    assert not value.started
+    assert value.get() == value.get() == 1
+    assert value.started and made == [os.getpid()]
+
+
+def test_made_again_after_fork():
+    value = PerProcess(os.getpid)
+    assert value.get() == os.getpid()
+    read, write = os.pipe()
+    child = os.fork()
+    if child == 0:
+        os.close(read)
+        ok = not value.started and value.get() == os.getpid() and value.started
+        os.write(write, b'1' if ok else b'0')
+        os._exit(0)
+    os.close(write)
+    result = os.read(read, 1)
+    os.close(read)
+    os.waitpid(child, 0)
+    assert result == b'1'
+    assert value.get() != child
+
+
+def test_reset():
+    made = []
+    value = PerProcess(lambda: made.append(1) or object())
+    first = value.get()
+    assert value.reset() is first and not value.started
+    assert value.get() is not first and len(made) == 2
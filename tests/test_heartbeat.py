@@ -0,0 +1,60 @@
+"""
+The heartbeat buffer - checkins that change nothing but last_update are held in memory and written in bulk,
+while checkins that change the safe are written through.  A flush never moves last_update backwards
+"""
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+
+@pytest.fixture
+def buffered(monkeypatch):
+    """
+    Turn the heartbeat buffer on, flushed only by the test
+    """
+    from libs.forksafe import PerProcess
+    from models.safe import heartbeat_buffer
+    monkeypatch.setattr(heartbeat_buffer, 'flush_secs', 3600)
+    monkeypatch.setattr(heartbeat_buffer, '_thread', PerProcess(lambda: None))
+    yield heartbeat_buffer
+    heartbeat_buffer.flush()
+
+
+def checkin(client, safe, timestamp: datetime, event: str = None):
+    message = f"STATUS,HW1,{timestamp},True,True,True"
+    if event:
+        message += f"\nEVENT,{timestamp},{event}"
+    response = client.post('/api/checkin', json=safe.envelope(message))
+    assert response.status_code == 200, response.json
+
+
+def last_update() -> datetime:
+    from db import db
+    from models.safe import SafeModel
+    db.session.expire_all()
+    return SafeModel.find_by_id('HW1').last_update
+
+
+def test_heartbeats_buffered_and_flushed_forward(client, safe, buffered):
+    start = datetime(2026, 5, 1, 12, 0, tzinfo=timezone.utc)
+    t = [(start + timedelta(minutes=i)).replace(tzinfo=None) for i in range(6)]
+    checkin(client, safe, start, event='SAFE_LOCKED')
+    assert last_update() == t[0]
+
+    checkin(client, safe, start + timedelta(minutes=1))
+    assert last_update() == t[0]
+    assert buffered.pending('HW1') == t[1]
+
+    # A state change is written through while a heartbeat is pending; an older heartbeat does not replace a newer
+    checkin(client, safe, start + timedelta(minutes=4), event='SAFE_OPENED')
+    assert last_update() == t[4]
+    checkin(client, safe, start + timedelta(minutes=3))
+    checkin(client, safe, start + timedelta(minutes=2))
+    assert buffered.pending('HW1') == t[3]
+    assert buffered.flush() == 1
+    assert last_update() == t[4]
+
+    checkin(client, safe, start + timedelta(minutes=5))
+    assert buffered.flush() == 1
+    assert last_update() == t[5]
+    assert buffered.stats()["pending"] == 0
@@ -0,0 +1,42 @@
+"""
+The identity cache - the user a JWT endpoint acts for is cached across requests, and saving or deleting the
+user through UserModel drops the cached copy, so the next request sees the change
+"""
+from datetime import datetime, timedelta
+import logging
+
+
+def test_saved_user_seen_by_next_request(client, db, make_user, auth_headers, caplog):
+    from libs.identity_cache import identity_cache
+    from models.safe import SafeModel
+    from models.user import UserModel
+    sh_id, kh_id = make_user('sh', displayname='SH'), make_user('kh', displayname='KH')
+    now = datetime.utcnow()
+    db.session.add(SafeModel(hardware_id='HW-C', safeholder_id=sh_id, digital_key='key-c', last_update=now,
+                             unlock_time=now + timedelta(days=1)))
+    db.session.commit()
+    headers = auth_headers(kh_id)
+    response = client.post('/operation/claim_sh', headers=headers, json={'displayname': 'SH', 'digital_key': 'x'})
+    assert response.status_code == 401
+    assert identity_cache.backend.get(kh_id)['username'] == 'kh'
+
+    keyholder = UserModel.query.get(kh_id)
+    keyholder.username = 'kate'
+    keyholder.save_to_db()
+    caplog.set_level(logging.INFO)
+    response = client.post('/operation/claim_sh', headers=headers, json={'displayname': 'SH', 'digital_key': 'key-c'})
+    assert response.status_code == 200, response.json
+    assert "RELATIONSHIP: START kate - sh" in caplog.messages
+
+
+def test_deleted_user_dropped(client, make_user, auth_headers):
+    from libs.identity_cache import identity_cache
+    from models.user import UserModel
+    user_id = make_user('bob')
+    response = client.post('/operation/claim_safe', headers=auth_headers(user_id), json={'hardware_id': 'NONE'})
+    assert response.status_code == 400
+    assert identity_cache.backend.get(user_id) is not None
+
+    UserModel.query.get(user_id).delete_from_db()
+    assert identity_cache.backend.get(user_id) is None
+    assert identity_cache.get(user_id) is None
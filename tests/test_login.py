@@ -0,0 +1,43 @@
+"""
+Login (POST /login) - a verified password stored with an outdated work factor is rehashed, and the login
+still succeeds when the hashing pool is too busy to rehash it
+"""
+from datetime import datetime
+
+import pytest
+
+
+@pytest.fixture
+def old_hash_user(db, make_user):
+    from libs.passwords import PasswordHasher
+    from models.user import UserModel
+    user = UserModel.query.get(make_user('alice'))
+    user.pw_salt, user.pw_hash, user.pw_algorithm, user.pw_iterations = \
+        PasswordHasher(iterations=1000).hash_new('correct horse')
+    user.confirmed_at = datetime.utcnow()
+    db.session.commit()
+    return user.id
+
+
+def stored_iterations(user_id: int) -> int:
+    from models.user import UserModel
+    return UserModel.query.get(user_id).pw_iterations
+
+
+def test_login_rehashes_outdated_password(client, old_hash_user):
+    from libs.passwords import password_hasher
+    response = client.post('/login', json={'username': 'alice', 'password': 'correct horse'})
+    assert response.status_code == 200, response.json
+    assert stored_iterations(old_hash_user) == password_hasher.iterations
+
+
+def test_login_succeeds_when_rehash_busy(client, old_hash_user, monkeypatch):
+    from libs.passwords import password_hasher, HashingBusy
+
+    def busy(password):
+        raise HashingBusy()
+    monkeypatch.setattr(password_hasher, 'hash_new', busy)
+    response = client.post('/login', json={'username': 'alice', 'password': 'correct horse'})
+    assert response.status_code == 200, response.json
+    assert 'access_token' in response.json
+    assert stored_iterations(old_hash_user) == 1000
@@ -0,0 +1,46 @@
+"""
+Relationship messages - only the two parties may read them, history pages back by keyset and new messages are
+polled with after_id
+"""
+import pytest
+
+
+@pytest.mark.parametrize('endpoint, args', [('/operation/message', {'type': 'all'}),
+                                            ('/operation/message', {'type': 'unread'}),
+                                            ('/operation/message/stream', {})])
+def test_outsider_cannot_read_messages(client, relationship, post_messages, make_user, auth_headers, endpoint,
+                                       args):
+    post_messages(1)
+    response = client.get(endpoint, headers=auth_headers(make_user('eve')),
+                          query_string=dict(args, relationship_id=relationship.relationship_id))
+    assert response.status_code == 401
+
+
+def test_outsider_cannot_post_or_mark_read(client, relationship, make_user, auth_headers):
+    headers = auth_headers(make_user('eve'))
+    response = client.post('/operation/message', headers=headers,
+                           json={'relationship_id': relationship.relationship_id, 'message': 'hello'})
+    assert response.status_code == 400
+    response = client.post('/operation/message/read', headers=headers,
+                           json={'relationship_id': relationship.relationship_id, 'up_to_id': 1})
+    assert response.status_code == 401
+
+
+def test_history_pages_back_and_polls_forward(client, relationship, post_messages):
+    ids = post_messages(5)
+    query = {'relationship_id': relationship.relationship_id, 'type': 'all', 'limit': 2}
+    pages = []
+    while True:
+        response = client.get('/operation/message', headers=relationship.sh_headers, query_string=query)
+        assert response.status_code == 200, response.json
+        pages.append([message['id'] for message in response.json['messages']])
+        if response.json['before_id'] is None:
+            break
+        query['before_id'] = response.json['before_id']
+    assert pages == [ids[:2:-1], ids[2:0:-1], ids[:1]]
+    # Poll for messages newer than the first - the oldest page of them, newest first
+    query = {'relationship_id': relationship.relationship_id, 'type': 'all', 'limit': 3, 'after_id': ids[0]}
+    response = client.get('/operation/message', headers=relationship.kh_headers, query_string=query)
+    assert [message['id'] for message in response.json['messages']] == ids[3:0:-1]
+    assert response.json['more'] and response.json['after_id'] == ids[3]
+
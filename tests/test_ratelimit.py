@@ -0,0 +1,19 @@
+"""
+Rate limiting of POST /login - each username gets a burst of attempts, whatever their case, before 429 and a
+Retry-After header, and other usernames are unaffected
+"""
+
+
+def login(client, username: str):
+    return client.post('/login', json={'username': username, 'password': 'guess'})
+
+
+def test_login_throttled_per_username(client):
+    from libs.ratelimit import AUTH_USER_BURST
+    for _ in range(AUTH_USER_BURST):
+        assert login(client, 'mallory').status_code == 401
+    for username in ('mallory', 'MALLORY'):
+        response = login(client, username)
+        assert response.status_code == 429
+        assert int(response.headers['Retry-After']) >= 1
+    assert login(client, 'alice').status_code == 401
@@ -0,0 +1,27 @@
+"""
+Read receipts (POST /operation/message/read) mark one side's messages read up to an id, and the unread counts
+kept on each relationship (GET /operation/message/unread) follow them
+"""
+
+
+def test_read_receipts_and_unread_counts(client, relationship, post_messages):
+    ids = post_messages(3)
+
+    def unread(headers) -> int:
+        response = client.get('/operation/message/unread', headers=headers)
+        assert response.status_code == 200, response.json
+        return response.json['relationships'][0]['unread']
+    assert unread(relationship.kh_headers) == 3 and unread(relationship.sh_headers) == 0
+    response = client.post('/operation/message/read', headers=relationship.kh_headers,
+                           json={'relationship_id': relationship.relationship_id, 'up_to_id': ids[1]})
+    assert response.status_code == 200, response.json
+    assert response.json == {'marked': 2, 'unread': 1}
+    # Marking again changes nothing
+    response = client.post('/operation/message/read', headers=relationship.kh_headers,
+                           json={'relationship_id': relationship.relationship_id, 'up_to_id': ids[1]})
+    assert response.json == {'marked': 0, 'unread': 1}
+    query = {'relationship_id': relationship.relationship_id, 'type': 'unread'}
+    response = client.get('/operation/message', headers=relationship.kh_headers, query_string=query)
+    assert [message['id'] for message in response.json['messages']] == [ids[2]]
+    post_messages(1, headers=relationship.kh_headers)
+    assert unread(relationship.sh_headers) == 1 and unread(relationship.kh_headers) == 1
@@ -0,0 +1,60 @@
+"""
+libs/retention.py - monthly partition names and ranges, the statements creating a partition alongside a default
+partition, and the row-by-row rollup and purge used where safe_event is not partitioned
+"""
+from datetime import date, datetime, timedelta
+
+import pytest
+
+from libs import retention
+
+
+@pytest.mark.parametrize('day, months_ahead, expected', [
+    (date(2026, 1, 31), 0, date(2026, 1, 1)),
+    (date(2026, 11, 15), 2, date(2027, 1, 1)),
+    (date(2026, 12, 1), 1, date(2027, 1, 1)),
+    (date(2026, 12, 1), 13, date(2028, 1, 1)),
+])
+def test_month_start(day, months_ahead, expected):
+    assert retention.month_start(day, months_ahead) == expected
+
+
+def test_partition_names_round_trip():
+    start = date(2027, 3, 1)
+    assert retention.partition_name(start) == 'safe_event_p202703'
+    assert retention.parse_partition_name(retention.partition_name(start)) == start
+    assert retention.parse_partition_name(retention.DEFAULT_PARTITION) is None
+    assert retention.parse_partition_name('safe_event_p2027031') is None
+
+
+def test_create_partition_without_default():
+    assert retention.create_partition_statements(date(2026, 12, 1), has_default=False) == [
+        "CREATE TABLE safe_event_p202612 PARTITION OF safe_event FOR VALUES FROM ('2026-12-01') TO ('2027-01-01')"]
+
+
+def test_create_partition_moves_rows_out_of_default():
+    statements = retention.create_partition_statements(date(2026, 12, 1), has_default=True)
+    assert statements[0] == "ALTER TABLE safe_event DETACH PARTITION safe_event_default"
+    assert statements[1].startswith("CREATE TABLE safe_event_p202612 PARTITION OF safe_event")
+    in_range = "WHERE timestamp >= '2026-12-01' AND timestamp < '2027-01-01'"
+    assert statements[2].startswith("INSERT INTO safe_event_p202612 SELECT") and statements[2].endswith(in_range)
+    assert statements[3] == f"DELETE FROM safe_event_default {in_range}"
+    assert statements[4] == "ALTER TABLE safe_event ATTACH PARTITION safe_event_default DEFAULT"
+
+
+def test_purge_rolls_up_expired_events(db):
+    from models.safe import SafeModel, SafeEventModel, SafeEventRollupModel
+    now = datetime(2026, 6, 1, 12)
+    db.session.add(SafeModel(hardware_id='HW1', last_update=now, unlock_time=now))
+    old = datetime(2026, 1, 10, 8)
+    SafeEventModel.bulk_insert(
+        [{'hardware_id': 'HW1', 'timestamp': old + timedelta(minutes=i), 'event_code': 1, 'detail': 'e'}
+         for i in range(3)] +
+        [{'hardware_id': 'HW1', 'timestamp': now - timedelta(days=1), 'event_code': 1, 'detail': 'e'}])
+    db.session.commit()
+    summary = retention.purge_events(now, retention_days=90, batch_size=2)
+    assert summary['rows_purged'] == 3 and summary['partitions_created'] == []
+    assert SafeEventModel.query.count() == 1
+    rollup = SafeEventRollupModel.query.one()
+    assert (rollup.day, rollup.count, rollup.first_timestamp, rollup.last_timestamp) == (
+        old.date(), 3, old, old + timedelta(minutes=2))
@@ -0,0 +1,45 @@
+"""
+Session-key handshake (POST /api/session) - malformed bodies get 400, and a handshake is only accepted with a
+current timestamp later than the safe's last one, so a captured handshake cannot be replayed to rotate the key
+"""
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+
+def handshake(timestamp: datetime) -> str:
+    return f"SESSION,HW1,{timestamp}"
+
+
+@pytest.mark.parametrize('body', [{'data': 'not json'}, {'json': []}, {'json': {'hwid': 1, 'sig': 'x', 'msg': 'x'}}])
+def test_malformed_body_rejected(client, body):
+    assert client.post('/api/session', **body).status_code == 400
+
+
+def test_session_issued(client, safe):
+    from models.safe import SafeModel
+    response = client.post('/api/session', json=safe.envelope(handshake(datetime.now(timezone.utc))))
+    assert response.status_code == 200, response.json
+    assert safe.read_response(response.json).startswith('Session_key:')
+    assert SafeModel.find_by_id('HW1').session_active(datetime.utcnow())
+
+
+def test_replayed_handshake_rejected(client, safe):
+    from models.safe import SafeModel
+    envelope = safe.envelope(handshake(datetime.now(timezone.utc)))
+    assert client.post('/api/session', json=envelope).status_code == 200
+    session_key = SafeModel.find_by_id('HW1').session_key
+    assert client.post('/api/session', json=envelope).status_code == 400
+    assert SafeModel.find_by_id('HW1').session_key == session_key
+    later = safe.envelope(handshake(datetime.now(timezone.utc) + timedelta(seconds=1)))
+    assert client.post('/api/session', json=later).status_code == 200
+
+
+@pytest.mark.parametrize('skew', [timedelta(hours=-1), timedelta(hours=1)])
+def test_stale_handshake_rejected(client, safe, skew):
+    response = client.post('/api/session', json=safe.envelope(handshake(datetime.now(timezone.utc) + skew)))
+    assert response.status_code == 400
+
+
+def test_malformed_timestamp_rejected(client, safe):
+    assert client.post('/api/session', json=safe.envelope('SESSION,HW1,yesterday')).status_code == 400
@@ -0,0 +1,57 @@
+"""
+SSE message stream (GET /operation/message/stream) - replays the messages after Last-Event-ID, sends each live
+message once even if it was also replayed, and ends with status active false when the relationship ends
+"""
+import json
+
+
+def read_events(response) -> list:
+    """
+    :return: (event type, id, data) for each event in an SSE body, reading it to the end
+    """
+    events = []
+    for block in response.get_data(as_text=True).split('\n\n'):
+        fields = dict(line.split(': ', 1) for line in block.split('\n') if line and not line.startswith(':'))
+        if 'event' in fields:
+            events.append((fields['event'], int(fields['id']) if 'id' in fields else None, json.loads(fields['data'])))
+    return events
+
+
+def stream(client, relationship, last_event_id: int, **kwargs):
+    return client.get('/operation/message/stream', headers=dict(relationship.kh_headers,
+                                                                **{'Last-Event-ID': str(last_event_id)}),
+                      query_string={'relationship_id': relationship.relationship_id}, **kwargs)
+
+
+def test_replay_after_relationship_ended(client, relationship, post_messages):
+    ids = post_messages(3)
+    assert client.delete('/operation/claim_sh', headers=relationship.kh_headers,
+                         json=relationship.claim).status_code == 200
+    response = stream(client, relationship, ids[0])
+    assert response.status_code == 200 and response.mimetype == 'text/event-stream'
+    events = read_events(response)
+    assert events[0][0] == 'status' and not events[0][2]['active']
+    assert [(event_type, event_id) for event_type, event_id, _ in events[1:]] == [('message', ids[1]),
+                                                                                ('message', ids[2])]
+    # Nothing left to send - the client stops reconnecting
+    assert stream(client, relationship, ids[2]).status_code == 204
+
+
+def test_live_messages_sent_once(client, relationship, post_messages):
+    from models.relationship import RelationshipModel, relationship_events
+    ids = post_messages(2)
+    response = stream(client, relationship, ids[0], buffered=False)
+    assert response.status_code == 200
+    # A message committed while the stream was replaying reaches it both ways - it must be sent once
+    replayed = client.get('/operation/message', headers=relationship.kh_headers,
+                          query_string={'relationship_id': relationship.relationship_id, 'type': 'all',
+                                        'limit': 1}).json['messages'][0]
+    channel = RelationshipModel.find_by_id(relationship.relationship_id).channel
+    relationship_events.publish(channel, 'message', replayed, replayed['id'])
+    new_id = post_messages(1)[-1]
+    assert client.delete('/operation/claim_sh', headers=relationship.kh_headers,
+                         json=relationship.claim).status_code == 200
+    events = read_events(response)
+    assert [(event_type, event_id) for event_type, event_id, _ in events] == [
+        ('status', None), ('message', ids[1]), ('message', new_id), ('status', None)]
+    assert events[0][2]['active'] and not events[-1][2]['active']
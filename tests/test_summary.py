@@ -0,0 +1,72 @@
+"""
+GET /operation/summary - built from one query however many relationships the user has, and answered 304 when
+the client's ETag still matches
+"""
+from datetime import date, datetime
+
+import pytest
+
+
+@pytest.fixture
+def keyholder_with_relationships(db, make_user):
+    """
+    A keyholder in n relationships, each with its own safe and safeholder, who also owns two safes
+    """
+    from models.relationship import RelationshipModel
+    from models.safe import SafeModel
+
+    def make(n: int) -> int:
+        now = datetime.utcnow()
+        keyholder_id = make_user('kh')
+        for i in range(n):
+            safeholder_id = make_user(f"sh{i}")
+            db.session.add(SafeModel(hardware_id=f"HW{i}", safeholder_id=safeholder_id, last_update=now,
+                                     unlock_time=now))
+            db.session.add(RelationshipModel(keyholder_id=keyholder_id, safeholder_id=safeholder_id,
+                                             safe_id=f"HW{i}", start_date=date.today()))
+        for i in range(2):
+            db.session.add(SafeModel(hardware_id=f"OWN{i}", safeholder_id=keyholder_id, last_update=now,
+                                     unlock_time=now))
+        db.session.commit()
+        return keyholder_id
+    return make
+
+
+@pytest.mark.parametrize('relationships', [0, 25])
+def test_summary_query_count_is_fixed(client, auth_headers, count_queries, keyholder_with_relationships,
+                                      relationships):
+    headers = auth_headers(keyholder_with_relationships(relationships))
+    client.get('/operation/summary', headers=headers)  # Identity now cached, as for a polling client
+    with count_queries() as queries:
+        response = client.get('/operation/summary', headers=headers)
+    assert response.status_code == 200
+    assert len(response.json['safe_list']) == relationships + 2
+    assert queries[0] == 1
+
+
+def test_summary_etag_round_trip(client, auth_headers, keyholder_with_relationships):
+    headers = auth_headers(keyholder_with_relationships(3))
+    response = client.get('/operation/summary', headers=headers)
+    etag = response.headers['ETag']
+    assert response.headers['Cache-Control'] == 'private, no-cache'
+
+    not_modified = client.get('/operation/summary', headers=dict(headers, **{'If-None-Match': etag}))
+    assert not_modified.status_code == 304
+    assert not_modified.headers['ETag'] == etag
+    assert not_modified.data == b''
+
+    stale = client.get('/operation/summary', headers=dict(headers, **{'If-None-Match': '"stale"'}))
+    assert stale.status_code == 200
+    assert stale.json == response.json
+
+
+def test_summary_etag_changes_with_content(client, db, auth_headers, keyholder_with_relationships):
+    from models.safe import SafeModel
+    headers = auth_headers(keyholder_with_relationships(1))
+    etag = client.get('/operation/summary', headers=headers).headers['ETag']
+    safe = SafeModel.find_by_id('HW0')
+    safe.hinge_closed = safe.lid_closed = safe.bolt_engaged = True
+    db.session.commit()
+    response = client.get('/operation/summary', headers=dict(headers, **{'If-None-Match': etag}))
+    assert response.status_code == 200
+    assert response.headers['ETag'] != etag
@@ -0,0 +1,45 @@
+"""
+The unlock scheduler - only the holder of the lease authorises safes, each once, and a safe it has authorised
+is told so at its next checkin.  The schedulers are ticked by hand rather than from their threads
+"""
+from datetime import datetime, timedelta, timezone
+
+
+def scheduler(holder: str):
+    from libs.unlock_scheduler import UnlockScheduler
+    from models.lease import LeaseModel
+    from models.safe import SafeModel
+    unlocks = UnlockScheduler(tick_secs=0, reload_secs=10, lease_secs=15)
+    unlocks.init_app(None, loader=SafeModel.find_pending_unlocks, unlocker=SafeModel.authorise_unlocks,
+                     acquire=LeaseModel.acquire, release=LeaseModel.release)
+    unlocks._holder = holder
+    return unlocks
+
+
+def test_leader_authorises_due_safes(client, db, safe):
+    from libs.unlock_scheduler import LEASE_NAME
+    from models.lease import LeaseModel
+    from models.safe import SafeModel
+    now = datetime.utcnow()
+    SafeModel.find_by_id('HW1').unlock_time = now - timedelta(seconds=1)
+    db.session.add(SafeModel(hardware_id='HW2', last_update=now, unlock_time=now + timedelta(seconds=5)))
+    db.session.commit()
+    leader, follower = scheduler('A'), scheduler('B')
+    assert leader.tick(now) == 1
+    assert follower.tick(now) == 0
+    assert leader.stats() == {"leader": True, "pending": 1, "unlocked": 1}
+    assert follower.stats() == {"leader": False, "pending": 0, "unlocked": 0}
+    assert leader.tick(now) == 0
+    assert [s.hardware_id for s in SafeModel.find_all() if s.auth_to_unlock] == ['HW1']
+
+    message = f"STATUS,HW1,{datetime.now(timezone.utc)},True,True,True"
+    response = client.post('/api/checkin', json=safe.envelope(message))
+    assert response.status_code == 200, response.json
+    assert safe.read_response(response.json).startswith('Auth_to_unlock:TRUE:')
+
+    # Released at shutdown, the lease passes to the follower, which picks up HW2 when it falls due
+    LeaseModel.release(LEASE_NAME, 'A')
+    later = now + timedelta(seconds=follower.lease_secs)
+    assert follower.tick(later) == 1
+    assert follower.is_leader
+    assert SafeModel.find_by_id('HW2').auth_to_unlock
@@ -0,0 +1,135 @@
+"""
+libs/wire.py - the binary envelope for checkins and registration.  Every kind round-trips to the JSON form the
+resources use, malformed bodies are rejected, and JSON stays the default when the client does not ask for binary
+"""
+import base64
+import json
+import os
+
+import pytest
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+
+from libs import wire
+
+
+def b64(n_bytes: int) -> str:
+    return base64.urlsafe_b64encode(os.urandom(n_bytes)).decode('ascii')
+
+
+def public_key_pem() -> str:
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048, backend=default_backend())
+    return key.public_key().public_bytes(encoding=serialization.Encoding.PEM,
+                                         format=serialization.PublicFormat.SubjectPublicKeyInfo).decode('ascii')
+
+
+REQUESTS = {
+    wire.RSA_CHECKIN: lambda: {'hwid': 'HW-0001', 'sig': b64(256), 'msg': b64(512)},
+    wire.SESSION_CHECKIN: lambda: {'hwid': 'HW-0001', 'nonce': b64(12), 'ct': b64(300)},
+    wire.REGISTER: lambda: {'hwid': 'HW-0001', 'pkey': public_key_pem()},
+}
+RESPONSES = {
+    wire.RSA_RESPONSE: lambda: {'sig': b64(256), 'msg': b64(256)},
+    wire.SESSION_RESPONSE: lambda: {'nonce': b64(12), 'ct': b64(80)},
+    wire.KEY_RESPONSE: lambda: {'key': public_key_pem()},
+    wire.ERROR_RESPONSE: lambda: {'error': 'Checkin error - naïve text'},
+}
+
+
+@pytest.mark.parametrize('kind', sorted(REQUESTS))
+def test_request_round_trip(kind):
+    body = REQUESTS[kind]()
+    data = wire.encode_request(body)
+    assert data[:2] == wire.MAGIC and data[2] == wire.VERSION and data[3] == kind
+    assert wire.decode_request(data) == body
+
+
+@pytest.mark.parametrize('kind', sorted(RESPONSES))
+def test_response_round_trip(kind):
+    body = RESPONSES[kind]()
+    data = wire.encode_response(body)
+    assert data[3] == kind
+    assert wire.decode_response(data) == body
+
+
+def test_binary_is_smaller_than_json():
+    body = REQUESTS[wire.RSA_CHECKIN]()
+    assert len(wire.encode_request(body)) < len(json.dumps(body))
+
+
+@pytest.mark.parametrize('header', [b'XS\x01\x01', b'CS\x02\x01', b'CS\x01\x04', b'CS\x01\x00'])
+def test_bad_header_rejected(header):
+    data = wire.encode_request(REQUESTS[wire.RSA_CHECKIN]())
+    with pytest.raises(wire.WireFormatError):
+        wire.unpack(header + data[4:])
+
+
+@pytest.mark.parametrize('kind', sorted(REQUESTS))
+def test_truncated_request_rejected(kind):
+    data = wire.encode_request(REQUESTS[kind]())
+    for length in range(len(data)):
+        with pytest.raises(wire.WireFormatError):
+            wire.decode_request(data[:length])
+
+
+@pytest.mark.parametrize('kind', sorted(RESPONSES))
+def test_truncated_response_rejected(kind):
+    data = wire.encode_response(RESPONSES[kind]())
+    for length in range(len(data)):
+        with pytest.raises(wire.WireFormatError):
+            wire.decode_response(data[:length])
+
+
+def test_trailing_bytes_rejected():
+    data = wire.encode_request(REQUESTS[wire.SESSION_CHECKIN]())
+    with pytest.raises(wire.WireFormatError):
+        wire.decode_request(data + b'\x00')
+
+
+def test_requests_and_responses_not_confused():
+    with pytest.raises(wire.WireFormatError):
+        wire.decode_request(wire.encode_response(RESPONSES[wire.ERROR_RESPONSE]()))
+    with pytest.raises(wire.WireFormatError):
+        wire.decode_response(wire.encode_request(REQUESTS[wire.RSA_CHECKIN]()))
+
+
+def test_invalid_text_rejected():
+    data = wire.pack(wire.RSA_CHECKIN, [b'\xff\xfe', b'sig', b'msg'])
+    with pytest.raises(wire.WireFormatError):
+        wire.decode_request(data)
+
+
+def test_oversized_field_rejected():
+    with pytest.raises(wire.WireFormatError):
+        wire.encode_request({'hwid': 'H' * 256, 'sig': b64(8), 'msg': b64(8)})
+
+
+def test_json_is_the_default(app):
+    body = REQUESTS[wire.RSA_CHECKIN]()
+    with app.test_request_context('/api/checkin', method='POST', json=body):
+        assert not wire.wants_binary()
+        assert wire.request_body() == body
+        assert wire.negotiated(lambda: ({'msg': 'x'}, 200))() == ({'msg': 'x'}, 200)
+
+
+def test_binary_request_gets_binary_response(app):
+    body = REQUESTS[wire.SESSION_CHECKIN]()
+    with app.test_request_context('/api/checkin', method='POST', data=wire.encode_request(body),
+                                  content_type=wire.CONTENT_TYPE):
+        assert wire.wants_binary()
+        assert wire.request_body() == body
+        response = wire.negotiated(lambda: ({'error': 'Checkin error'}, 400))()
+        assert response.status_code == 400 and response.mimetype == wire.CONTENT_TYPE
+        assert wire.decode_response(response.get_data()) == {'error': 'Checkin error'}
+
+
+def test_json_request_may_ask_for_binary_response(app):
+    with app.test_request_context('/api/checkin', method='POST', json={}, headers={'Accept': wire.CONTENT_TYPE}):
+        assert wire.wants_binary()
+
+
+def test_malformed_binary_request_body_is_none(app):
+    with app.test_request_context('/api/checkin', method='POST', data=b'CS\x01\x01\x00',
+                                  content_type=wire.CONTENT_TYPE):
+        assert wire.request_body() is None